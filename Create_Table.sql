@@ -27,3 +27,100 @@ CREATE TABLE Storico_Modifiche_Fatture (
     targa VARCHAR(20)
 );
 GO
+
+-- Checkpoint dell'ingestione: un watermark per azienda, aggiornato nella stessa transazione degli inserimenti
+CREATE TABLE Checkpoint_Ingestione (
+    azienda VARCHAR(10) PRIMARY KEY,
+    id_esecuzione INT,
+    last_id_documento INT NOT NULL,
+    aggiornato_il DATETIME
+);
+GO
+
+-- Storico delle esecuzioni di main.py
+CREATE TABLE Storico_Esecuzioni (
+    id INT PRIMARY KEY IDENTITY(1,1),
+    avvio DATETIME NOT NULL,
+    fine DATETIME,
+    stato VARCHAR(20) NOT NULL,
+    record_inseriti INT,
+    dettaglio VARCHAR(MAX)
+);
+GO
+
+-- Riepilogo delle differenze (ultima modifica per azienda e id_documento) per azienda, mese e utente,
+-- aggiornato da main.py a ogni inserimento e letto da dashboard ed export
+CREATE TABLE Riepilogo_Modifiche_Fatture (
+    azienda VARCHAR(10) NOT NULL,
+    mese VARCHAR(7) NOT NULL,
+    utente VARCHAR(50) NOT NULL,
+    numero_record INT NOT NULL,
+    differenza_totale DECIMAL(18, 2) NOT NULL,
+    PRIMARY KEY (azienda, mese, utente)
+);
+GO
+
+-- Shard dell'ingestione distribuita (main.py --coordinatore / --worker): log dell'azienda con id_da < id_documento <= id_a
+CREATE TABLE Lease_Ingestione (
+    id INT PRIMARY KEY IDENTITY(1,1),
+    id_esecuzione INT NOT NULL,
+    azienda VARCHAR(10) NOT NULL,
+    id_da INT NOT NULL,
+    id_a INT NOT NULL,
+    stato VARCHAR(20) NOT NULL,
+    worker VARCHAR(100),
+    scadenza DATETIME,
+    ultimo_id_documento INT NOT NULL,
+    record_letti INT NOT NULL,
+    record_inseriti INT NOT NULL,
+    tentativi INT NOT NULL,
+    errore VARCHAR(1000),
+    aggiornato_il DATETIME
+);
+GO
+CREATE INDEX IX_Lease_Esecuzione_Stato ON Lease_Ingestione (id_esecuzione, stato);
+GO
+
+-- Metriche di fine esecuzione di main.py (una riga per processo), lette da /metrics della dashboard
+CREATE TABLE Metriche_Esecuzioni (
+    id INT PRIMARY KEY IDENTITY(1,1),
+    id_esecuzione INT NOT NULL,
+    processo VARCHAR(100),
+    registrata_il DATETIME NOT NULL,
+    secondi FLOAT,
+    record_letti INT,
+    record_inseriti INT,
+    record_scartati INT,
+    record_al_secondo FLOAT,
+    fasi VARCHAR(MAX)
+);
+GO
+CREATE INDEX IX_Metriche_Esecuzione ON Metriche_Esecuzioni (id_esecuzione);
+GO
+
+-- Indici di Storico_Modifiche_Fatture, definiti in models.py (python migrations.py --sql)
+CREATE UNIQUE INDEX UX_Storico_Chiave_Naturale ON Storico_Modifiche_Fatture (azienda, id_documento, data_modifica, id_reg_pd)
+    INCLUDE (utente, importo_fattura, importo_modifica);
+GO
+CREATE INDEX IX_Storico_Data_Modifica ON Storico_Modifiche_Fatture (data_modifica, id)
+    INCLUDE (azienda, id_documento, id_reg_pd, data_trasmissione_fattura, targa, importo_fattura, importo_modifica, utente);
+GO
+CREATE INDEX IX_Storico_Azienda_Data_Modifica ON Storico_Modifiche_Fatture (azienda, data_modifica, id)
+    INCLUDE (id_documento, id_reg_pd, data_trasmissione_fattura, targa, importo_fattura, importo_modifica, utente);
+GO
+
+-- Versione dello schema: le migrazioni di migrations.py già incluse in questo script
+CREATE TABLE Schema_Versione (
+    versione INT PRIMARY KEY,
+    descrizione VARCHAR(200) NOT NULL,
+    applicata_il DATETIME NOT NULL
+);
+GO
+INSERT INTO Schema_Versione (versione, descrizione, applicata_il) VALUES
+    (1, 'Tabelle di storico, checkpoint, esecuzioni e riepilogo', GETDATE()),
+    (2, 'Indice univoco sulla chiave naturale e indici coprenti di Storico_Modifiche_Fatture', GETDATE()),
+    (3, 'Tabella Lease_Ingestione per l''ingestione a shard', GETDATE()),
+    (4, 'Tabella Metriche_Esecuzioni', GETDATE()),
+    (5, 'Storico_Esecuzioni.dettaglio VARCHAR(MAX)', GETDATE()),
+    (6, 'Metriche_Esecuzioni.fasi VARCHAR(MAX)', GETDATE());
+GO
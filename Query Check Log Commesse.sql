@@ -35,6 +35,9 @@ WHERE
 	AND storico_modifiche.note like '%ivato%'
 	and cli.cond_pag ='205' --pagamento in contanti
 	and cli.id_reg_pd>0
+	and storico_modifiche.id_documento > ? --checkpoint: ultimo id_documento elaborato
+	and storico_modifiche.id_documento <= ? --fine dell'intervallo (shard dell'ingestione distribuita)
+	and (cli.anno is null or cli.anno >= ?) --anno minimo per azienda ([ANNO_MINIMO] in config.ini)
 order by
    cli.id_documento,
    storico_modifiche.data_operazione
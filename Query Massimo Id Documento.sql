@@ -0,0 +1,8 @@
+SELECT
+	max(storico_modifiche.id_documento) as id_massimo,
+	min(storico_modifiche.id_documento) as id_minimo
+FROM
+	dba.hst_doc storico_modifiche
+WHERE
+	storico_modifiche.nome_tabella='tdo_cli'
+	AND storico_modifiche.id_documento > ? --checkpoint: ultimo id_documento elaborato
@@ -0,0 +1,3 @@
+select trasmissione_testata.id_reg_pd, trasmissione_testata.fine_trasmissione, trasmissione_dettaglio.nome_file, trasmissione_dettaglio.file_xml_vendita from dba.reg_pd_fattura_xml as trasmissione_testata
+inner join dba.reg_pd_fattura_pa as trasmissione_dettaglio on trasmissione_dettaglio.id_reg_pd=trasmissione_testata.id_reg_pd
+where trasmissione_testata.id_reg_pd in ({placeholders})
\ No newline at end of file
@@ -0,0 +1,213 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import BigInteger, cast, func, select
+
+from models import StoricoEsecuzioni, StoricoModificheFatture
+from riepilogo import SOGLIA_DIFFERENZA
+
+# Righe lette dal database per ogni blocco del caricamento
+CHUNK_RIGHE = 50000
+
+# Fasce del ritardo (giorni) tra la modifica e la trasmissione della fattura
+FASCE_RITARDO = (0, 1, 7, 30, 90, 365, np.inf)
+ETICHETTE_RITARDO = ('< 1 giorno', '1-7 giorni', '7-30 giorni', '30-90 giorni', '90-365 giorni', '> 365 giorni')
+PERCENTILI = (50, 75, 90, 95, 99)
+# Massimo numero di targhe richiedibili e di analisi (azienda, top) tenute in cache
+TOP_MASSIMO = 100
+VOCI_CACHE = 32
+
+COLONNE = ('azienda', 'utente', 'targa', 'data_modifica', 'data_trasmissione_fattura',
+           'importo_fattura_cent', 'importo_modifica_cent')
+
+
+def _centesimi(colonna):
+    # Importo DECIMAL(18,2) come intero in centesimi: somme e soglia esatte anche in float64
+    return cast(func.round(colonna * 100, 0), BigInteger)
+
+
+def _euro(centesimi):
+    return round(float(centesimi) / 100, 2)
+
+
+class AnalisiStore:
+    """
+    Analisi delle differenze per la dashboard (/api/analytics): per utente, per mese di data_modifica,
+    per fascia di ritardo tra modifica e trasmissione della fattura, targhe con la differenza maggiore
+    e percentili di differenza e ritardo, sull'ultima modifica di ogni documento come il riepilogo.
+
+    Le colonne necessarie vengono lette a blocchi di CHUNK_RIGHE righe in un DataFrame pandas
+    (importi in centesimi interi, testi come categorie) e le aggregazioni sono calcolate in forma
+    vettoriale. I risultati restano in cache finché non cambia l'ultima esecuzione di main.py
+    in Storico_Esecuzioni (id e stato): un'esecuzione in corso aggiorna l'analisi quando termina.
+    La cache tiene le voci_cache analisi usate più di recente; azienda deve essere una di quelle
+    presenti nello storico (senza distinzione tra maiuscole e minuscole) e top è limitato a TOP_MASSIMO.
+    """
+
+    def __init__(self, session_factory, chunk=CHUNK_RIGHE, voci_cache=VOCI_CACHE):
+        self.Session = session_factory
+        self.chunk = chunk
+        self.voci_cache = voci_cache
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._aziende = None
+        self._versione = None
+
+    def versione(self):
+        """(id, stato) dell'ultima esecuzione registrata in Storico_Esecuzioni, None se non ce ne sono."""
+        with self.Session() as session:
+            riga = session.execute(
+                select(StoricoEsecuzioni.id, StoricoEsecuzioni.stato).order_by(StoricoEsecuzioni.id.desc()).limit(1)
+            ).first()
+        return tuple(riga) if riga else None
+
+    def aziende(self):
+        """Aziende presenti in Storico_Modifiche_Fatture."""
+        with self.Session() as session:
+            return [row[0] for row in session.execute(
+                select(StoricoModificheFatture.azienda).where(StoricoModificheFatture.azienda.isnot(None)).distinct()
+            )]
+
+    def invalida(self):
+        """Svuota la cache (es. dopo lo svuotamento della tabella)."""
+        with self._lock:
+            self._cache.clear()
+            self._aziende = None
+
+    def analisi(self, azienda=None, top=10):
+        """
+        Ritorna (risultato, da_cache) per l'azienda (None = tutte) e il numero di targhe indicati.
+        Solleva ValueError se l'azienda non è presente nello storico.
+        """
+        top = max(1, min(int(top), TOP_MASSIMO))
+        versione = self.versione()
+        with self._lock:
+            if versione != self._versione:
+                self._cache.clear()
+                self._aziende = None
+                self._versione = versione
+            aziende = self._aziende
+        if aziende is None:
+            aziende = {nome.strip().upper(): nome for nome in self.aziende()}
+            with self._lock:
+                if versione == self._versione:
+                    self._aziende = aziende
+        if azienda:
+            nome = aziende.get(azienda.strip().upper())
+            if nome is None:
+                raise ValueError(f"Azienda {azienda} non presente nello storico")
+            azienda = nome
+        chiave = (azienda or None, top)
+        with self._lock:
+            if chiave in self._cache:
+                self._cache.move_to_end(chiave)
+                return self._cache[chiave], True
+
+        inizio = time.perf_counter()
+        risultato = self.calcola(self.carica(chiave[0]), top)
+        risultato['id_esecuzione'] = versione[0] if versione else None
+        risultato['secondi_calcolo'] = round(time.perf_counter() - inizio, 3)
+        with self._lock:
+            if versione == self._versione:
+                self._cache[chiave] = risultato
+                while len(self._cache) > self.voci_cache:
+                    self._cache.popitem(last=False)
+        return risultato, False
+
+    def carica(self, azienda=None):
+        """DataFrame con le colonne di COLONNE dell'ultima modifica di ogni documento."""
+        modello = StoricoModificheFatture
+        rn = func.row_number().over(
+            partition_by=(modello.azienda, modello.id_documento),
+            order_by=(modello.data_modifica.desc(), modello.id)
+        ).label('rn')
+        ultime = select(modello.azienda, modello.utente, modello.targa, modello.data_modifica,
+                        modello.data_trasmissione_fattura,
+                        _centesimi(modello.importo_fattura).label('importo_fattura_cent'),
+                        _centesimi(modello.importo_modifica).label('importo_modifica_cent'), rn)
+        if azienda:
+            ultime = ultime.where(modello.azienda == azienda)
+        ultime = ultime.subquery()
+        query = select(*(ultime.c[nome] for nome in COLONNE)).where(ultime.c.rn == 1)
+
+        blocchi = []
+        with self.Session() as session:
+            result = session.execute(query, execution_options={'yield_per': self.chunk})
+            for righe in result.partitions():
+                blocchi.append(self._blocco(righe))
+        if not blocchi:
+            return self._blocco([])
+        frame = pd.concat(blocchi, ignore_index=True)
+        for nome in ('azienda', 'utente', 'targa'):
+            frame[nome] = frame[nome].astype('category')
+        return frame
+
+    @staticmethod
+    def _blocco(righe):
+        frame = pd.DataFrame.from_records(righe, columns=COLONNE)
+        for nome in ('azienda', 'utente', 'targa'):
+            frame[nome] = frame[nome].fillna('').astype(str)
+        for nome in ('data_modifica', 'data_trasmissione_fattura'):
+            frame[nome] = pd.to_datetime(frame[nome], errors='coerce')
+        for nome in ('importo_fattura_cent', 'importo_modifica_cent'):
+            frame[nome] = pd.to_numeric(frame[nome], errors='coerce').astype('float64')
+        return frame
+
+    @staticmethod
+    def calcola(frame, top=10):
+        """Aggregazioni del DataFrame di carica(); importi in euro, ritardi in giorni."""
+        soglia = float(SOGLIA_DIFFERENZA * 100)
+        differenza = frame['importo_fattura_cent'] - frame['importo_modifica_cent']
+        # Come riepilogo.contributo: differenza oltre la soglia, altrimenti 0 (anche se manca un importo)
+        contributo = differenza.where(differenza > soglia, 0.0).fillna(0.0)
+        ritardo = (frame['data_trasmissione_fattura'] - frame['data_modifica']) / pd.Timedelta(days=1)
+        dati = pd.DataFrame({
+            'utente': frame['utente'],
+            'targa': frame['targa'],
+            'mese': frame['data_modifica'].dt.year * 100 + frame['data_modifica'].dt.month,
+            'fascia_ritardo': pd.cut(ritardo, FASCE_RITARDO, labels=ETICHETTE_RITARDO, right=False),
+            'contributo': contributo,
+            'con_differenza': contributo > 0,
+        })
+
+        def gruppi(chiave, etichetta=str):
+            aggregati = dati.groupby(chiave, observed=True, sort=True).agg(
+                numero_record=('contributo', 'size'),
+                record_con_differenza=('con_differenza', 'sum'),
+                differenza_totale=('contributo', 'sum'),
+                differenza_massima=('contributo', 'max'),
+            )
+            return [{chiave: etichetta(valore), 'numero_record': int(r.numero_record),
+                     'record_con_differenza': int(r.record_con_differenza),
+                     'differenza_totale': _euro(r.differenza_totale),
+                     'differenza_massima': _euro(r.differenza_massima)}
+                    for valore, r in zip(aggregati.index, aggregati.itertuples())]
+
+        targhe = dati[dati['targa'] != ''].groupby('targa', observed=True).agg(
+            numero_record=('contributo', 'size'), differenza_totale=('contributo', 'sum')
+        ).nlargest(top, 'differenza_totale')
+
+        def percentili(valori):
+            valori = valori.dropna().to_numpy()
+            if not len(valori):
+                return {}
+            return {f'p{p}': round(float(v), 2) for p, v in zip(PERCENTILI, np.percentile(valori, PERCENTILI))}
+
+        return {
+            'numero_record': int(len(dati)),
+            'record_con_differenza': int(dati['con_differenza'].sum()),
+            'differenza_totale': _euro(contributo.sum()),
+            'per_utente': gruppi('utente'),
+            'per_mese': gruppi('mese', lambda mese: f'{int(mese) // 100:04d}-{int(mese) % 100:02d}'),
+            'per_ritardo': gruppi('fascia_ritardo'),
+            'top_targhe': [{'targa': targa, 'numero_record': int(r.numero_record),
+                            'differenza_totale': _euro(r.differenza_totale)}
+                           for targa, r in zip(targhe.index, targhe.itertuples())],
+            'percentili': {
+                'differenza': percentili(differenza / 100),
+                'ritardo_giorni': percentili(ritardo),
+            },
+        }
@@ -1,11 +1,20 @@
-from flask import Flask, render_template, send_file, request, redirect, url_for, flash
-import io
-import pandas as pd
-import subprocess
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, abort
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import and_, exists, or_, select
+from sqlalchemy.orm import aliased, sessionmaker
 from models import StoricoModificheFatture
+from riepilogo import RiepilogoStore, contributo
+from analisi import AnalisiStore
+from checkpoint import CheckpointStore
+from jobs import EsecuzioneGiaAttiva, JobRunner
+from migrations import migrazioni_mancanti
+from database import get_engine
+from export_to_csv import righe_csv
+from log_config import configura_logging
+from metriche import LatenzeRoute, MetricheStore
 import configparser
+import logging
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key' # Per flask o rompe le scatole
@@ -13,117 +22,287 @@ app.secret_key = 'your_secret_key' # Per flask o rompe le scatole
 # Carica la configurazione
 config = configparser.ConfigParser()
 config.read('config.ini')
+configura_logging(config)
+logger = logging.getLogger(__name__)
 
 # Connessione SQL Server
-sqlserver_conf = config['SQLSERVER']
-sqlserver_conn_str = (
-    f"mssql+pyodbc://{sqlserver_conf['username']}:{sqlserver_conf['password']}@"
-    f"{sqlserver_conf['server']}/{sqlserver_conf['database']}?driver=ODBC+Driver+17+for+SQL+Server"
-)
-engine = create_engine(sqlserver_conn_str)
+engine = get_engine(config)
 Session = sessionmaker(bind=engine)
+# Tabelle di supporto e indici usati dalle query della dashboard (vedi migrations.py): li crea main.py
+# o python migrations.py, non l'avvio della dashboard (una migrazione verifica i doppioni dello storico)
+mancanti = migrazioni_mancanti(engine)
+if mancanti:
+    logger.warning("Schema del database non aggiornato (migrazioni mancanti: %s): eseguire python migrations.py",
+                   ', '.join(map(str, mancanti)))
+riepilogo_store = RiepilogoStore(Session)
+# Analisi delle differenze (/api/analytics), in cache fino alla prossima esecuzione di main.py
+analisi_store = AnalisiStore(Session)
+checkpoint_store = CheckpointStore.da_config(config, Session)
+# Metriche per /metrics: latenze delle route (tempo totale, SQL e template) e ultime esecuzioni di main.py
+latenze_route = LatenzeRoute()
+latenze_route.registra(app, engine)
+metriche_store = MetricheStore(Session)
+
+# Esecuzioni di main.py avviate dalla dashboard (sezione [JOBS])
+job_runner = JobRunner.da_config(config, Session, checkpoint_store)
 
 @app.route('/')
 def index():
-    session = Session()
-    # Lista aziende distinte
-    aziende = [row[0] for row in session.query(StoricoModificheFatture.azienda).distinct().order_by(StoricoModificheFatture.azienda)]
     azienda_filtro = request.args.get('azienda', default=None, type=str)
-    query = session.query(StoricoModificheFatture)
-    if azienda_filtro and azienda_filtro != 'TUTTE':
-        query = query.filter(StoricoModificheFatture.azienda == azienda_filtro)
-    all_records = query.order_by(StoricoModificheFatture.data_modifica.desc()).all()
-    
-    # Raggruppa per id_documento e prendi solo l'ultimo (più recente)
-    records_dict = {}
-    for rec in all_records:
-        id_doc = rec.id_documento
-        if id_doc not in records_dict:
-            records_dict[id_doc] = rec
-    
-    records = list(records_dict.values())
-    
-    # Calcola statistiche
-    totale_record = len(records)
-    totale_differenza = 0.0
-    for rec in records:
-        try:
-            if rec.importo_fattura is not None and rec.importo_modifica is not None:
-                diff = float(rec.importo_fattura) - float(rec.importo_modifica)
-                if diff > 0.05:
-                    totale_differenza += diff
-        except Exception:
-            pass
-    
+    if azienda_filtro == 'TUTTE':
+        azienda_filtro = None
+
+    # Statistiche lette dal riepilogo mantenuto da main.py (ultima modifica per azienda e id_documento).
+    # Le righe della tabella non vengono generate qui: il browser le legge a pagine da /api/records.
+    aziende = riepilogo_store.aziende()
+    totale_record, totale_differenza = riepilogo_store.totali(azienda_filtro)
+
     # Totali per azienda (solo se nessun filtro attivo)
     totali_per_azienda = []
-    if not azienda_filtro or azienda_filtro == 'TUTTE':
-        for az in aziende:
-            if not az:
-                continue
-            recs_az_all = [r for r in session.query(StoricoModificheFatture).filter(StoricoModificheFatture.azienda == az).order_by(StoricoModificheFatture.data_modifica.desc()).all()]
-            # Raggruppa per id_documento
-            recs_az_dict = {}
-            for r in recs_az_all:
-                if r.id_documento not in recs_az_dict:
-                    recs_az_dict[r.id_documento] = r
-            recs_az = list(recs_az_dict.values())
-            count_az = len(recs_az)
-            diff_az = 0.0
-            for r in recs_az:
-                try:
-                    if r.importo_fattura is not None and r.importo_modifica is not None:
-                        diff = float(r.importo_fattura) - float(r.importo_modifica)
-                        if diff > 0.05:
-                            diff_az += diff
-                except Exception:
-                    pass
-            totali_per_azienda.append({'azienda': az, 'record': count_az, 'differenza': diff_az})
-    
-    session.close()
+    if not azienda_filtro:
+        totali_per_azienda = [{'azienda': az, 'record': count_az, 'differenza': float(diff_az)}
+                              for az, count_az, diff_az in riepilogo_store.totali_per_azienda()]
+
     return render_template(
         'index.html',
-        records=records,
         totale_record=totale_record,
-        totale_differenza=totale_differenza,
+        totale_differenza=float(totale_differenza),
         aziende=aziende,
         azienda_filtro=azienda_filtro,
-        totali_per_azienda=totali_per_azienda
+        totali_per_azienda=totali_per_azienda,
+        targa_filtro=request.args.get('targa', default='', type=str),
+        utente_filtro=request.args.get('utente', default='', type=str),
+        data_da=request.args.get('da', default='', type=str),
+        data_a=request.args.get('a', default='', type=str),
+        id_job_attivo=job_runner.attiva()
+    )
+
+
+# Colonne della riga in tabella; le altre vengono lette da /api/records/<id> quando la riga viene espansa
+COLONNE_RIGA = ('id', 'id_documento', 'id_reg_pd', 'azienda', 'data_trasmissione_fattura', 'targa',
+                'importo_fattura', 'importo_modifica', 'utente', 'data_modifica')
+COLONNE_DETTAGLIO = ('anno', 'id_cliente', 'tipo_doc', 'data_doc', 'num_doc', 'tipo_fattura', 'data_fattura',
+                     'numero_fattura', 'tipo_pagamento', 'id_hst', 'nome_tabella', 'tipo_operazione', 'note',
+                     'data_modifica')
+PAGINA_DEFAULT = 100
+PAGINA_MAX = 500
+
+
+def _valore_json(valore):
+    # Date e datetime come stringhe ISO, importi (Decimal) come numeri, il resto così com'è
+    if isinstance(valore, Decimal):
+        return float(valore)
+    if isinstance(valore, datetime):
+        return valore.isoformat(sep=' ')
+    if hasattr(valore, 'isoformat'):
+        return valore.isoformat()
+    return valore
+
+
+def _parametro_data(nome):
+    valore = request.args.get(nome, default='', type=str)
+    if not valore:
+        return None
+    try:
+        return datetime.strptime(valore, '%Y-%m-%d')
+    except ValueError:
+        abort(400, f'Parametro {nome} non valido (formato AAAA-MM-GG)')
+
+
+def ultima_del_documento():
+    """
+    Condizione SQL vera solo per l'ultima modifica del proprio documento (stessa azienda e id_documento),
+    con lo stesso criterio del riepilogo (data_modifica più recente, a parità l'id più basso;
+    una data_modifica NULL è più vecchia di qualsiasi data).
+    È una NOT EXISTS correlata invece di ROW_NUMBER(): il database scorre le righe nell'ordine della
+    pagina e si ferma al LIMIT, senza numerare prima tutta la tabella.
+    """
+    successiva = aliased(StoricoModificheFatture)
+    condizioni = [
+        successiva.azienda == StoricoModificheFatture.azienda,
+        successiva.id_documento == StoricoModificheFatture.id_documento,
+        or_(
+            successiva.data_modifica > StoricoModificheFatture.data_modifica,
+            and_(successiva.data_modifica == StoricoModificheFatture.data_modifica,
+                 successiva.id < StoricoModificheFatture.id),
+            and_(StoricoModificheFatture.data_modifica.is_(None), successiva.data_modifica.isnot(None)),
+            and_(StoricoModificheFatture.data_modifica.is_(None), successiva.data_modifica.is_(None),
+                 successiva.id < StoricoModificheFatture.id),
+        ),
+    ]
+    return ~exists(select(successiva.id).where(*condizioni))
+
+
+def _contiene(testo):
+    # Pattern LIKE per "contiene testo": %, _ e [ (classe di caratteri in SQL Server) valgono letteralmente
+    for carattere in ('\\', '%', '_', '['):
+        testo = testo.replace(carattere, '\\' + carattere)
+    return f'%{testo}%'
+
+
+# API JSON: record paginati con keyset su (data_modifica, id), dal più recente (le date NULL in fondo)
+@app.route('/api/records')
+def api_records():
+    azienda_filtro = request.args.get('azienda', default=None, type=str)
+    if azienda_filtro == 'TUTTE':
+        azienda_filtro = None
+    targa = request.args.get('targa', default='', type=str).strip()
+    utente = request.args.get('utente', default='', type=str).strip()
+    data_da = _parametro_data('da')
+    data_a = _parametro_data('a')
+    limite = max(1, min(request.args.get('limite', default=PAGINA_DEFAULT, type=int), PAGINA_MAX))
+
+    modello = StoricoModificheFatture
+    query = (
+        select(*(getattr(modello, nome) for nome in COLONNE_RIGA))
+        .where(ultima_del_documento())
+        .order_by(modello.data_modifica.desc(), modello.id.desc())
+        .limit(limite + 1)
+    )
+    if azienda_filtro:
+        query = query.where(modello.azienda == azienda_filtro)
+    if targa:
+        query = query.where(modello.targa.like(_contiene(targa), escape='\\'))
+    if utente:
+        query = query.where(modello.utente.like(_contiene(utente), escape='\\'))
+    if data_da:
+        query = query.where(modello.data_modifica >= data_da)
+    if data_a:
+        # Data finale inclusa
+        query = query.where(modello.data_modifica < data_a + timedelta(days=1))
+
+    # Cursore della pagina precedente: "data_modifica|id" dell'ultima riga ricevuta ("|id" se la data è NULL).
+    # Le date NULL sono le ultime nell'ordinamento decrescente, sia in SQL Server sia in SQLite.
+    dopo = request.args.get('dopo', default='', type=str)
+    if dopo:
+        try:
+            data_cursore, separatore, id_cursore = dopo.rpartition('|')
+            data_cursore = datetime.fromisoformat(data_cursore) if data_cursore else None
+            id_cursore = int(id_cursore)
+            if not separatore:
+                raise ValueError(dopo)
+        except ValueError:
+            abort(400, 'Parametro dopo non valido')
+        if data_cursore is None:
+            query = query.where(modello.data_modifica.is_(None), modello.id < id_cursore)
+        else:
+            query = query.where(or_(
+                modello.data_modifica < data_cursore,
+                and_(modello.data_modifica == data_cursore, modello.id < id_cursore),
+                modello.data_modifica.is_(None),
+            ))
+
+    with Session() as session:
+        righe = session.execute(query).all()
+
+    successivo = None
+    if len(righe) > limite:
+        righe = righe[:limite]
+        ultima = righe[-1]
+        data_ultima = ultima.data_modifica.isoformat(sep=' ') if ultima.data_modifica else ''
+        successivo = f'{data_ultima}|{ultima.id}'
+    return jsonify(
+        records=[{nome: _valore_json(valore) for nome, valore in zip(COLONNE_RIGA, riga)} for riga in righe],
+        successivo=successivo
     )
 
 
+# API JSON: campi di dettaglio di un record, letti all'espansione della riga
+@app.route('/api/records/<int:record_id>')
+def api_record_dettaglio(record_id):
+    with Session() as session:
+        riga = session.execute(
+            select(*(getattr(StoricoModificheFatture, nome) for nome in COLONNE_DETTAGLIO))
+            .where(StoricoModificheFatture.id == record_id)
+        ).first()
+    if riga is None:
+        abort(404)
+    return jsonify({nome: _valore_json(valore) for nome, valore in zip(COLONNE_DETTAGLIO, riga)})
+
+
+# API JSON: differenze per utente, mese, ritardo di trasmissione, targhe principali e percentili
+@app.route('/api/analytics')
+def api_analytics():
+    azienda_filtro = request.args.get('azienda', default=None, type=str)
+    if azienda_filtro == 'TUTTE':
+        azienda_filtro = None
+    top = request.args.get('top', default=10, type=int)
+    try:
+        risultato, da_cache = analisi_store.analisi(azienda_filtro, top)
+    except ValueError as e:
+        abort(400, str(e))
+    return jsonify(azienda=azienda_filtro, da_cache=da_cache, **risultato)
+
+
 # Route per svuotare la tabella
 @app.route('/clear-table', methods=['POST'])
 def clear_table():
     session = Session()
     session.query(StoricoModificheFatture).delete()
+    riepilogo_store.svuota(session)
     session.commit()
     session.close()
+    analisi_store.invalida()
     flash('Tabella svuotata con successo!', 'success')
     return redirect(url_for('index'))
 
-# Route per avviare lo script main.py
+# Route per avviare lo script main.py in background (una sola esecuzione alla volta)
 @app.route('/run-script', methods=['POST'])
 def run_script():
     try:
-        # Avvia main.py come sottoprocesso
-        result = subprocess.run(['python', 'main.py'], capture_output=True, text=True, cwd='.')
-        if result.returncode == 0:
-            flash('Script eseguito con successo!', 'success')
-        else:
-            flash(f'Errore nell\'esecuzione dello script: {result.stderr}', 'danger')
+        id_esecuzione = job_runner.avvia()
+        flash(f'Esecuzione {id_esecuzione} avviata: avanzamento qui sotto', 'success')
+    except EsecuzioneGiaAttiva as e:
+        flash(f"Esecuzione {e.id_esecuzione} già in corso: attendere che termini", 'warning')
     except Exception as e:
         flash(f'Errore: {e}', 'danger')
     return redirect(url_for('index'))
 
 
-# Route per esportazione CSV
+# Storico delle ultime esecuzioni (JSON)
+@app.route('/jobs')
+def jobs():
+    limite = max(1, min(request.args.get('limite', default=20, type=int), 100))
+    return jsonify(esecuzioni=job_runner.storico(limite))
+
+
+# Stato e avanzamento di un'esecuzione (JSON): azienda, record letti, record/s, ETA
+@app.route('/jobs/<int:id_esecuzione>')
+def job(id_esecuzione):
+    stato = job_runner.stato(id_esecuzione)
+    if stato is None:
+        abort(404)
+    return jsonify(stato)
+
+
+# Metriche (JSON): latenze per route dall'avvio della dashboard e metriche delle ultime esecuzioni di main.py
+@app.route('/metrics')
+def metrics():
+    limite = max(1, min(request.args.get('limite', default=5, type=int), 100))
+    return jsonify(route=latenze_route.stato(), ingestione=metriche_store.ultime(limite))
+
+
+def _riga_export(rec):
+    importo_fattura = rec.importo_fattura if rec.importo_fattura is not None else Decimal('0')
+    importo_modifica = rec.importo_modifica if rec.importo_modifica is not None else Decimal('0')
+    differenza = importo_fattura - importo_modifica
+    return [
+        rec.id_documento,
+        rec.id_reg_pd or '',
+        rec.azienda or '',
+        rec.data_trasmissione_fattura.strftime('%d-%m-%Y %H:%M') if rec.data_trasmissione_fattura else '',
+        rec.targa or '',
+        f"{importo_fattura:.2f} €",
+        f"{importo_modifica:.2f} €",
+        f"{differenza:.2f} €",
+        rec.utente or '',
+        rec.data_modifica.strftime('%d-%m-%Y %H:%M') if rec.data_modifica else ''
+    ]
+
+
+# Route per esportazione CSV: le righe vengono inviate man mano che sono lette dal database
 @app.route('/export')
 def export():
-    session = Session()
-    records = session.query(StoricoModificheFatture).order_by(StoricoModificheFatture.id.desc()).all()
-    session.close()
-    
     # Colonne per la nuova visualizzazione
     columns = [
         'ID Documento',
@@ -137,64 +316,44 @@ def export():
         'Utente',
         'Data Modifica'
     ]
-    
-    data = []
-    for rec in records:
-        importo_fattura = rec.importo_fattura if rec.importo_fattura is not None else 0.0
-        importo_modifica = rec.importo_modifica if rec.importo_modifica is not None else 0.0
-        differenza = importo_fattura - importo_modifica
-        
-        data.append({
-            'ID Documento': rec.id_documento,
-            'ID Reg PD': rec.id_reg_pd or '',
-            'Azienda': rec.azienda or '',
-            'Data Trasmissione Fattura': rec.data_trasmissione_fattura.strftime('%d-%m-%Y %H:%M') if rec.data_trasmissione_fattura else '',
-            'Targa': rec.targa or '',
-            'Importo Fattura': f"{importo_fattura:.2f} €",
-            'Importo Ultima Modifica': f"{importo_modifica:.2f} €",
-            'Differenza': f"{differenza:.2f} €",
-            'Utente': rec.utente or '',
-            'Data Modifica': rec.data_modifica.strftime('%d-%m-%Y %H:%M') if rec.data_modifica else ''
-        })
-    
-    df = pd.DataFrame(data, columns=columns)
-    output = io.StringIO()
-    df.to_csv(output, index=False, sep=';')
-    
-    # Riga vuota
-    output.write('\n')
-    
-    # Statistiche per azienda
-    output.write('Azienda;Numero Record;Differenza Totale\n')
-    aziende_stats = {}
-    for rec in records:
-        azienda = rec.azienda or 'N/D'
-        if azienda not in aziende_stats:
-            aziende_stats[azienda] = {'count': 0, 'diff': 0.0}
-        aziende_stats[azienda]['count'] += 1
-        try:
-            if rec.importo_fattura is not None and rec.importo_modifica is not None:
-                diff = float(rec.importo_fattura) - float(rec.importo_modifica)
-                if diff > 0:
-                    aziende_stats[azienda]['diff'] += diff
-        except Exception:
-            pass
-    
-    for azienda in sorted(aziende_stats.keys()):
-        stats = aziende_stats[azienda]
-        output.write(f'{azienda};{stats["count"]};{stats["diff"]:.2f} €\n')
-    
-    # Totale generale
-    totale_record = sum(s['count'] for s in aziende_stats.values())
-    totale_diff = sum(s['diff'] for s in aziende_stats.values())
-    output.write(f'TOTALE GENERALE;{totale_record};{totale_diff:.2f} €\n')
-    
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.getvalue().encode('utf-8-sig')),
+    modello = StoricoModificheFatture
+    query = select(
+        modello.id_documento, modello.id_reg_pd, modello.azienda, modello.data_trasmissione_fattura, modello.targa,
+        modello.importo_fattura, modello.importo_modifica, modello.utente, modello.data_modifica
+    ).order_by(modello.id.desc())
+
+    def genera():
+        # Statistiche per azienda delle righe esportate (tutte le modifiche, non solo l'ultima per documento
+        # come la dashboard): numero di righe e somma delle differenze oltre riepilogo.SOGLIA_DIFFERENZA
+        statistiche = {}
+
+        def formatta(rec):
+            valori = statistiche.setdefault(rec.azienda or 'N/D', [0, Decimal('0')])
+            valori[0] += 1
+            valori[1] += contributo(rec.importo_fattura, rec.importo_modifica)
+            return _riga_export(rec)
+
+        yield '\ufeff'  # BOM UTF-8 per Excel
+        yield from righe_csv(engine, query, columns, formatta)
+
+        # Riga vuota
+        yield '\n'
+
+        righe = ['Azienda;Numero Record;Differenza Totale\n']
+        for azienda in sorted(statistiche):
+            count_az, diff_az = statistiche[azienda]
+            righe.append(f'{azienda};{count_az};{diff_az:.2f} €\n')
+
+        # Totale generale
+        totale_record = sum(count_az for count_az, _ in statistiche.values())
+        totale_diff = sum((diff_az for _, diff_az in statistiche.values()), Decimal('0'))
+        righe.append(f'TOTALE GENERALE;{totale_record};{totale_diff:.2f} €\n')
+        yield ''.join(righe)
+
+    return Response(
+        genera(),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name='storico_modifiche_fatture.csv'
+        headers={'Content-Disposition': 'attachment; filename=storico_modifiche_fatture.csv'}
     )
 
 if __name__ == '__main__':
@@ -0,0 +1,279 @@
+"""
+Benchmark end-to-end di ingestione (main.py), dashboard e export (app.py) su dati sintetici.
+
+Genera una sorgente Infinity sintetica in SQLite per ogni azienda (benchmarks/sorgente_sintetica.py),
+usa un database SQLite come destinazione al posto di SQL Server e collega main.py alle sorgenti
+tramite main.connetti_sorgente, senza ODBC. Poi esegue:
+  - l'ingestione completa (main.main()) e una seconda esecuzione sugli stessi dati
+    (tutti i record già presenti, importi fattura dalla cache);
+  - le route della dashboard (/, /api/records: prima pagina, scorrimento di tutte le pagine, dettaglio)
+    e /export letto in streaming fino in fondo.
+
+Riporta record/s dell'ingestione, tempi per fase della pipeline di main.py (lavoro e attese dovute
+alle fasi vicine, da PipelineAzienda.statistiche), latenze per route e il picco di memoria residente
+(RSS) del processo dopo ogni parte; i processi di analisi XML non sono inclusi nel picco.
+La generazione dei dati avviene in processi separati e non pesa sul picco di RSS.
+Il log di main.py (livello --log-level) viene scartato, ma la formattazione dei messaggi resta nei tempi.
+
+Uso:
+    python benchmarks/bench_end_to_end.py [--aziende 2] [--documenti 5000] [--modifiche-per-documento 3]
+        [--righe-fattura 20] [--allegato-kb 0] [--workers 2] [--ripetizioni 5] [--log-level INFO]
+        [--cartella DIR]
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RADICE = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, RADICE)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import sorgente_sintetica  # noqa: E402
+
+AZIENDE = ['AU', 'CV', 'MO', 'VE', 'PD', 'TV']
+FILE_SQL = ['Query Check Log Commesse.sql', 'Query Recupero Fatture Batch.sql', 'Query Recupero Trasmissioni Batch.sql',
+            'Query Massimo Id Documento.sql']
+
+
+def picco_rss_mb():
+    """Picco di memoria residente del processo in MB (None dove resource non è disponibile)."""
+    if resource is None:
+        return None
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return picco / 1024 / 1024 if sys.platform == 'darwin' else picco / 1024  # byte su macOS, KB su Linux
+
+
+class Tempi:
+    """Durate (secondi) raccolte per nome, anche da più thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durate = {}
+
+    def aggiungi(self, nome, secondi):
+        with self._lock:
+            self.durate.setdefault(nome, []).append(secondi)
+
+    def riga(self, nome):
+        durate = sorted(self.durate.get(nome, []))
+        if not durate:
+            return f"{nome:<34} {'-':>8}"
+        p95 = durate[min(len(durate) - 1, int(len(durate) * 0.95))]
+        return (f"{nome:<34} {len(durate):>8} {sum(durate):>10.2f} {sum(durate) / len(durate) * 1000:>10.2f} "
+                f"{p95 * 1000:>10.2f} {durate[-1] * 1000:>10.2f}")
+
+    @staticmethod
+    def intestazione():
+        return f"{'Route':<34} {'chiamate':>8} {'totale s':>10} {'media ms':>10} {'p95 ms':>10} {'max ms':>10}"
+
+
+def somma_statistiche(statistiche):
+    """Somma per fase le StatisticheFasi delle pipeline delle aziende."""
+    totali = {}
+    for singola in statistiche:
+        for fase, valori in singola.fasi.items():
+            for chiave, valore in valori.items():
+                totali.setdefault(fase, dict.fromkeys(valori, 0))[chiave] += valore
+    return totali
+
+
+def stampa_fasi(titolo, fasi):
+    print(f"{titolo}\n{'Fase':<16} {'elementi':>9} {'lavoro s':>9} {'µs/elem.':>9} {'attesa ingresso s':>18} "
+          f"{'attesa uscita s':>16}")
+    for fase, v in fasi.items():
+        per_elemento = v['lavoro'] / v['elementi'] * 1e6 if v['elementi'] else 0.0
+        print(f"{fase:<16} {v['elementi']:>9} {v['lavoro']:>9.2f} {per_elemento:>9.0f} {v['attesa_ingresso']:>18.2f} "
+              f"{v['attesa_uscita']:>16.2f}")
+    print()
+
+
+def prepara_cartella(cartella, args):
+    """Genera le sorgenti (in parallelo, una per azienda) e scrive config.ini e le query nella cartella."""
+    aziende = AZIENDE[:args.aziende]
+    sorgenti = {azienda: os.path.join(cartella, f'sorgente_{azienda.lower()}.db') for azienda in aziende}
+    with ProcessPoolExecutor(max_workers=len(aziende)) as executor:
+        futures = {azienda: executor.submit(sorgente_sintetica.genera_sorgente, percorso, args.documenti,
+                                            args.modifiche_per_documento, args.righe_fattura, args.allegato_kb,
+                                            args.anno_minimo, seed=n + 1)
+                   for n, (azienda, percorso) in enumerate(sorgenti.items())}
+        conteggi = {azienda: future.result() for azienda, future in futures.items()}
+    for nome in FILE_SQL:
+        shutil.copy(os.path.join(RADICE, nome), cartella)
+    dsn = ', '.join(f'{azienda}^{percorso}^bench^bench' for azienda, percorso in sorgenti.items())
+    with open(os.path.join(cartella, 'config.ini'), 'w') as f:
+        f.write(f"[SQLSERVER]\nurl = sqlite:///{os.path.join(cartella, 'destinazione.db')}\n\n"
+                f"[SOURCE_INFINITY]\ndsn = {dsn}\nworkers = {args.workers}\n\n"
+                f"[ANNO_MINIMO]\ndefault = {args.anno_minimo}\n\n"
+                f"[LOG]\nlivello = {args.log_level}\n\n"
+                f"[CACHE_FATTURE]\npercorso = {os.path.join(cartella, 'cache_fatture.sqlite')}\n")
+    return conteggi
+
+
+@contextlib.contextmanager
+def silenzioso():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def esegui_ingestione(main, workers):
+    """Esegue main.main() come da riga di comando; ritorna (secondi, righe di log lette, record inseriti)."""
+    from models import StoricoEsecuzioni
+    from sqlalchemy import select
+
+    argv = sys.argv
+    sys.argv = ['main.py', '--workers', str(workers)]
+    inizio = time.perf_counter()
+    try:
+        with silenzioso():
+            main.main()
+    finally:
+        secondi = time.perf_counter() - inizio
+        sys.argv = argv
+    with main.Session() as session:
+        esecuzione = session.execute(select(StoricoEsecuzioni).order_by(StoricoEsecuzioni.id.desc())).scalars().first()
+    aziende = json.loads(esecuzione.dettaglio).get('aziende', {})
+    letti = sum(valori.get('letti') or 0 for valori in aziende.values())
+    return secondi, letti, esecuzione.record_inseriti
+
+
+def misura_route(client, analisi_store, tempi, ripetizioni):
+    """Latenze delle route della dashboard e dell'export; ritorna (righe lette da /api/records, byte esportati)."""
+    def get(nome, url, **kwargs):
+        inizio = time.perf_counter()
+        risposta = client.get(url, **kwargs)
+        tempi.aggiungi(nome, time.perf_counter() - inizio)
+        assert risposta.status_code == 200, f"{url}: {risposta.status_code}"
+        return risposta
+
+    for _ in range(ripetizioni):
+        get('GET /', '/')
+        get('GET /api/records prima pagina', '/api/records')
+        get('GET /api/records azienda', '/api/records', query_string={'azienda': AZIENDE[0]})
+
+    # Scorrimento completo della tabella come fa la dashboard caricando le pagine successive
+    dopo, righe, id_record = None, 0, []
+    while True:
+        pagina = get('GET /api/records pagina', '/api/records', query_string={'limite': 100, **({'dopo': dopo} if dopo else {})}).get_json()
+        righe += len(pagina['records'])
+        id_record.extend(r['id'] for r in pagina['records'][:1])
+        dopo = pagina['successivo']
+        if not dopo:
+            break
+    for id_ in id_record[:ripetizioni * 10]:
+        get('GET /api/records/<id>', f'/api/records/{id_}')
+
+    # Analisi: il primo calcolo per ogni esecuzione di main.py, poi dalla cache
+    for _ in range(ripetizioni):
+        analisi_store.invalida()
+        get('GET /api/analytics calcolo', '/api/analytics')
+        get('GET /api/analytics cache', '/api/analytics')
+
+    byte_export = 0
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        risposta = client.get('/export', buffered=False)
+        byte_export, primo = 0, None
+        for blocco in risposta.response:
+            if primo is None:
+                primo = time.perf_counter() - inizio
+            byte_export += len(blocco)
+        risposta.close()
+        tempi.aggiungi('GET /export primo blocco', primo or 0.0)
+        tempi.aggiungi('GET /export completo', time.perf_counter() - inizio)
+    return righe, byte_export
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark end-to-end di ingestione, dashboard ed export')
+    parser.add_argument('--aziende', type=int, default=2, choices=range(1, len(AZIENDE) + 1))
+    parser.add_argument('--documenti', type=int, default=5000, help='commesse per azienda')
+    parser.add_argument('--modifiche-per-documento', type=int, default=3, help='righe di log medie per commessa')
+    parser.add_argument('--righe-fattura', type=int, default=20, help='righe di dettaglio per fattura XML')
+    parser.add_argument('--allegato-kb', type=int, default=0, help='dimensione allegato PDF nelle fatture')
+    parser.add_argument('--anno-minimo', type=int, default=date.today().year - 1)
+    parser.add_argument('--workers', type=int, default=2, help='aziende elaborate in parallelo da main.py')
+    parser.add_argument('--ripetizioni', type=int, default=5, help='richieste per route')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING'], type=str.upper)
+    parser.add_argument('--cartella', help='cartella di lavoro (default: temporanea, rimossa a fine benchmark)')
+    args = parser.parse_args()
+
+    cartella = os.path.abspath(args.cartella) if args.cartella else tempfile.mkdtemp(prefix='bench_e2e_')
+    os.makedirs(cartella, exist_ok=True)
+    try:
+        inizio = time.perf_counter()
+        conteggi = prepara_cartella(cartella, args)
+        righe_log = sum(c['hst_doc'] for c in conteggi.values())
+        byte_sorgenti = sum(os.path.getsize(os.path.join(cartella, f'sorgente_{a.lower()}.db')) for a in conteggi)
+        print(f"Sorgenti sintetiche: {len(conteggi)} aziende, {sum(c['tdo_cli'] for c in conteggi.values())} commesse, "
+              f"{righe_log} righe di log, {sum(c['reg_pd_fattura_pa'] for c in conteggi.values())} fatture XML, "
+              f"{byte_sorgenti / 1024 / 1024:.1f} MB ({time.perf_counter() - inizio:.1f} s) in {cartella}\n")
+
+        # main.py e app.py leggono config.ini e le query dalla cartella corrente
+        os.chdir(cartella)
+        rss_iniziale = picco_rss_mb()
+        # Il log va scartato: configurato qui, main.py e app.py ne impostano solo il livello
+        logging.basicConfig(stream=open(os.devnull, 'w'))
+        import main as ingestione
+        ingestione.connetti_sorgente = sorgente_sintetica.connetti
+        # Raccoglie le statistiche per fase della pipeline di ogni azienda
+        statistiche = []
+        esegui_pipeline = ingestione.PipelineAzienda.esegui
+
+        def esegui_e_raccogli(pipeline):
+            try:
+                return esegui_pipeline(pipeline)
+            finally:
+                statistiche.append(pipeline.statistiche)
+        ingestione.PipelineAzienda.esegui = esegui_e_raccogli
+
+        risultati = []
+        for etichetta in ('Ingestione', 'Ingestione ripetuta'):
+            statistiche.clear()
+            secondi, letti, inseriti = esegui_ingestione(ingestione, args.workers)
+            risultati.append((etichetta, secondi, letti, inseriti, picco_rss_mb(), somma_statistiche(statistiche)))
+
+        with silenzioso():
+            import app as dashboard
+        dashboard.app.testing = True
+        tempi_route = Tempi()
+        righe_pagine, byte_export = misura_route(dashboard.app.test_client(), dashboard.analisi_store, tempi_route, args.ripetizioni)
+        rss_finale = picco_rss_mb()
+    finally:
+        os.chdir(RADICE)
+        if not args.cartella:
+            shutil.rmtree(cartella, ignore_errors=True)
+
+    def rss(valore):
+        return f"{valore:.0f} MB" if valore is not None else 'n/d'
+
+    print(f"{'Esecuzione':<22} {'secondi':>8} {'letti':>8} {'inseriti':>9} {'letti/s':>9} {'inseriti/s':>10} {'picco RSS':>10}")
+    for etichetta, secondi, letti, inseriti, picco, _ in risultati:
+        print(f"{etichetta:<22} {secondi:>8.2f} {letti:>8} {inseriti:>9} {letti / secondi:>9.0f} "
+              f"{inseriti / secondi:>10.0f} {rss(picco):>10}")
+    print(f"(picco RSS prima dell'ingestione: {rss(rss_iniziale)}, dopo dashboard ed export: {rss(rss_finale)})\n")
+
+    for etichetta, _, _, _, _, fasi in risultati:
+        stampa_fasi(f"{etichetta}: fasi della pipeline (somma delle aziende)", fasi)
+
+    print(f"Dashboard ed export ({righe_pagine} righe in /api/records, export {byte_export / 1024:.0f} KB)")
+    print(Tempi.intestazione())
+    for nome in tempi_route.durate:
+        print(tempi_route.riga(nome))
+
+
+if __name__ == '__main__':
+    main()
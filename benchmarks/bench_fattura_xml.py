@@ -0,0 +1,161 @@
+"""
+Micro-benchmark del parsing delle fatture elettroniche.
+
+Confronta fattura_xml.extract_importo_from_xml (iterparse in streaming) con la vecchia
+implementazione basata su ElementTree.fromstring, su fatture sintetiche con molte righe
+di dettaglio, più corpi e un allegato. Riporta tempo medio per fattura e picco di memoria:
+- RSS: aumento del picco di memoria residente durante un parsing, misurato in un processo figlio
+  (fork) con resource.getrusage; comprende le allocazioni C di lxml. È un limite inferiore: la
+  memoria già liberata dal processo e riusata dal parsing non lo aumenta. Solo dove fork e
+  resource sono disponibili (Linux, macOS), altrimenti n/d.
+- Python: picco di tracemalloc, che vede solo le allocazioni dell'interprete; con lxml non conta
+  l'albero e i buffer del parser e sottostima la memoria reale.
+
+Uso:
+    python benchmarks/bench_fattura_xml.py [--righe 2000] [--corpi 3] [--allegato-kb 512] [--ripetizioni 20]
+"""
+import argparse
+import base64
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fattura_xml  # noqa: E402
+
+NAMESPACE = 'http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2'
+
+
+def extract_importo_from_xml_dom(xml_content):
+    """Implementazione precedente (albero completo, tag senza namespace), usata come riferimento."""
+    if not xml_content or not isinstance(xml_content, (str, bytes)):
+        return None
+    try:
+        if isinstance(xml_content, bytes):
+            xml_content = xml_content.decode('utf-8', errors='ignore')
+        root = ET.fromstring(xml_content)
+        importo_totale = root.find('.//ImportoTotaleDocumento')
+        importo_totale_val = float(importo_totale.text) if importo_totale is not None else 0.0
+        spesa_materiale = 0.0
+        iva_materiale = 0.0
+        for dettaglio in root.findall('.//DettaglioLinee'):
+            descrizione = dettaglio.find('Descrizione')
+            if descrizione is not None and 'Spesa Materiale consumo' in descrizione.text:
+                prezzo_totale = dettaglio.find('PrezzoTotale')
+                aliquota_iva = dettaglio.find('AliquotaIVA')
+                if prezzo_totale is not None:
+                    valore = float(prezzo_totale.text)
+                    spesa_materiale += valore
+                    if aliquota_iva is not None:
+                        try:
+                            iva_materiale += valore * float(aliquota_iva.text) / 100.0
+                        except Exception:
+                            pass
+        return round(importo_totale_val - spesa_materiale - iva_materiale, 2)
+    except Exception:
+        return None
+
+
+def genera_fattura(righe, corpi, allegato_kb, namespace_default=False):
+    """Genera una FatturaPA sintetica (bytes) con righe 'Spesa Materiale consumo' ogni 10 righe."""
+    radice = f'<FatturaElettronica xmlns="{NAMESPACE}" versione="FPR12">' if namespace_default \
+        else f'<p:FatturaElettronica xmlns:p="{NAMESPACE}" versione="FPR12">'
+    chiusura = '</FatturaElettronica>' if namespace_default else '</p:FatturaElettronica>'
+    allegato = base64.b64encode(os.urandom(allegato_kb * 1024)).decode('ascii') if allegato_kb else ''
+    parti = ['<?xml version="1.0" encoding="UTF-8"?>', radice,
+             '<FatturaElettronicaHeader><DatiTrasmissione><ProgressivoInvio>00001</ProgressivoInvio>'
+             '</DatiTrasmissione></FatturaElettronicaHeader>']
+    for _ in range(corpi):
+        parti.append('<FatturaElettronicaBody><DatiGenerali><DatiGeneraliDocumento>'
+                     f'<ImportoTotaleDocumento>{righe * 12.2:.2f}</ImportoTotaleDocumento>'
+                     '</DatiGeneraliDocumento></DatiGenerali><DatiBeniServizi>')
+        for n in range(righe):
+            descrizione = 'Spesa Materiale consumo' if n % 10 == 0 else f'Manodopera riga {n}'
+            parti.append(f'<DettaglioLinee><NumeroLinea>{n + 1}</NumeroLinea><Descrizione>{descrizione}</Descrizione>'
+                         '<Quantita>1.00</Quantita><PrezzoUnitario>10.00</PrezzoUnitario>'
+                         '<PrezzoTotale>10.00</PrezzoTotale><AliquotaIVA>22.00</AliquotaIVA></DettaglioLinee>')
+        parti.append('<DatiRiepilogo><AliquotaIVA>22.00</AliquotaIVA><ImponibileImporto>0</ImponibileImporto>'
+                     '</DatiRiepilogo></DatiBeniServizi>')
+        if allegato:
+            parti.append(f'<Allegati><NomeAttachment>fattura.pdf</NomeAttachment><Attachment>{allegato}</Attachment></Allegati>')
+        parti.append('</FatturaElettronicaBody>')
+    parti.append(chiusura)
+    return ''.join(parti).encode('utf-8')
+
+
+def _picco_rss_kb():
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return picco / 1024 if sys.platform == 'darwin' else picco  # byte su macOS, KB su Linux
+
+
+def _parsing_figlio(funzione, xml_content, risultati):
+    # Nel figlio il picco parte dalla memoria residente al momento del fork
+    iniziale = _picco_rss_kb()
+    with contextlib.redirect_stdout(io.StringIO()):
+        funzione(xml_content)
+    risultati.put(_picco_rss_kb() - iniziale)
+
+
+def picco_rss(funzione, xml_content):
+    """Aumento del picco di memoria residente (byte) di un parsing in un processo figlio, None se non misurabile."""
+    if resource is None or 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    contesto = multiprocessing.get_context('fork')
+    risultati = contesto.Queue()
+    processo = contesto.Process(target=_parsing_figlio, args=(funzione, xml_content, risultati))
+    processo.start()
+    aumento = risultati.get()
+    processo.join()
+    return aumento * 1024
+
+
+def misura(funzione, xml_content, ripetizioni):
+    # Prima del riscaldamento: la memoria liberata dalle esecuzioni precedenti verrebbe riusata nel figlio
+    rss = picco_rss(funzione, xml_content)
+    # Il print di debug della funzione non deve pesare sulla misura
+    with contextlib.redirect_stdout(io.StringIO()):
+        risultato = funzione(xml_content)
+        inizio = time.perf_counter()
+        for _ in range(ripetizioni):
+            funzione(xml_content)
+        durata = (time.perf_counter() - inizio) / ripetizioni
+        tracemalloc.start()
+        funzione(xml_content)
+        _, picco = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return risultato, durata, rss, picco
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing XML fatture')
+    parser.add_argument('--righe', type=int, default=2000, help='righe DettaglioLinee per corpo')
+    parser.add_argument('--corpi', type=int, default=3, help='FatturaElettronicaBody per file')
+    parser.add_argument('--allegato-kb', type=int, default=512, help='dimensione allegato per corpo (KB)')
+    parser.add_argument('--ripetizioni', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"Parser streaming: {'lxml' if fattura_xml.LXML else 'xml.etree'}")
+    for namespace_default in (False, True):
+        xml_content = genera_fattura(args.righe, args.corpi, args.allegato_kb, namespace_default)
+        print(f"\nFattura {len(xml_content) / 1024:.0f} KB, {args.corpi} corpi x {args.righe} righe"
+              f"{', namespace di default' if namespace_default else ''}")
+        for nome, funzione in (('dom (precedente)', extract_importo_from_xml_dom),
+                               ('iterparse', fattura_xml.extract_importo_from_xml)):
+            risultato, durata, rss, picco = misura(funzione, xml_content, args.ripetizioni)
+            rss = f'{rss / 1024 / 1024:7.2f} MB' if rss is not None else '    n/d'
+            print(f"  {nome:<18} importo={risultato!s:<12} {durata * 1000:8.2f} ms/fattura  "
+                  f"picco RSS {rss}  Python {picco / 1024 / 1024:7.2f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Conformità e velocità dell'estrazione dell'importo dalle note dei log (main.extract_importi).
+
+Su un corpus di note nei formati presenti in hst_doc ("Totale ivato da 1.234,56 a 1.300,00",
+importi con punto o virgola, 1-3 decimali, note senza importo, vuote o None) confronta
+extract_importi (Decimal, a blocchi) con extract_importo (float, una nota alla volta):
+i risultati devono coincidere, salvo gli importi a 3 decimali che finiscono in 5, dove
+extract_importi arrotonda per eccesso e il float dipende dalla rappresentazione binaria.
+Riporta poi la differenza tra le somme (float e Decimal) e le note/s della vecchia
+implementazione, di extract_importo e di extract_importi.
+Esce con codice 1 se trova differenze non attese.
+
+Uso:
+    python benchmarks/bench_importi_note.py [--note 200000] [--blocco 1000] [--ripetizioni 3] [--seed 1]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+RADICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RADICE)
+
+MODELLI = (
+    'Totale ivato da {a} a {b}',
+    'Totale ivato modificato: {b}',
+    'Importo ivato {b} €',
+    'ivato {b}',
+    'Totale ivato da {a} a {b} (rif. ordine {n})',
+    'Totale IVATO variato da € {a} a € {b}',
+    'Modificato totale ivato',
+)
+NOTE_FISSE = (None, '', 'ivato', 'Totale ivato da  a ', 'Totale ivato da 123456789 a 987654321',
+              'Totale ivato da 0,125 a 0,135', 'Totale ivato da 12,345 a 12,355', 'ivato 99999999,999',
+              'ivato 1.000.000,00', 'ivato 7', 'ivato 7,5', 'ivato 0,005', 'ivato 1,0001', 'ivato 3.14159')
+
+
+def extract_importo_precedente(note):
+    """Implementazione precedente (regex non compilata, una nota alla volta), usata come riferimento."""
+    if not note:
+        return None
+    match = re.findall(r"\b\d{1,8}(?:[\.,]\d{1,3})?\b", note)
+    if match:
+        val = match[-1].replace(',', '.')
+        try:
+            return float(f"{float(val):.2f}")
+        except Exception:
+            return None
+    return None
+
+
+def formatta(casuale, valore):
+    """Importo nei formati usati nelle note: separatore decimale virgola o punto, migliaia, 0-3 decimali."""
+    decimali = casuale.choice((0, 1, 2, 2, 2, 3))
+    testo = f'{valore:,.{decimali}f}' if casuale.random() < 0.3 else f'{valore:.{decimali}f}'
+    if casuale.random() < 0.8:
+        # Formato italiano: punto per le migliaia, virgola per i decimali
+        testo = testo.replace(',', '_').replace('.', ',').replace('_', '.')
+    return testo
+
+
+def genera_note(numero, seed):
+    casuale = random.Random(seed)
+    note = list(NOTE_FISSE)
+    while len(note) < numero:
+        modello = casuale.choice(MODELLI)
+        note.append(modello.format(a=formatta(casuale, casuale.uniform(0, 20000)),
+                                   b=formatta(casuale, casuale.uniform(0, 20000)), n=casuale.randint(1, 99999)))
+    return note
+
+
+def ultimo_numero(note):
+    trovati = re.findall(r"\b\d{1,8}(?:[\.,]\d{1,3})?\b", note) if note else None
+    return trovati[-1] if trovati else None
+
+
+def verifica(ingestione, note):
+    """Ritorna (differenze attese per arrotondamento, differenze non attese)."""
+    attese, inattese = [], []
+    for nota, atteso, importo in zip(note, map(ingestione.extract_importo, note), ingestione.extract_importi(note)):
+        if atteso is None and importo is None:
+            continue
+        if atteso is not None and importo is not None and Decimal(repr(atteso)) == importo:
+            continue
+        numero = ultimo_numero(nota) or ''
+        decimali = re.split(r'[.,]', numero)[1] if re.search(r'[.,]', numero) else ''
+        if (atteso is not None and importo is not None and len(decimali) == 3 and decimali.endswith('5')
+                and abs(Decimal(repr(atteso)) - importo) == Decimal('0.01')):
+            attese.append((nota, atteso, importo))
+        else:
+            inattese.append((nota, atteso, importo))
+    return attese, inattese
+
+
+def misura(funzione, ripetizioni):
+    migliore = None
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        funzione()
+        durata = time.perf_counter() - inizio
+        migliore = durata if migliore is None else min(migliore, durata)
+    return migliore
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark estrazione importi dalle note')
+    parser.add_argument('--note', type=int, default=200000, help='note nel corpus')
+    parser.add_argument('--blocco', type=int, default=1000, help='note per chiamata di extract_importi')
+    parser.add_argument('--ripetizioni', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # main.py legge config.ini dalla cartella corrente: database di destinazione in memoria
+    cartella = tempfile.mkdtemp(prefix='bench_importi_')
+    with open(os.path.join(cartella, 'config.ini'), 'w') as f:
+        f.write('[SQLSERVER]\nurl = sqlite://\n')
+    os.chdir(cartella)
+    import main as ingestione
+
+    note = genera_note(args.note, args.seed)
+    attese, inattese = verifica(ingestione, note)
+    print(f"Conformità su {len(note)} note: {len(note) - len(attese) - len(inattese)} identiche, "
+          f"{len(attese)} arrotondamenti a metà centesimo, {len(inattese)} differenze non attese")
+    for nota, atteso, importo in inattese[:10]:
+        print(f"  {nota!r}: extract_importo={atteso!r} extract_importi={importo!r}")
+
+    somma_float = sum(i for i in map(ingestione.extract_importo, note) if i is not None)
+    somma_decimal = sum(i for i in ingestione.extract_importi(note) if i is not None)
+    print(f"Somma importi: float {somma_float!r}, Decimal {somma_decimal}")
+
+    blocchi = [note[i:i + args.blocco] for i in range(0, len(note), args.blocco)]
+    print(f"\n{'Implementazione':<32} {'secondi':>8} {'note/s':>12}")
+    for nome, funzione in (
+            ('precedente (una nota)', lambda: [extract_importo_precedente(n) for n in note]),
+            ('extract_importo (una nota)', lambda: [ingestione.extract_importo(n) for n in note]),
+            (f'extract_importi (blocchi {args.blocco})', lambda: [ingestione.extract_importi(b) for b in blocchi])):
+        durata = misura(funzione, args.ripetizioni)
+        print(f"{nome:<32} {durata:8.3f} {len(note) / durata:12.0f}")
+    return 1 if inattese else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Benchmark delle query più frequenti su Storico_Modifiche_Fatture prima e dopo gli indici della migrazione 2.
+
+Genera un database SQLite sintetico (più aziende, più modifiche per documento), misura le query
+senza indici, applica le migrazioni (migrations.applica_migrazioni) e ripete le misure.
+Le query sono quelle reali: /api/records della dashboard (tramite il client di test di Flask),
+RiepilogoStore.ultime (aggiornamento del riepilogo in main.py), RiepilogoStore.ricostruisci,
+il controllo di esistenza sulla chiave naturale usato dall'inserimento in blocco e DISTINCT azienda.
+
+Uso:
+    python benchmarks/bench_indici.py [--righe 200000] [--ripetizioni 5] [--limite-secondi 30]
+
+Senza indici alcune query (es. la deduplica NOT EXISTS di /api/records) crescono col quadrato delle
+righe: una query che supera --limite-secondi viene interrotta e riportata come tale.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+RADICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, RADICE)
+
+from sqlalchemy import create_engine, event, exists, insert, select  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.schema import CreateTable  # noqa: E402
+
+import migrations  # noqa: E402
+from models import Base, StoricoModificheFatture  # noqa: E402
+
+AZIENDE = ['AU', 'CV', 'MO', 'VE']
+UTENTI = ['mario', 'luca', 'giulia', 'sara', 'paolo']
+
+
+def genera_storico(engine, righe, seed=42):
+    """Crea Storico_Modifiche_Fatture senza indici e la riempie con righe sintetiche (1-5 modifiche per documento)."""
+    casuale = random.Random(seed)
+    tabella = StoricoModificheFatture.__table__
+    inizio = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(CreateTable(tabella))
+        blocco, id_documento, scritte = [], 0, 0
+        while scritte < righe:
+            id_documento += 1
+            azienda = AZIENDE[id_documento % len(AZIENDE)]
+            data_trasmissione = inizio + timedelta(days=casuale.randint(30, 700))
+            importo_fattura = round(casuale.uniform(50, 3000), 2)
+            for n in range(min(casuale.randint(1, 5), righe - scritte)):
+                blocco.append(dict(
+                    id_documento=id_documento, anno=data_trasmissione.year, id_cliente=casuale.randint(1, 5000),
+                    tipo_doc='OC', num_doc=str(id_documento), tipo_fattura='FT', numero_fattura=str(id_documento),
+                    tipo_pagamento='205', id_hst=id_documento * 10 + n, nome_tabella='tdo_cli',
+                    utente=casuale.choice(UTENTI), tipo_operazione='U', note='Totale ivato da 100,00 a 200,00',
+                    data_modifica=data_trasmissione - timedelta(days=casuale.randint(1, 29), minutes=n),
+                    azienda=azienda, importo_modifica=round(importo_fattura - casuale.uniform(-5, 200), 2),
+                    importo_fattura=importo_fattura, id_reg_pd=id_documento * 10,
+                    data_trasmissione_fattura=data_trasmissione, targa=f'AB{id_documento % 1000:03d}CD',
+                ))
+                scritte += 1
+            if len(blocco) >= 10000:
+                conn.execute(insert(tabella), blocco)
+                blocco.clear()
+        if blocco:
+            conn.execute(insert(tabella), blocco)
+    return id_documento
+
+
+_scadenza = [float('inf')]
+
+
+@event.listens_for(Engine, 'connect')
+def _interrompi_oltre_scadenza(dbapi_connection, _):
+    # Vale per tutte le connessioni SQLite, anche quelle dell'engine di app.py
+    dbapi_connection.set_progress_handler(lambda: int(time.perf_counter() > _scadenza[0]), 10000)
+
+
+def misura(funzione, ripetizioni, limite_secondi):
+    """Tempo medio in ms, oppure None se una esecuzione supera limite_secondi."""
+    try:
+        _scadenza[0] = time.perf_counter() + limite_secondi
+        funzione()  # riscaldamento (cache delle pagine SQLite)
+        inizio = time.perf_counter()
+        _scadenza[0] = inizio + limite_secondi * ripetizioni
+        for _ in range(ripetizioni):
+            funzione()
+        return (time.perf_counter() - inizio) / ripetizioni * 1000
+    except OperationalError:
+        return None
+    finally:
+        _scadenza[0] = float('inf')
+
+
+def query_da_misurare(engine, client, ultimo_id_documento):
+    from riepilogo import RiepilogoStore
+    from sqlalchemy.orm import sessionmaker
+
+    tabella = StoricoModificheFatture.__table__
+    riepilogo_store = RiepilogoStore(sessionmaker(bind=engine))
+    casuale = random.Random(7)
+    id_blocco = casuale.sample(range(1, ultimo_id_documento + 1), min(500, ultimo_id_documento))
+
+    with engine.connect() as conn:
+        # Chiavi naturali di 500 righe esistenti, come un blocco già inserito che viene riletto dopo una ripresa
+        chiavi = conn.execute(
+            select(tabella.c.azienda, tabella.c.id_documento, tabella.c.data_modifica, tabella.c.id_reg_pd)
+            .where(tabella.c.id_documento.in_(id_blocco[:500]))
+        ).all()[:500]
+        centro = conn.execute(
+            select(tabella.c.data_modifica, tabella.c.id).order_by(tabella.c.data_modifica.desc(), tabella.c.id.desc())
+            .offset(ultimo_id_documento // 2).limit(1)
+        ).one()
+    cursore_centro = f'{centro.data_modifica.isoformat(sep=" ")}|{centro.id}'
+
+    def esistenza_chiavi():
+        with engine.connect() as conn:
+            for azienda, id_documento, data_modifica, id_reg_pd in chiavi:
+                conn.execute(select(exists().where(
+                    tabella.c.azienda == azienda, tabella.c.id_documento == id_documento,
+                    tabella.c.data_modifica == data_modifica, tabella.c.id_reg_pd == id_reg_pd,
+                ))).scalar()
+
+    def ultime_riepilogo():
+        with engine.connect() as conn:
+            for azienda in AZIENDE:
+                RiepilogoStore.ultime(conn, azienda, id_blocco)
+
+    def pagina(**parametri):
+        def esegui():
+            client.get('/api/records', query_string=parametri)
+        return esegui
+
+    def distinct_aziende():
+        with engine.connect() as conn:
+            conn.execute(select(tabella.c.azienda).distinct().order_by(tabella.c.azienda)).all()
+
+    return [
+        ('Esistenza chiave naturale (500 righe)', esistenza_chiavi),
+        ('RiepilogoStore.ultime (500 documenti)', ultime_riepilogo),
+        ('/api/records prima pagina', pagina()),
+        ('/api/records prima pagina azienda', pagina(azienda='CV')),
+        ('/api/records pagina a metà tabella', pagina(dopo=cursore_centro)),
+        ('DISTINCT azienda', distinct_aziende),
+        ('RiepilogoStore.ricostruisci', riepilogo_store.ricostruisci),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark indici Storico_Modifiche_Fatture')
+    parser.add_argument('--righe', type=int, default=200000)
+    parser.add_argument('--ripetizioni', type=int, default=5)
+    parser.add_argument('--limite-secondi', type=float, default=30.0, help='tempo massimo per singola query')
+    args = parser.parse_args()
+
+    cartella = tempfile.mkdtemp(prefix='bench_indici_')
+    percorso_db = os.path.join(cartella, 'storico.db')
+    url = f'sqlite:///{percorso_db}'
+    # app.py legge config.ini dalla cartella corrente: ne usa uno che punta al database sintetico
+    with open(os.path.join(cartella, 'config.ini'), 'w') as f:
+        f.write(f'[SQLSERVER]\nurl = {url}\n')
+    os.chdir(cartella)
+
+    engine = create_engine(url)
+    inizio = time.perf_counter()
+    ultimo_id_documento = genera_storico(engine, args.righe)
+    print(f"Database sintetico: {args.righe} righe, {ultimo_id_documento} documenti "
+          f"({time.perf_counter() - inizio:.1f} s) in {percorso_db}")
+
+    # app.py non applica le migrazioni: si misura prima senza indici, poi le migrazioni vengono applicate esplicitamente
+    import app  # noqa: E402
+    app.app.testing = True  # le eccezioni (query interrotte) arrivano al benchmark invece di diventare un 500
+    with app.engine.begin() as conn:
+        for tabella in ('Riepilogo_Modifiche_Fatture', 'Checkpoint_Ingestione', 'Storico_Esecuzioni'):
+            Base.metadata.tables[tabella].create(conn, checkfirst=True)
+    client = app.app.test_client()
+    query = query_da_misurare(engine, client, ultimo_id_documento)
+
+    prima = {nome: misura(funzione, args.ripetizioni, args.limite_secondi) for nome, funzione in query}
+    with open(os.devnull, 'w') as silenzio:
+        stdout, sys.stdout = sys.stdout, silenzio
+        try:
+            inizio = time.perf_counter()
+            migrations.applica_migrazioni(engine)
+            durata_migrazione = time.perf_counter() - inizio
+        finally:
+            sys.stdout = stdout
+    print(f"Migrazioni applicate in {durata_migrazione:.1f} s\n")
+    dopo = {nome: misura(funzione, args.ripetizioni, args.limite_secondi) for nome, funzione in query}
+
+    def formato(ms):
+        return f"{ms:>11.2f} ms" if ms is not None else f"{'> ' + format(args.limite_secondi, 'g') + ' s':>14}"
+
+    print(f"{'Query':<42} {'senza indici':>14} {'con indici':>14} {'rapporto':>9}")
+    for nome, _ in query:
+        if prima[nome] is not None and dopo[nome]:
+            rapporto = f"{prima[nome] / dopo[nome]:>8.1f}x"
+        elif dopo[nome]:
+            rapporto = f"{'> ' + format(args.limite_secondi * 1000 / dopo[nome], '.0f') + 'x':>9}"
+        else:
+            rapporto = f"{'-':>9}"
+        print(f"{nome:<42} {formato(prima[nome])} {formato(dopo[nome])} {rapporto}")
+
+
+if __name__ == '__main__':
+    main()
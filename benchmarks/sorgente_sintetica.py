@@ -0,0 +1,248 @@
+"""
+Sorgenti Infinity sintetiche in SQLite per i benchmark.
+
+genera_sorgente() crea un database SQLite con le tabelle lette dalle query di main.py
+(hst_doc, tdo_cli, mdm_cli_veicoli, off_veicoli, reg_pd_fattura_xml, reg_pd_fattura_pa)
+e connetti() apre una connessione compatibile con quella di pyodbc usata da main.py
+(cursor.execute(query, *parametri), fetchmany, iterazione sul cursore, rollback) con il
+database collegato come schema 'dba', così le query .sql vengono eseguite senza modifiche.
+
+Il DSN della stringa ODBC è il percorso del file SQLite: in config.ini
+    dsn = AU^/percorso/sorgente_au.db^utente^password
+"""
+import base64
+import os
+import random
+import sqlite3
+from datetime import date, datetime, timedelta
+
+NAMESPACE = 'http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2'
+UTENTI = ['mario', 'luca', 'giulia', 'sara', 'paolo', 'anna']
+LAVORAZIONI = ['Manodopera meccanica', 'Tagliando', 'Sostituzione pastiglie freno', 'Olio motore 5W30',
+               'Filtro aria', 'Filtro abitacolo', 'Diagnosi elettronica', 'Convergenza']
+
+TABELLE = '''
+CREATE TABLE hst_doc (id_hst INTEGER PRIMARY KEY, id_documento INTEGER, nome_tabella TEXT, utente TEXT,
+                      tipo_operazione TEXT, note TEXT, data_operazione TIMESTAMP, gestione TEXT, tipo_doc TEXT);
+CREATE TABLE tdo_cli (id_documento INTEGER PRIMARY KEY, anno INTEGER, id_cliente INTEGER, tipo_doc TEXT,
+                      data_doc DATE, num_doc TEXT, td_fatt TEXT, data_fatt DATE, num_fatt TEXT,
+                      cond_pag TEXT, id_reg_pd INTEGER);
+CREATE TABLE mdm_cli_veicoli (anno INTEGER, id_cliente INTEGER, data_doc DATE, tipo_doc TEXT,
+                              numero_doc TEXT, id_veicolo INTEGER);
+CREATE TABLE off_veicoli (id_veicolo INTEGER PRIMARY KEY, targa TEXT);
+CREATE TABLE reg_pd_fattura_xml (id_reg_pd INTEGER PRIMARY KEY, fine_trasmissione TIMESTAMP);
+CREATE TABLE reg_pd_fattura_pa (id_reg_pd INTEGER PRIMARY KEY, nome_file TEXT, file_xml_vendita BLOB);
+'''
+
+# Conversioni esplicite delle date (gli adattatori predefiniti di sqlite3 sono deprecati da Python 3.12)
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda valore: valore.isoformat(sep=' '))
+sqlite3.register_converter('DATE', lambda valore: date.fromisoformat(valore.decode()))
+sqlite3.register_converter('TIMESTAMP', lambda valore: datetime.fromisoformat(valore.decode()))
+
+# Indici equivalenti a quelli delle tabelle Infinity usati dalle join delle query
+INDICI = '''
+CREATE INDEX ix_hst_doc ON hst_doc (nome_tabella, id_documento, data_operazione);
+CREATE INDEX ix_mdm_cli_veicoli ON mdm_cli_veicoli (anno, id_cliente, data_doc, tipo_doc, numero_doc);
+'''
+
+
+def _importo(valore):
+    return f'{valore:.2f}'
+
+
+def _importo_it(valore):
+    return f'{valore:,.2f}'.replace(',', '_').replace('.', ',').replace('_', '.')
+
+
+def genera_fattura_pa(casuale, numero, data, righe=20, allegato_kb=0, namespace_default=False):
+    """
+    FatturaPA (bytes, UTF-8) con header completo, righe di dettaglio con circa una riga
+    'Spesa Materiale consumo' ogni 8, riepilogo IVA, pagamento e allegato opzionale.
+    Ritorna (xml, importo atteso da extract_importo_from_xml).
+    """
+    linee, imponibile, materiale = [], 0.0, 0.0
+    for n in range(1, righe + 1):
+        quantita = casuale.choice([1, 1, 1, 2, 4])
+        prezzo = round(casuale.uniform(5, 250), 2)
+        totale = round(quantita * prezzo, 2)
+        descrizione = 'Spesa Materiale consumo' if n % 8 == 0 else casuale.choice(LAVORAZIONI)
+        if descrizione == 'Spesa Materiale consumo':
+            materiale += totale
+        imponibile += totale
+        linee.append(
+            f'<DettaglioLinee><NumeroLinea>{n}</NumeroLinea><Descrizione>{descrizione}</Descrizione>'
+            f'<Quantita>{quantita}.00</Quantita><UnitaMisura>PZ</UnitaMisura>'
+            f'<PrezzoUnitario>{_importo(prezzo)}</PrezzoUnitario><PrezzoTotale>{_importo(totale)}</PrezzoTotale>'
+            '<AliquotaIVA>22.00</AliquotaIVA></DettaglioLinee>'
+        )
+    imposta = round(imponibile * 0.22, 2)
+    totale_documento = round(imponibile + imposta, 2)
+    prefisso = '' if namespace_default else 'p:'
+    dichiarazione = f'xmlns="{NAMESPACE}"' if namespace_default else f'xmlns:p="{NAMESPACE}"'
+    allegato = ''
+    if allegato_kb:
+        contenuto = base64.b64encode(casuale.randbytes(allegato_kb * 768)).decode('ascii')
+        allegato = (f'<Allegati><NomeAttachment>FT_{numero}.pdf</NomeAttachment><FormatoAttachment>PDF'
+                    f'</FormatoAttachment><Attachment>{contenuto}</Attachment></Allegati>')
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<{prefisso}FatturaElettronica versione="FPR12" {dichiarazione} '
+        'xmlns:ds="http://www.w3.org/2000/09/xmldsig#">'
+        '<FatturaElettronicaHeader>'
+        '<DatiTrasmissione><IdTrasmittente><IdPaese>IT</IdPaese><IdCodice>01234567890</IdCodice></IdTrasmittente>'
+        f'<ProgressivoInvio>{numero:05d}</ProgressivoInvio><FormatoTrasmissione>FPR12</FormatoTrasmissione>'
+        '<CodiceDestinatario>0000000</CodiceDestinatario></DatiTrasmissione>'
+        '<CedentePrestatore><DatiAnagrafici><IdFiscaleIVA><IdPaese>IT</IdPaese><IdCodice>01234567890</IdCodice>'
+        '</IdFiscaleIVA><Anagrafica><Denominazione>Officina Sintetica S.r.l.</Denominazione></Anagrafica>'
+        '<RegimeFiscale>RF01</RegimeFiscale></DatiAnagrafici><Sede><Indirizzo>Via Roma 1</Indirizzo>'
+        '<CAP>00100</CAP><Comune>Roma</Comune><Provincia>RM</Provincia><Nazione>IT</Nazione></Sede>'
+        '</CedentePrestatore>'
+        f'<CessionarioCommittente><DatiAnagrafici><CodiceFiscale>RSSMRA80A01H501{numero % 10}</CodiceFiscale>'
+        '<Anagrafica><Nome>Mario</Nome><Cognome>Rossi</Cognome></Anagrafica></DatiAnagrafici>'
+        '<Sede><Indirizzo>Via Milano 2</Indirizzo><CAP>20100</CAP><Comune>Milano</Comune><Provincia>MI</Provincia>'
+        '<Nazione>IT</Nazione></Sede></CessionarioCommittente>'
+        '</FatturaElettronicaHeader>'
+        '<FatturaElettronicaBody><DatiGenerali><DatiGeneraliDocumento><TipoDocumento>TD01</TipoDocumento>'
+        f'<Divisa>EUR</Divisa><Data>{data:%Y-%m-%d}</Data><Numero>{numero}</Numero>'
+        f'<ImportoTotaleDocumento>{_importo(totale_documento)}</ImportoTotaleDocumento>'
+        '</DatiGeneraliDocumento></DatiGenerali>'
+        f'<DatiBeniServizi>{"".join(linee)}'
+        f'<DatiRiepilogo><AliquotaIVA>22.00</AliquotaIVA><ImponibileImporto>{_importo(imponibile)}</ImponibileImporto>'
+        f'<Imposta>{_importo(imposta)}</Imposta><EsigibilitaIVA>I</EsigibilitaIVA></DatiRiepilogo></DatiBeniServizi>'
+        '<DatiPagamento><CondizioniPagamento>TP02</CondizioniPagamento><DettaglioPagamento>'
+        f'<ModalitaPagamento>MP01</ModalitaPagamento><ImportoPagamento>{_importo(totale_documento)}</ImportoPagamento>'
+        f'</DettaglioPagamento></DatiPagamento>{allegato}</FatturaElettronicaBody>'
+        f'</{prefisso}FatturaElettronica>'
+    )
+    return xml.encode('utf-8'), round(totale_documento - materiale * 1.22, 2)
+
+
+def genera_sorgente(percorso, documenti=2000, modifiche_per_documento=3, righe_fattura=20, allegato_kb=0,
+                    anno_minimo=2024, seed=1):
+    """
+    Crea (sovrascrivendolo) il database sintetico di un'azienda e ritorna il numero di righe per tabella.
+
+    Ogni commessa (tdo_cli) ha da 1 a 2*modifiche_per_documento-1 righe di log (in media
+    modifiche_per_documento); le proporzioni dei casi scartati da main.py (pagamento non in contanti,
+    commessa non fatturata o non trasmessa, modifica dopo la trasmissione, note senza importo,
+    anno precedente al minimo) sono fisse, così i risultati sono confrontabili tra esecuzioni.
+    """
+    casuale = random.Random(seed)
+    if os.path.exists(percorso):
+        os.remove(percorso)
+    conn = sqlite3.connect(percorso)
+    conn.executescript(TABELLE)
+    conteggi = dict.fromkeys(['hst_doc', 'tdo_cli', 'reg_pd_fattura_xml', 'reg_pd_fattura_pa'], 0)
+    id_hst = 0
+    blocchi = {tabella: [] for tabella in ('hst_doc', 'tdo_cli', 'mdm_cli_veicoli', 'off_veicoli',
+                                           'reg_pd_fattura_xml', 'reg_pd_fattura_pa')}
+
+    def scrivi():
+        for tabella, righe in blocchi.items():
+            if righe:
+                conn.executemany(f'INSERT INTO {tabella} VALUES ({", ".join("?" * len(righe[0]))})', righe)
+                righe.clear()
+
+    for id_documento in range(1, documenti + 1):
+        anno = anno_minimo - 1 if casuale.random() < 0.05 else casuale.randint(anno_minimo, anno_minimo + 1)
+        data_doc = datetime(anno, 1, 1) + timedelta(days=casuale.randint(0, 330))
+        id_cliente = casuale.randint(1, max(1, documenti // 4))
+        id_reg_pd = 0 if casuale.random() < 0.05 else id_documento * 10
+        cond_pag = '205' if casuale.random() < 0.85 else '100'
+        data_fattura = data_doc + timedelta(days=casuale.randint(5, 30))
+        blocchi['tdo_cli'].append((id_documento, anno, id_cliente, 'OC', data_doc.date(), str(id_documento), 'FT',
+                                   data_fattura.date(), f'{id_documento}/FT', cond_pag, id_reg_pd))
+        blocchi['mdm_cli_veicoli'].append((anno, id_cliente, data_doc.date(), 'OC', str(id_documento), id_documento))
+        blocchi['off_veicoli'].append((id_documento, f'{chr(65 + id_documento % 26)}{chr(65 + id_documento // 26 % 26)}'
+                                                     f'{id_documento % 1000:03d}{chr(65 + id_documento // 676 % 26)}X'))
+        conteggi['tdo_cli'] += 1
+
+        importo = round(casuale.uniform(80, 2500), 2)
+        data_operazione = data_doc
+        for _ in range(casuale.randint(1, max(1, 2 * modifiche_per_documento - 1))):
+            id_hst += 1
+            data_operazione += timedelta(days=casuale.randint(0, 3), minutes=casuale.randint(1, 600))
+            nuovo = round(importo * casuale.uniform(0.8, 1.2), 2)
+            if casuale.random() < 0.05:
+                note = 'Modificata descrizione commessa'
+            else:
+                note = f'Totale ivato da {_importo_it(importo)} a {_importo_it(nuovo)}'
+            blocchi['hst_doc'].append((id_hst, id_documento, 'tdo_cli', casuale.choice(UTENTI), 'U', note,
+                                       data_operazione, 'O', 'OC'))
+            importo = nuovo
+            conteggi['hst_doc'] += 1
+
+        if id_reg_pd and casuale.random() < 0.9:
+            # La trasmissione avviene di solito dopo l'ultima modifica, a volte prima (modifiche scartate)
+            fine_trasmissione = data_operazione + timedelta(days=casuale.randint(-2, 10), hours=1)
+            xml, _ = genera_fattura_pa(casuale, id_documento, fine_trasmissione, righe_fattura, allegato_kb,
+                                       namespace_default=id_documento % 3 == 0)
+            blocchi['reg_pd_fattura_xml'].append((id_reg_pd, fine_trasmissione))
+            blocchi['reg_pd_fattura_pa'].append((id_reg_pd, f'IT01234567890_{id_documento:05d}.xml', xml))
+            conteggi['reg_pd_fattura_xml'] += 1
+            conteggi['reg_pd_fattura_pa'] += 1
+        if id_documento % 1000 == 0:
+            scrivi()
+    scrivi()
+    conn.executescript(INDICI)
+    conn.commit()
+    conn.close()
+    return conteggi
+
+
+class _Cursore:
+    # Adatta sqlite3.Cursor alla firma di pyodbc: execute(query, *parametri) restituisce il cursore
+    def __init__(self, cursore):
+        self._cursore = cursore
+
+    def execute(self, query, *parametri):
+        self._cursore.execute(query, parametri)
+        return self
+
+    @property
+    def description(self):
+        return self._cursore.description
+
+    def fetchone(self):
+        return self._cursore.fetchone()
+
+    def fetchmany(self, dimensione):
+        return self._cursore.fetchmany(dimensione)
+
+    def fetchall(self):
+        return self._cursore.fetchall()
+
+    def close(self):
+        self._cursore.close()
+
+    def __iter__(self):
+        return iter(self._cursore)
+
+
+class _Connessione:
+    def __init__(self, percorso):
+        # Le date arrivano come datetime/date (come da pyodbc); ogni pool usa la connessione da un thread alla volta
+        self._conn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self._conn.execute('ATTACH DATABASE ? AS dba', (percorso,))
+
+    def cursor(self):
+        return _Cursore(self._conn.cursor())
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def connetti(odbc_conn_str):
+    """Sostituto di pyodbc.connect per main.connetti_sorgente: 'DSN=<percorso sqlite>;UID=...;PWD=...'."""
+    parti = dict(parte.split('=', 1) for parte in odbc_conn_str.split(';') if '=' in parte)
+    percorso = parti.get('DSN', '')
+    if not os.path.exists(percorso):
+        raise sqlite3.OperationalError(f'Sorgente sintetica non trovata: {percorso}')
+    return _Connessione(percorso)
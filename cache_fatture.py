@@ -0,0 +1,132 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class CacheFatture:
+    """
+    Cache persistente (SQLite locale) degli importi calcolati dai file XML delle fatture.
+
+    Una fattura trasmessa praticamente non cambia più: se (azienda, id_reg_pd) ha ancora la stessa
+    fine_trasmissione e lo stesso nome_file, l'importo salvato viene riusato senza scaricare
+    né analizzare di nuovo il file_xml_vendita. Per i file scaricati viene salvato anche l'hash
+    SHA-256 del contenuto: un XML già visto (es. ritrasmissione identica) non viene rianalizzato.
+
+    Le voci non usate da più di max_giorni vengono eliminate, e oltre max_voci vengono eliminate
+    quelle usate meno di recente. VERSIONE va incrementata quando cambia il calcolo dell'importo,
+    così le voci calcolate con la logica precedente vengono ignorate.
+    """
+
+    VERSIONE = 1
+
+    def __init__(self, percorso, max_voci=200000, max_giorni=365):
+        self.max_voci = max_voci
+        self.max_giorni = max_giorni
+        self._lock = threading.Lock()  # la stessa connessione è usata dai worker delle varie aziende
+        self._conn = sqlite3.connect(percorso, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS fatture (
+                azienda TEXT NOT NULL,
+                id_reg_pd INTEGER NOT NULL,
+                fine_trasmissione TEXT,
+                nome_file TEXT,
+                hash_xml TEXT NOT NULL,
+                importo REAL,
+                versione INTEGER NOT NULL,
+                ultimo_accesso REAL NOT NULL,
+                PRIMARY KEY (azienda, id_reg_pd)
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_fatture_hash ON fatture (hash_xml)')
+        self._conn.commit()
+        self.pulisci()
+
+    @classmethod
+    def da_config(cls, config):
+        """Crea la cache dalla sezione [CACHE_FATTURE]; ritorna None se disabilitata (abilitata = false)."""
+        if not config.getboolean('CACHE_FATTURE', 'abilitata', fallback=True):
+            return None
+        return cls(
+            config.get('CACHE_FATTURE', 'percorso', fallback='cache_fatture.sqlite'),
+            max_voci=config.getint('CACHE_FATTURE', 'max_voci', fallback=200000),
+            max_giorni=config.getint('CACHE_FATTURE', 'max_giorni', fallback=365),
+        )
+
+    @staticmethod
+    def hash_xml(xml_content):
+        if isinstance(xml_content, str):
+            xml_content = xml_content.encode('utf-8')
+        return hashlib.sha256(xml_content or b'').hexdigest()
+
+    def cerca(self, azienda, trasmissioni):
+        """
+        trasmissioni: {id_reg_pd: (fine_trasmissione, nome_file)} letti dalla sorgente.
+        Ritorna {id_reg_pd: importo} per le fatture in cache con la stessa trasmissione.
+        """
+        if not trasmissioni:
+            return {}
+        ids = list(trasmissioni)
+        trovati = {}
+        with self._lock:
+            # Al massimo 500 parametri per query (limite SQLite sulle variabili)
+            for start in range(0, len(ids), 500):
+                blocco = ids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT id_reg_pd, fine_trasmissione, nome_file, importo FROM fatture "
+                    f"WHERE azienda = ? AND versione = ? AND id_reg_pd IN ({', '.join('?' * len(blocco))})",
+                    [azienda, self.VERSIONE, *blocco],
+                )
+                for id_reg_pd, fine_trasmissione, nome_file, importo in rows:
+                    if (fine_trasmissione, nome_file) == (str(trasmissioni[id_reg_pd][0]), trasmissioni[id_reg_pd][1]):
+                        trovati[id_reg_pd] = importo
+            if trovati:
+                adesso = time.time()
+                self._conn.executemany(
+                    "UPDATE fatture SET ultimo_accesso = ? WHERE azienda = ? AND id_reg_pd = ?",
+                    [(adesso, azienda, id_reg_pd) for id_reg_pd in trovati],
+                )
+                self._conn.commit()
+        return trovati
+
+    def cerca_hash(self, hash_xml):
+        """Importo già calcolato per un XML con lo stesso contenuto, oppure (False, None) se sconosciuto."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT importo FROM fatture WHERE hash_xml = ? AND versione = ? LIMIT 1", (hash_xml, self.VERSIONE)
+            ).fetchone()
+        return (True, row[0]) if row else (False, None)
+
+    def salva(self, azienda, voci):
+        """voci: lista di (id_reg_pd, fine_trasmissione, nome_file, hash_xml, importo)."""
+        if not voci:
+            return
+        adesso = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fatture "
+                "(azienda, id_reg_pd, fine_trasmissione, nome_file, hash_xml, importo, versione, ultimo_accesso) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(azienda, id_reg_pd, str(fine_trasmissione), nome_file, hash_xml, importo, self.VERSIONE, adesso)
+                 for id_reg_pd, fine_trasmissione, nome_file, hash_xml, importo in voci],
+            )
+            self._conn.commit()
+
+    def pulisci(self):
+        """Elimina le voci scadute (max_giorni) e quelle usate meno di recente oltre max_voci."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM fatture WHERE ultimo_accesso < ? OR versione <> ?",
+                (time.time() - self.max_giorni * 86400, self.VERSIONE),
+            )
+            self._conn.execute(
+                "DELETE FROM fatture WHERE rowid IN ("
+                "SELECT rowid FROM fatture ORDER BY ultimo_accesso DESC LIMIT -1 OFFSET ?)",
+                (self.max_voci,),
+            )
+            self._conn.commit()
+
+    def chiudi(self):
+        self.pulisci()
+        with self._lock:
+            self._conn.close()
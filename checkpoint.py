@@ -0,0 +1,129 @@
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, exists, insert, select, update
+
+from models import CheckpointIngestione, LeaseIngestione, StoricoEsecuzioni
+
+
+def ultimo_aggiornamento(avvio, dettaglio):
+    """Istante dell'ultimo avanzamento salvato in dettaglio (aggiornato_il), oppure l'avvio dell'esecuzione."""
+    try:
+        aggiornato_il = json.loads(dettaglio).get('aggiornato_il')
+        return datetime.fromisoformat(aggiornato_il) if aggiornato_il else avvio
+    except (TypeError, ValueError, AttributeError):
+        return avvio
+
+
+class CheckpointStore:
+    """
+    Checkpoint dell'ingestione salvato nel database di destinazione.
+
+    - Checkpoint_Ingestione: un watermark per azienda (ultimo id_documento elaborato completamente).
+      Viene avanzato con avanza() nella stessa transazione dell'inserimento in blocco,
+      quindi dati e checkpoint non possono divergere dopo un crash.
+    - Storico_Esecuzioni: una riga per ogni esecuzione di main.py (avvio, fine, stato, totali).
+      Mentre l'esecuzione è in corso, dettaglio contiene l'avanzamento per azienda (salva_avanzamento),
+      letto dalla dashboard tramite /jobs/<id>.
+
+    Le righe di Checkpoint_Ingestione esistono solo mentre un'esecuzione è in corso o dopo
+    un'esecuzione interrotta: a elaborazione completata vengono rimosse, come il vecchio checkpoint.json.
+    Funziona con qualsiasi engine SQLAlchemy (SQL Server in produzione, SQLite per i test).
+    """
+
+    def __init__(self, session_factory, timeout_minuti=30):
+        self.Session = session_factory
+        self.timeout = timedelta(minutes=timeout_minuti)
+
+    @classmethod
+    def da_config(cls, config, session_factory):
+        """Crea lo store con il timeout delle esecuzioni della sezione [JOBS] (timeout_minuti, come JobRunner)."""
+        return cls(session_factory, timeout_minuti=config.getint('JOBS', 'timeout_minuti', fallback=30))
+
+    def carica(self):
+        """Ritorna il dizionario {azienda: last_id_documento} lasciato da un'esecuzione interrotta."""
+        with self.Session() as session:
+            rows = session.execute(select(CheckpointIngestione.azienda, CheckpointIngestione.last_id_documento))
+            return {azienda: last_id for azienda, last_id in rows}
+
+    def accoda_esecuzione(self):
+        """Registra un'esecuzione 'in_coda' (avviata dalla dashboard, main.py non ancora partito) e ne ritorna l'id."""
+        with self.Session() as session, session.begin():
+            esecuzione = StoricoEsecuzioni(avvio=datetime.now(), stato='in_coda')
+            session.add(esecuzione)
+            session.flush()
+            return esecuzione.id
+
+    def avvia_esecuzione(self, id_esecuzione=None):
+        """
+        Registra una nuova esecuzione (o avvia quella già accodata con accoda_esecuzione) e ne ritorna l'id.
+        Le esecuzioni rimaste 'in_corso' (processo terminato senza chiuderle) vengono marcate come 'interrotta'
+        se non hanno salvato avanzamenti negli ultimi timeout_minuti (stessa regola di JobRunner.attiva),
+        tranne quelle a shard con shard non ancora completati in Lease_Ingestione (altri worker possono riprenderli).
+        """
+        limite = datetime.now() - self.timeout
+        shard_aperto = exists().where(
+            LeaseIngestione.id_esecuzione == StoricoEsecuzioni.id, LeaseIngestione.stato != 'completato',
+        )
+        with self.Session() as session, session.begin():
+            rows = session.execute(
+                select(StoricoEsecuzioni.id, StoricoEsecuzioni.avvio, StoricoEsecuzioni.dettaglio)
+                .where(StoricoEsecuzioni.stato == 'in_corso', StoricoEsecuzioni.id != (id_esecuzione or 0),
+                       ~shard_aperto)
+            ).all()
+            interrotte = [id_riga for id_riga, avvio, dettaglio in rows
+                          if ultimo_aggiornamento(avvio, dettaglio) < limite]
+            if interrotte:
+                session.execute(
+                    update(StoricoEsecuzioni)
+                    .where(StoricoEsecuzioni.id.in_(interrotte), StoricoEsecuzioni.stato == 'in_corso')
+                    .values(stato='interrotta')
+                )
+            if id_esecuzione:
+                result = session.execute(
+                    update(StoricoEsecuzioni)
+                    .where(StoricoEsecuzioni.id == id_esecuzione)
+                    .values(avvio=datetime.now(), stato='in_corso')
+                )
+                if result.rowcount == 0:
+                    raise ValueError(f"Esecuzione {id_esecuzione} non trovata in Storico_Esecuzioni")
+                return id_esecuzione
+            esecuzione = StoricoEsecuzioni(avvio=datetime.now(), stato='in_corso')
+            session.add(esecuzione)
+            session.flush()
+            return esecuzione.id
+
+    def salva_avanzamento(self, id_esecuzione, avanzamento):
+        """Salva l'avanzamento (dizionario -> json) in dettaglio finché l'esecuzione è in corso."""
+        with self.Session() as session, session.begin():
+            session.execute(
+                update(StoricoEsecuzioni)
+                .where(StoricoEsecuzioni.id == id_esecuzione, StoricoEsecuzioni.stato == 'in_corso')
+                .values(dettaglio=json.dumps(avanzamento))
+            )
+
+    @staticmethod
+    def avanza(conn, id_esecuzione, azienda, last_id_documento):
+        """
+        Aggiorna il watermark dell'azienda usando la connessione (e quindi la transazione) del chiamante.
+        """
+        valori = dict(id_esecuzione=id_esecuzione, last_id_documento=last_id_documento, aggiornato_il=datetime.now())
+        tabella = CheckpointIngestione.__table__
+        result = conn.execute(update(tabella).where(tabella.c.azienda == azienda).values(**valori))
+        if result.rowcount == 0:
+            conn.execute(insert(tabella).values(azienda=azienda, **valori))
+
+    def chiudi_esecuzione(self, id_esecuzione, stato, record_inseriti, dettaglio):
+        """
+        Chiude l'esecuzione con lo stato finale. Se completata rimuove i watermark,
+        così l'esecuzione successiva riparte da zero (la deduplica evita i doppioni).
+        """
+        with self.Session() as session, session.begin():
+            session.execute(
+                update(StoricoEsecuzioni)
+                .where(StoricoEsecuzioni.id == id_esecuzione)
+                .values(fine=datetime.now(), stato=stato, record_inseriti=record_inseriti,
+                        dettaglio=json.dumps(dettaglio))
+            )
+            if stato == 'completata':
+                session.execute(delete(CheckpointIngestione))
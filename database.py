@@ -0,0 +1,18 @@
+from sqlalchemy import create_engine
+
+
+def get_engine(config):
+    """
+    Crea l'engine SQLAlchemy verso il database di destinazione dalla sezione [SQLSERVER].
+    Se è presente la chiave 'url' viene usata così com'è (es. sqlite:///locale.db per i test),
+    altrimenti la stringa di connessione SQL Server viene costruita da server/database/username/password.
+    """
+    sqlserver_conf = config['SQLSERVER']
+    sqlserver_conn_str = sqlserver_conf.get('url') or (
+        f"mssql+pyodbc://{sqlserver_conf['username']}:{sqlserver_conf['password']}@"
+        f"{sqlserver_conf['server']}/{sqlserver_conf['database']}?driver=ODBC+Driver+17+for+SQL+Server"
+    )
+    if sqlserver_conn_str.startswith('mssql+pyodbc'):
+        # executemany in un solo round-trip per gli inserimenti in blocco
+        return create_engine(sqlserver_conn_str, fast_executemany=True)
+    return create_engine(sqlserver_conn_str)
@@ -1,31 +1,51 @@
-
-import pandas as pd
-from sqlalchemy import create_engine
 import configparser
 import csv
+from sqlalchemy import MetaData, Table, select
+import database
+from models import StoricoModificheFatture
+
+# Righe lette dal cursore (e scritte nel CSV) per ogni blocco
+CHUNK_RIGHE = 5000
 
 # Carica la configurazione
 def get_engine():
     config = configparser.ConfigParser()
     config.read('config.ini')
-    sqlserver_conf = config['SQLSERVER']
-    sqlserver_conn_str = (
-        f"mssql+pyodbc://{sqlserver_conf['username']}:{sqlserver_conf['password']}@"
-        f"{sqlserver_conf['server']}/{sqlserver_conf['database']}?driver=ODBC+Driver+17+for+SQL+Server"
-    )
-    return create_engine(sqlserver_conn_str)
+    return database.get_engine(config)
+
+
+class _Eco:
+    # File fittizio: csv.writer.writerow restituisce direttamente la riga formattata
+    def write(self, valore):
+        return valore
+
+
+def righe_csv(engine, query, intestazione, formatta=None, chunk=CHUNK_RIGHE, **formato):
+    """
+    Generatore di testo CSV (separatore ';') per query: prima l'intestazione, poi un blocco
+    di righe alla volta letto dal cursore in streaming (stream_results/yield_per), quindi
+    in memoria resta al massimo un blocco qualunque sia la dimensione della tabella.
+    formatta, se indicata, trasforma ogni riga del risultato nella lista dei valori da scrivere.
+    """
+    writer = csv.writer(_Eco(), delimiter=';', lineterminator='\n', **formato)
+    yield writer.writerow(intestazione)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk).execute(query)
+        for blocco in result.partitions():
+            yield ''.join(writer.writerow(formatta(riga) if formatta else riga) for riga in blocco)
+
 
 def export_table_to_csv():
     engine = get_engine()
-    query = "SELECT * FROM Storico_Modifiche_Fatture"
-    df = pd.read_sql(query, engine)
-    df.to_csv(
-        "Storico_Modifiche_Fatture_export.csv",
-        index=False,
-        encoding="utf-8-sig",  # UTF-8 con BOM per Excel
-        sep=";",  # Punto e virgola come separatore
-        quoting=csv.QUOTE_ALL
-    )
+    # Colonne della tabella fisica, come il vecchio SELECT *: anche quelle non mappate in models.py
+    # (es. data_stampa_fattura di Create_Table.sql)
+    tabella = Table(StoricoModificheFatture.__tablename__, MetaData(), autoload_with=engine)
+    with open("Storico_Modifiche_Fatture_export.csv", "w",
+              encoding="utf-8-sig",  # UTF-8 con BOM per Excel
+              newline="") as f:
+        # Punto e virgola come separatore, tutti i campi tra virgolette
+        for testo in righe_csv(engine, select(tabella), [c.name for c in tabella.columns], quoting=csv.QUOTE_ALL):
+            f.write(testo)
     print("Esportazione completata: Storico_Modifiche_Fatture_export.csv")
 
 if __name__ == "__main__":
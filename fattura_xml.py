@@ -0,0 +1,127 @@
+import io
+import logging
+import time
+
+try:
+    # lxml è opzionale: se installato il parsing è più veloce, altrimenti si usa la libreria standard
+    from lxml import etree as ET
+    LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    LXML = False
+
+logger = logging.getLogger(__name__)
+
+DESCRIZIONE_MATERIALE = 'Spesa Materiale consumo'
+
+# Elementi che non servono al calcolo e possono essere scartati appena chiusi
+# (Allegati può contenere PDF in base64 di diversi MB)
+ELEMENTI_DA_SCARTARE = {'FatturaElettronicaHeader', 'DatiRiepilogo', 'Allegati', 'FatturaElettronicaBody'}
+
+
+def _libera(elem):
+    # Svuota l'elemento; con lxml rimuove anche i fratelli precedenti già elaborati dal padre
+    elem.clear()
+    if LXML:
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def _eventi(sorgente):
+    if LXML:
+        # lxml filtra i tag in C: arrivano solo gli eventi degli elementi che interessano.
+        # huge_tree per gli allegati base64 oltre i 10 MB.
+        tag = ['{*}DettaglioLinee', '{*}ImportoTotaleDocumento'] + ['{*}' + nome for nome in ELEMENTI_DA_SCARTARE]
+        return ET.iterparse(sorgente, events=('end',), tag=tag, huge_tree=True)
+    return ET.iterparse(sorgente, events=('end',))
+
+
+def _calcola_importo(sorgente):
+    importo_totale_val = None
+    spesa_materiale = 0.0
+    iva_materiale = 0.0
+    nomi = {}  # cache tag completo -> nome locale
+
+    def nome_locale(tag):
+        nome = nomi.get(tag)
+        if nome is None:
+            # I commenti di lxml hanno come tag una funzione, non una stringa
+            nome = nomi[tag] = tag.rpartition('}')[2] if isinstance(tag, str) else ''
+        return nome
+
+    for _, elem in _eventi(sorgente):
+        nome = nome_locale(elem.tag)
+        if nome == 'DettaglioLinee':
+            # Somma PrezzoTotale (e la relativa IVA) delle righe 'Spesa Materiale consumo'
+            descrizione = prezzo_totale = aliquota_iva = None
+            for figlio in elem:
+                nome_figlio = nome_locale(figlio.tag)
+                if nome_figlio == 'Descrizione':
+                    descrizione = figlio.text
+                elif nome_figlio == 'PrezzoTotale':
+                    prezzo_totale = figlio.text
+                elif nome_figlio == 'AliquotaIVA':
+                    aliquota_iva = figlio.text
+            if descrizione and DESCRIZIONE_MATERIALE in descrizione and prezzo_totale is not None:
+                valore = float(prezzo_totale)
+                spesa_materiale += valore
+                # Calcola l'IVA di questa riga se presente
+                if aliquota_iva is not None:
+                    try:
+                        iva_materiale += valore * float(aliquota_iva) / 100.0
+                    except Exception:
+                        pass
+            _libera(elem)
+        elif nome == 'ImportoTotaleDocumento':
+            # Vale il primo ImportoTotaleDocumento del file
+            if importo_totale_val is None:
+                importo_totale_val = float(elem.text)
+        elif nome in ELEMENTI_DA_SCARTARE:
+            _libera(elem)
+    return importo_totale_val or 0.0, spesa_materiale, iva_materiale
+
+
+def extract_importo_from_xml(xml_content):
+    """
+    Estrae l'importo effettivo della fattura elettronica dal file XML.
+    Logica:
+    - Prende il valore di <ImportoTotaleDocumento> (importo totale della fattura)
+    - Sottrae la somma delle righe <DettaglioLinee> che hanno <Descrizione> contenente 'Spesa Materiale consumo'.
+    - Sottrae anche l'IVA relativa a queste righe (se presente), per replicare il calcolo manuale dell'utente.
+    - Restituisce il risultato arrotondato a due decimali.
+    Il file viene letto in streaming (iterparse) direttamente dai bytes, senza costruire l'albero
+    completo, e i tag vengono confrontati ignorando namespace e prefissi.
+    Parametri:
+        xml_content: stringa XML (o bytes) della fattura elettronica
+    Ritorna:
+        float: importo effettivo (ImportoTotaleDocumento - somma Spesa Materiale consumo - IVA relativa), oppure None se errore
+    """
+    if not xml_content or not isinstance(xml_content, (str, bytes)):
+        return None
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode('utf-8')
+    try:
+        try:
+            importo_totale_val, spesa_materiale, iva_materiale = _calcola_importo(io.BytesIO(xml_content))
+        except ET.ParseError:
+            # Byte non validi per la codifica dichiarata: li scarta e riprova, come la vecchia decodifica errors='ignore'
+            pulito = xml_content.decode('utf-8', errors='ignore').encode('utf-8')
+            importo_totale_val, spesa_materiale, iva_materiale = _calcola_importo(io.BytesIO(pulito))
+        # Calcola l'importo effettivo: totale - spese materiale consumo - iva materiale consumo
+        risultato = round(importo_totale_val - spesa_materiale - iva_materiale, 2)
+        logger.debug("XML: ImportoTotale=%s, SpesaMateriale=%s, IVA_Materiale=%s, Risultato=%s",
+                     importo_totale_val, spesa_materiale, iva_materiale, risultato)
+        return risultato
+    except Exception as e:
+        logger.warning("Errore nel parsing XML: %s", e)
+        return None
+
+
+def extract_importi_from_xml(xml_contents):
+    """
+    extract_importo_from_xml per una lista di XML, usata dalla pipeline di main.py per analizzare
+    un blocco di fatture in un processo separato. Ritorna (importi nello stesso ordine, secondi impiegati).
+    """
+    inizio = time.perf_counter()
+    importi = [extract_importo_from_xml(xml_content) for xml_content in xml_contents]
+    return importi, time.perf_counter() - inizio
@@ -0,0 +1,182 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+from checkpoint import ultimo_aggiornamento
+from models import StoricoEsecuzioni
+
+# Stati di un'esecuzione non ancora terminata
+STATI_ATTIVI = ('in_coda', 'in_corso')
+
+
+class EsecuzioneGiaAttiva(Exception):
+    def __init__(self, id_esecuzione):
+        super().__init__(f"Esecuzione {id_esecuzione} già in corso")
+        self.id_esecuzione = id_esecuzione
+
+
+def _data(valore):
+    return datetime.fromisoformat(valore) if valore else None
+
+
+def avanzamento_azienda(valori, aggiornato_il):
+    """
+    Aggiunge ai valori salvati da main.py per un'azienda velocità (record letti al secondo),
+    percentuale stimata sull'intervallo di id_documento ed ETA in secondi.
+    """
+    risultato = dict(valori)
+    inizio, fine = _data(valori.get('inizio')), _data(valori.get('fine')) or aggiornato_il
+    secondi = (fine - inizio).total_seconds() if inizio and fine else 0
+    letti = valori.get('letti') or 0
+    risultato['record_al_secondo'] = round(letti / secondi, 1) if secondi > 0 else None
+    risultato['percentuale'] = risultato['eta_secondi'] = None
+    if valori.get('stato') == 'completata':
+        risultato['percentuale'], risultato['eta_secondi'] = 100.0, 0
+        return risultato
+    id_iniziale, ultimo, massimo = valori.get('id_iniziale') or 0, valori.get('ultimo_id_documento'), valori.get('id_massimo')
+    if ultimo is not None and massimo and massimo > id_iniziale:
+        frazione = min(1.0, max(0.0, (ultimo - id_iniziale) / (massimo - id_iniziale)))
+        risultato['percentuale'] = round(frazione * 100, 1)
+        if frazione > 0 and secondi > 0:
+            risultato['eta_secondi'] = round(secondi * (1 - frazione) / frazione)
+    return risultato
+
+
+class JobRunner:
+    """
+    Avvia main.py in background dalla dashboard, una sola esecuzione alla volta.
+
+    avvia() registra l'esecuzione in Storico_Esecuzioni ('in_coda'), lancia main.py con
+    --id-esecuzione e ritorna subito; l'output del processo va in cartella_log/esecuzione_<id>.log.
+    main.py salva l'avanzamento nella stessa riga, letta da stato().
+    Un'esecuzione è considerata attiva se il processo lanciato da qui è ancora vivo, oppure se
+    in Storico_Esecuzioni c'è un'esecuzione in_coda/in_corso aggiornata negli ultimi timeout_minuti
+    (es. avviata da riga di comando o da un altro processo della dashboard).
+    """
+
+    def __init__(self, session_factory, checkpoint_store, cartella_log='log_esecuzioni', timeout_minuti=30):
+        self.Session = session_factory
+        self.checkpoint_store = checkpoint_store
+        self.cartella_log = cartella_log
+        self.timeout = timedelta(minutes=timeout_minuti)
+        self._lock = threading.Lock()
+        self._processo = None
+        self._id_processo = None
+
+    @classmethod
+    def da_config(cls, config, session_factory, checkpoint_store):
+        """Crea il runner dalla sezione [JOBS] (cartella_log, timeout_minuti)."""
+        return cls(
+            session_factory,
+            checkpoint_store,
+            cartella_log=config.get('JOBS', 'cartella_log', fallback='log_esecuzioni'),
+            timeout_minuti=config.getint('JOBS', 'timeout_minuti', fallback=30),
+        )
+
+    def _percorso_log(self, id_esecuzione):
+        return os.path.join(self.cartella_log, f'esecuzione_{id_esecuzione}.log')
+
+    def attiva(self):
+        """Id dell'esecuzione attiva, oppure None."""
+        if self._processo is not None and self._processo.poll() is None:
+            return self._id_processo
+        limite = datetime.now() - self.timeout
+        with self.Session() as session:
+            rows = session.execute(
+                select(StoricoEsecuzioni.id, StoricoEsecuzioni.avvio, StoricoEsecuzioni.dettaglio)
+                .where(StoricoEsecuzioni.stato.in_(STATI_ATTIVI))
+                .order_by(StoricoEsecuzioni.id.desc())
+            ).all()
+        for id_esecuzione, avvio, dettaglio in rows:
+            # Senza aggiornamenti recenti il processo è considerato morto (es. terminato senza chiudere l'esecuzione)
+            if ultimo_aggiornamento(avvio, dettaglio) >= limite:
+                return id_esecuzione
+        return None
+
+    def avvia(self, argomenti=()):
+        """Avvia main.py in background e ritorna l'id dell'esecuzione; EsecuzioneGiaAttiva se ce n'è già una."""
+        with self._lock:
+            id_attiva = self.attiva()
+            if id_attiva is not None:
+                raise EsecuzioneGiaAttiva(id_attiva)
+            id_esecuzione = self.checkpoint_store.accoda_esecuzione()
+            os.makedirs(self.cartella_log, exist_ok=True)
+            log = open(self._percorso_log(id_esecuzione), 'w', encoding='utf-8')
+            try:
+                processo = subprocess.Popen(
+                    [sys.executable, 'main.py', '--id-esecuzione', str(id_esecuzione), *argomenti],
+                    stdout=log, stderr=subprocess.STDOUT, cwd='.'
+                )
+            except Exception as e:
+                log.close()
+                self._chiudi_se_attiva(id_esecuzione, {'errore': f'Avvio non riuscito: {e}'})
+                raise
+            self._processo, self._id_processo = processo, id_esecuzione
+        threading.Thread(target=self._sorveglia, args=(id_esecuzione, processo, log), daemon=True).start()
+        return id_esecuzione
+
+    def _sorveglia(self, id_esecuzione, processo, log):
+        # main.py chiude da solo l'esecuzione; se il processo termina prima (es. errore all'avvio) la chiude qui
+        codice = processo.wait()
+        log.close()
+        self._chiudi_se_attiva(id_esecuzione, {'errore': f'Processo terminato con codice {codice}'})
+
+    def _chiudi_se_attiva(self, id_esecuzione, dettaglio):
+        with self.Session() as session, session.begin():
+            session.execute(
+                update(StoricoEsecuzioni)
+                .where(StoricoEsecuzioni.id == id_esecuzione, StoricoEsecuzioni.stato.in_(STATI_ATTIVI))
+                .values(fine=datetime.now(), stato='errore', dettaglio=json.dumps(dettaglio))
+            )
+
+    def coda_log(self, id_esecuzione, righe=20):
+        """Ultime righe del log dell'esecuzione (vuoto se non avviata da qui)."""
+        try:
+            with open(self._percorso_log(id_esecuzione), encoding='utf-8', errors='replace') as f:
+                return ''.join(f.readlines()[-righe:])
+        except OSError:
+            return ''
+
+    @staticmethod
+    def _descrivi(esecuzione):
+        try:
+            dettaglio = json.loads(esecuzione.dettaglio) if esecuzione.dettaglio else {}
+        except ValueError:
+            dettaglio = {}
+        if not isinstance(dettaglio, dict):
+            dettaglio = {}
+        aggiornato_il = _data(dettaglio.get('aggiornato_il')) or esecuzione.fine
+        return {
+            'id': esecuzione.id,
+            'stato': esecuzione.stato,
+            'avvio': esecuzione.avvio.isoformat(timespec='seconds') if esecuzione.avvio else None,
+            'fine': esecuzione.fine.isoformat(timespec='seconds') if esecuzione.fine else None,
+            'record_inseriti': esecuzione.record_inseriti,
+            'aziende': {azienda: avanzamento_azienda(valori, aggiornato_il)
+                        for azienda, valori in (dettaglio.get('aziende') or {}).items()},
+            'errori': dettaglio.get('errori') or ({'esecuzione': dettaglio['errore']} if 'errore' in dettaglio else {}),
+        }
+
+    def stato(self, id_esecuzione):
+        """Stato e avanzamento dell'esecuzione (dizionario pronto per JSON), None se non esiste."""
+        with self.Session() as session:
+            esecuzione = session.get(StoricoEsecuzioni, id_esecuzione)
+            if esecuzione is None:
+                return None
+            risultato = self._descrivi(esecuzione)
+        if risultato['stato'] == 'errore':
+            risultato['log'] = self.coda_log(id_esecuzione)
+        return risultato
+
+    def storico(self, limite=20):
+        """Ultime esecuzioni, dalla più recente."""
+        with self.Session() as session:
+            esecuzioni = session.execute(
+                select(StoricoEsecuzioni).order_by(StoricoEsecuzioni.id.desc()).limit(limite)
+            ).scalars().all()
+            return [self._descrivi(esecuzione) for esecuzione in esecuzioni]
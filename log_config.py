@@ -0,0 +1,16 @@
+import logging
+import sys
+
+# Stesso formato delle righe stampate in precedenza ("[INFO] messaggio")
+FORMATO = '[%(levelname)s] %(message)s'
+
+
+def configura_logging(config, livello=None):
+    """
+    Configura il logging dalla sezione [LOG] (livello, default INFO) su stdout, che la dashboard
+    salva nel log dell'esecuzione. livello (es. da --log-level) ha la precedenza su config.ini.
+    Se il logging è già configurato (es. dai benchmark) cambia solo il livello.
+    """
+    livello = (livello or config.get('LOG', 'livello', fallback='INFO')).upper()
+    logging.basicConfig(stream=sys.stdout, format=FORMATO)
+    logging.getLogger().setLevel(livello)
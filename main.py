@@ -1,41 +1,139 @@
+import argparse
 import configparser
+import json
+import logging
+import multiprocessing
+import os
 import re
-import pyodbc
-import xml.etree.ElementTree as ET
-from sqlalchemy import create_engine
+from collections import Counter
+try:
+    import pyodbc
+except ImportError:
+    # Senza driver ODBC (es. benchmark con sorgenti SQLite, vedi connetti_sorgente) main.py resta importabile
+    pyodbc = None
+from sqlalchemy import Column, MetaData, Table, and_, exists, select
 from sqlalchemy.orm import sessionmaker
 from models import StoricoModificheFatture, Base
+from fattura_xml import extract_importi_from_xml
+from database import get_engine
+from checkpoint import CheckpointStore
+from riepilogo import RiepilogoStore
+from migrations import DoppioniChiaveNaturale, applica_migrazioni
+from cache_fatture import CacheFatture
+from shard import Heartbeat, LeaseScaduto, LeaseStore, dividi_intervallo, nome_worker
+from log_config import configura_logging
+from metriche import Istogramma, MetricheStore, Profilatore
 from datetime import datetime, date
-import json
-import os
+from decimal import ROUND_HALF_UP, Decimal
+from operator import itemgetter
+from typing import NamedTuple, Optional
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
 
 # Carica la configurazione
 config = configparser.ConfigParser()
 config.read('config.ini')
 
-CHECKPOINT_FILE = 'checkpoint.json'
+logger = logging.getLogger(__name__)
+
+QUERY_FATTURE_BATCH_FILE = 'Query Recupero Fatture Batch.sql'
+QUERY_TRASMISSIONI_BATCH_FILE = 'Query Recupero Trasmissioni Batch.sql'
+QUERY_MASSIMO_ID_FILE = 'Query Massimo Id Documento.sql'
+
+# Numero massimo di id_reg_pd per singola query di recupero fatture (IN-list)
+FATTURE_BATCH_SIZE = config.getint('SOURCE_INFINITY', 'batch_size', fallback=500)
+
+# Anno minimo delle commesse per azienda (sezione [ANNO_MINIMO], chiave 'default' per le aziende non elencate).
+# Le chiavi di configparser sono minuscole.
+ANNO_MINIMO = {'default': 2025, 'cv': 2024}
+if config.has_section('ANNO_MINIMO'):
+    ANNO_MINIMO.update({k: int(v) for k, v in config['ANNO_MINIMO'].items()})
+
+# Righe lette per ogni fetchmany dalla query dei log
+FETCH_SIZE = config.getint('SOURCE_INFINITY', 'fetch_size', fallback=1000)
+# Fine dell'intervallo di id_documento della query dei log quando non è limitata a un shard
+ID_DOCUMENTO_ILLIMITATO = 2 ** 63 - 1
+
+# Ingestione a shard (sezione [SHARD], vedi shard.py): id_documento per shard e secondi
+# di attesa del worker quando i shard rimasti sono tutti assegnati ad altri worker
+AMPIEZZA_SHARD = max(1, config.getint('SHARD', 'ampiezza', fallback=50000))
+ATTESA_SHARD = config.getfloat('SHARD', 'attesa', fallback=5.0)
+
+# Pool di connessioni verso le sorgenti Infinity (una per stringa DSN).
+# Almeno 2: la query dei log in streaming tiene occupata una connessione mentre le fatture ne usano un'altra.
+# Con i shard il pool viene allargato a 2 connessioni per thread worker (vedi dimensiona_pool).
+POOL_MAX_SIZE = max(2, config.getint('SOURCE_INFINITY', 'pool_size', fallback=4))
+POOL_TIMEOUT = config.getfloat('SOURCE_INFINITY', 'pool_timeout', fallback=30.0)
+POOL_HEALTH_CHECK = config.getfloat('SOURCE_INFINITY', 'pool_health_check', fallback=60.0)
+
+# Secondi minimi tra due salvataggi dell'avanzamento in Storico_Esecuzioni (letto da /jobs/<id>)
+INTERVALLO_AVANZAMENTO = config.getfloat('JOBS', 'intervallo_avanzamento', fallback=2.0)
+
+# Pipeline per azienda (sezione [PIPELINE], vedi PipelineAzienda): elementi in attesa in ogni coda tra due fasi,
+# processi per l'analisi degli XML (0 = un thread, senza processi) e blocchi di XML in analisi contemporaneamente
+DIMENSIONE_CODE = max(1, config.getint('PIPELINE', 'dimensione_code', fallback=4))
+PROCESSI_XML = max(0, config.getint('PIPELINE', 'processi_xml', fallback=min(4, os.cpu_count() or 1)))
+ANALISI_IN_CORSO = max(1, config.getint('PIPELINE', 'analisi_in_corso', fallback=2 * max(1, PROCESSI_XML)))
+# Dimensione massima di un blocco di XML inviato all'analisi (gli XML con allegati possono pesare diversi MB)
+XML_PER_BLOCCO = 100
+BYTE_BLOCCO_XML = 4 * 1024 * 1024
+
+# Secondi tra due righe di riepilogo della velocità per azienda (sezione [LOG])
+INTERVALLO_THROUGHPUT = config.getfloat('LOG', 'intervallo_throughput', fallback=30.0)
 
 # Connessione SQL Server
-sqlserver_conf = config['SQLSERVER']
-sqlserver_conn_str = (
-    f"mssql+pyodbc://{sqlserver_conf['username']}:{sqlserver_conf['password']}@"
-    f"{sqlserver_conf['server']}/{sqlserver_conf['database']}?driver=ODBC+Driver+17+for+SQL+Server"
-)
-engine = create_engine(sqlserver_conn_str)
+engine = get_engine(config)
 Session = sessionmaker(bind=engine)
+checkpoint_store = CheckpointStore.da_config(config, Session)
+riepilogo_store = RiepilogoStore(Session)
+lease_store = LeaseStore.da_config(config, Session)
+metriche_store = MetricheStore(Session)
+
+# cProfile dei thread dell'elaborazione, attivato da --profile
+profilatore = Profilatore()
+
+# Cache persistente degli importi fattura (sezione [CACHE_FATTURE]), aperta da main(); None se disabilitata.
+# Non viene aperta all'importazione: i processi di analisi XML reimportano questo modulo.
+cache_fatture = None
+
+# Record accodati prima di ogni scrittura in blocco su Storico_Modifiche_Fatture
+INSERT_BATCH_SIZE = config.getint('SQLSERVER', 'batch_size', fallback=500)
+
+# Chiave naturale usata per evitare duplicati in Storico_Modifiche_Fatture
+CHIAVE_NATURALE = ('id_documento', 'id_reg_pd', 'azienda', 'data_modifica')
+
+def _tabella_staging(dialect_name):
+    """
+    Tabella temporanea con le stesse colonne di Storico_Modifiche_Fatture (senza id),
+    usata per l'inserimento in blocco. Su SQL Server le tabelle temporanee hanno il prefisso '#'.
+    """
+    colonne = [Column(c.name, c.type) for c in StoricoModificheFatture.__table__.columns if c.name != 'id']
+    if dialect_name == 'mssql':
+        return Table('#Staging_Modifiche_Fatture', MetaData(), *colonne)
+    return Table('Staging_Modifiche_Fatture', MetaData(), *colonne, prefixes=['TEMPORARY'])
+
+STAGING_TABLE = _tabella_staging(engine.dialect.name)
+
+# Importo nelle note: numero fino a 8 cifre, con separatore decimale punto o virgola e 1-3 decimali
+RE_IMPORTO = re.compile(r"\b\d{1,8}(?:[\.,]\d{1,3})?\b")
+CENTESIMO = Decimal('0.01')
 
 def extract_importo(note):
     """
     Estrae l'ultimo importo numerico dal campo note.
     Accetta sia punto che virgola come separatore decimale, fino a 3 decimali.
     Restituisce il valore come float troncato a due decimali, oppure None se non trovato.
+    La pipeline usa extract_importi, che restituisce Decimal esatti.
     """
 
     if not note:
         return None
     
     # Cerca numeri con separatore decimale punto o virgola, 1-3 decimali
-    match = re.findall(r"\b\d{1,8}(?:[\.,]\d{1,3})?\b", note)
+    match = RE_IMPORTO.findall(note)
 
     if match:
         # Sostituisci la virgola con il punto per la conversione
@@ -47,124 +145,1110 @@ def extract_importo(note):
             return None
     return None
 
-def extract_importo_from_xml(xml_content):
+def extract_importi(note_list):
     """
-    Estrae l'importo effettivo della fattura elettronica dal file XML.
-    Logica:
-    - Prende il valore di <ImportoTotaleDocumento> (importo totale della fattura)
-    - Sottrae la somma delle righe <DettaglioLinee> che hanno <Descrizione> contenente 'Spesa Materiale consumo'.
-    - Sottrae anche l'IVA relativa a queste righe (se presente), per replicare il calcolo manuale dell'utente.
-    - Restituisce il risultato arrotondato a due decimali.
-    Parametri:
-        xml_content: stringa XML (o bytes) della fattura elettronica
-    Ritorna:
-        float: importo effettivo (ImportoTotaleDocumento - somma Spesa Materiale consumo - IVA relativa), oppure None se errore
+    Come extract_importo per un blocco di note, con la regex precompilata e senza passare da float:
+    ritorna una lista allineata a note_list di Decimal arrotondati al centesimo (ROUND_HALF_UP),
+    esatti come la colonna DECIMAL(18,2), oppure None per le note senza importo.
     """
-    if not xml_content or not isinstance(xml_content, (str, bytes)):
+    findall = RE_IMPORTO.findall
+    importi = []
+    for note in note_list:
+        trovati = findall(note) if note else None
+        importi.append(Decimal(trovati[-1].replace(',', '.')).quantize(CENTESIMO, ROUND_HALF_UP) if trovati else None)
+    return importi
+
+def parse_data(val):
+    """Converte in datetime una data della sorgente (datetime, stringa ISO o AAAAMMGG); None se non valida."""
+    if not val:
         return None
+    if isinstance(val, datetime):
+        return val
+    s = str(val)
     try:
-        # Se il contenuto è bytes, decodifica in stringa
-        if isinstance(xml_content, bytes):
-            xml_content = xml_content.decode('utf-8', errors='ignore')
-        root = ET.fromstring(xml_content)
-        
-        # Cerca il tag <ImportoTotaleDocumento> (importo totale della fattura)
-        importo_totale = root.find('.//ImportoTotaleDocumento')
-        importo_totale_val = float(importo_totale.text) if importo_totale is not None else 0.0
-        
-        # Cerca tutte le righe <DettaglioLinee> e somma i valori di <PrezzoTotale>
-        # solo se la <Descrizione> contiene 'Spesa Materiale consumo'
-        spesa_materiale = 0.0
-        iva_materiale = 0.0
-        for dettaglio in root.findall('.//DettaglioLinee'):
-            descrizione = dettaglio.find('Descrizione')
-            if descrizione is not None and 'Spesa Materiale consumo' in descrizione.text:
-                prezzo_totale = dettaglio.find('PrezzoTotale')
-                aliquota_iva = dettaglio.find('AliquotaIVA')
-                if prezzo_totale is not None:
-                    valore = float(prezzo_totale.text)
-                    spesa_materiale += valore
-                    # Calcola l'IVA di questa riga se presente
-                    if aliquota_iva is not None:
-                        try:
-                            iva = valore * float(aliquota_iva.text) / 100.0
-                            iva_materiale += iva
-                        except Exception:
-                            pass
-        # Calcola l'importo effettivo: totale - spese materiale consumo - iva materiale consumo
-        risultato = round(importo_totale_val - spesa_materiale - iva_materiale, 2)
-        print(f"[DEBUG XML] ImportoTotale={importo_totale_val}, SpesaMateriale={spesa_materiale}, IVA_Materiale={iva_materiale}, Risultato={risultato}")
-        return risultato
-    except Exception as e:
-        print(f"[WARNING] Errore nel parsing XML: {e}")
-        return None
+        return datetime.fromisoformat(s)
+    except Exception:
+        pass
+    if s.isdigit() and len(s) == 8:
+        try:
+            return datetime.strptime(s, '%Y%m%d')
+        except Exception:
+            pass
+    return None
 
-def get_fattura_data(odbc_conn_str, id_reg_pd):
+def parse_dsn(dsn_str):
     """
-    Recupera i dati della fattura (data trasmissione e importo dal XML) dato l'id_reg_pd
+    Scompone la stringa 'azienda^dsn^user^pwd' di [SOURCE_INFINITY].
+    Ritorna la tupla (azienda, stringa di connessione ODBC).
+    """
+    dsn_parts = dsn_str.split('^')
+    azienda = dsn_parts[0] if len(dsn_parts) > 0 else ''
+    dsn_name = dsn_parts[1] if len(dsn_parts) > 1 else ''
+    username_source = dsn_parts[2] if len(dsn_parts) > 2 else ''
+    password_source = dsn_parts[3] if len(dsn_parts) > 3 else ''
+    return azienda, f"DSN={dsn_name};UID={username_source};PWD={password_source}"
+
+def connetti_pyodbc(odbc_conn_str):
+    if pyodbc is None:
+        raise RuntimeError("pyodbc non disponibile: installare pyodbc e il driver ODBC per leggere le sorgenti Infinity")
+    return pyodbc.connect(odbc_conn_str)
+
+# Funzione usata dai nuovi pool per aprire le connessioni alle sorgenti (stringa ODBC -> connessione DB-API
+# compatibile con pyodbc). I benchmark la sostituiscono per leggere sorgenti sintetiche in SQLite.
+connetti_sorgente = connetti_pyodbc
+
+class InfinityConnectionPool:
+    """
+    Pool minimale di connessioni pyodbc verso una singola sorgente Infinity.
+    - Al massimo max_size connessioni aperte contemporaneamente (le richieste oltre il limite
+      attendono fino a timeout secondi).
+    - Le connessioni inattive da più di health_check secondi vengono verificate con 'SELECT 1'
+      prima di essere riusate; se non rispondono vengono chiuse e riaperte.
+    - Una connessione che solleva un errore durante l'uso viene chiusa, non restituita al pool.
+    """
+
+    def __init__(self, odbc_conn_str, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT, health_check=POOL_HEALTH_CHECK,
+                 connect=None):
+        self.odbc_conn_str = odbc_conn_str
+        self.connect = connect or connetti_pyodbc
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check = health_check
+        self._idle = queue.LifoQueue()  # (connessione, istante ultimo utilizzo)
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _connect(self):
+        return self.connect(self.odbc_conn_str)
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        # Riusa la connessione inattiva più recente, verificandola se ferma da troppo tempo
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used < self.health_check or self._is_alive(conn):
+                return conn
+            logger.warning("Connessione Infinity non più valida, riconnessione in corso")
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"Nessuna connessione disponibile entro {self.timeout}s (pool_size={self.max_size})")
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+            # Chiude la transazione implicita aperta dalle SELECT prima di restituire la connessione
+            conn.rollback()
+            self._idle.put((conn, time.monotonic()))
+        except BaseException:
+            # Anche GeneratorExit: un generatore chiuso a metà lascia la connessione con un cursore aperto
+            if conn is not None:
+                self._close(conn)
+            raise
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(conn)
+
+_pools = {}
+_pools_lock = threading.Lock()
+_connessioni_pool = POOL_MAX_SIZE  # dimensione dei pool creati da get_pool
+
+def dimensiona_pool(pipeline):
+    """
+    Porta i pool ad almeno 2 connessioni per ciascuna delle pipeline che possono usare lo stesso DSN
+    insieme (query dei log in streaming e recupero fatture), come i thread worker dei shard della
+    stessa azienda. I pool già aperti vengono chiusi e ricreati al prossimo get_pool.
+    """
+    global _connessioni_pool
+    with _pools_lock:
+        _connessioni_pool = max(POOL_MAX_SIZE, 2 * pipeline)
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+def get_pool(dsn_str):
+    """
+    Restituisce il pool di connessioni associato alla stringa 'azienda^dsn^user^pwd',
+    creandolo al primo utilizzo. Lo stesso pool viene condiviso per tutta l'esecuzione.
+    """
+    with _pools_lock:
+        pool = _pools.get(dsn_str)
+        if pool is None:
+            pool = InfinityConnectionPool(parse_dsn(dsn_str)[1], max_size=_connessioni_pool, connect=connetti_sorgente)
+            _pools[dsn_str] = pool
+        return pool
+
+def close_pools():
+    """Chiude tutte le connessioni inattive dei pool aperti durante l'esecuzione."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+class LottoFatture:
+    """
+    Dati fattura di un gruppo di id_reg_pd letti dalla sorgente (vedi scarica_fatture).
+    Gli XML scaricati vengono inviati all'analisi (extract_importi_from_xml) a blocchi di al massimo
+    XML_PER_BLOCCO file o BYTE_BLOCCO_XML byte man mano che arrivano, così in memoria restano solo
+    gli XML non ancora analizzati. Con un executor i blocchi vengono analizzati in parallelo
+    (al massimo quanti ne consente il semaforo: chi scarica si ferma finché un blocco non termina),
+    senza executor subito, nel thread chiamante.
+    risultati() attende le analisi, salva gli importi nella cache fatture e ritorna
+    {id_reg_pd: (data_trasmissione, importo_fattura)}.
+    interrogati contiene gli id_reg_pd per cui la query è terminata: quelli assenti dai risultati
+    non sono stati trasmessi.
+    """
+
+    def __init__(self, azienda, executor=None, semaforo=None):
+        self.azienda = azienda
+        self.executor = executor
+        self.semaforo = semaforo
+        self.importi = {}
+        self.interrogati = set()
+        self.analizzati = 0  # XML analizzati
+        self.secondi_analisi = 0.0  # tempo di analisi degli XML (nei processi dell'executor)
+        self.attesa_invio = 0.0  # attesa sul semaforo prima di inviare un blocco (backpressure)
+        self.attesa_risultati = 0.0  # attesa in risultati() delle analisi non ancora terminate
+        self._voci_cache = []  # (id_reg_pd, fine_trasmissione, nome_file, hash_xml, importo) da salvare in cache
+        self._visti = set()
+        self._blocco, self._byte_blocco = [], 0
+        self._analisi = []  # (voci del blocco, future di extract_importi_from_xml)
+
+    def aggiungi_trasmissione(self, id_reg_pd, fine_trasmissione, importo_fattura):
+        # Fattura trovata nella cache con la stessa trasmissione: nessun XML da scaricare
+        self._visti.add(id_reg_pd)
+        self.importi[id_reg_pd] = (fine_trasmissione, importo_fattura)
+
+    def aggiungi_xml(self, id_reg_pd, fine_trasmissione, nome_file, xml_content):
+        if id_reg_pd in self._visti:
+            return
+        self._visti.add(id_reg_pd)
+        hash_xml = None
+        if cache_fatture is not None:
+            # Un XML con lo stesso contenuto già analizzato non viene rianalizzato
+            hash_xml = cache_fatture.hash_xml(xml_content)
+            trovato, importo_fattura = cache_fatture.cerca_hash(hash_xml)
+            if trovato:
+                self.importi[id_reg_pd] = (fine_trasmissione, importo_fattura)
+                self._voci_cache.append((id_reg_pd, fine_trasmissione, nome_file, hash_xml, importo_fattura))
+                return
+        self._blocco.append((id_reg_pd, fine_trasmissione, nome_file, hash_xml, xml_content))
+        self._byte_blocco += len(xml_content) if isinstance(xml_content, (str, bytes)) else 0
+        if len(self._blocco) >= XML_PER_BLOCCO or self._byte_blocco >= BYTE_BLOCCO_XML:
+            self.invia()
+
+    def invia(self):
+        """Invia all'analisi gli XML accodati."""
+        if not self._blocco:
+            return
+        xml = [voce[4] for voce in self._blocco]
+        voci = [voce[:4] for voce in self._blocco]
+        self._blocco, self._byte_blocco = [], 0
+        if self.executor is None:
+            analisi = Future()
+            analisi.set_result(extract_importi_from_xml(xml))
+        else:
+            if self.semaforo is not None:
+                inizio = time.perf_counter()
+                self.semaforo.acquire()
+                self.attesa_invio += time.perf_counter() - inizio
+            analisi = self.executor.submit(extract_importi_from_xml, xml)
+            if self.semaforo is not None:
+                analisi.add_done_callback(lambda _: self.semaforo.release())
+        self._analisi.append((voci, analisi))
+
+    def risultati(self):
+        self.invia()
+        for voci, analisi in self._analisi:
+            inizio = time.perf_counter()
+            importi, secondi = analisi.result()
+            self.attesa_risultati += time.perf_counter() - inizio
+            self.secondi_analisi += secondi
+            self.analizzati += len(voci)
+            for (id_reg_pd, fine_trasmissione, nome_file, hash_xml), importo_fattura in zip(voci, importi):
+                self.importi[id_reg_pd] = (fine_trasmissione, importo_fattura)
+                if hash_xml is not None:
+                    self._voci_cache.append((id_reg_pd, fine_trasmissione, nome_file, hash_xml, importo_fattura))
+        self._analisi = []
+        if cache_fatture is not None and self._voci_cache:
+            cache_fatture.salva(self.azienda, self._voci_cache)
+            self._voci_cache = []
+        return self.importi
+
+def scarica_fatture(dsn_str, id_reg_pd_list, batch_size=FATTURE_BATCH_SIZE, executor=None, semaforo=None):
+    """
+    Legge dalla sorgente i dati fattura (data trasmissione e file XML) per più id_reg_pd
+    con una connessione del pool del DSN e query a blocchi (IN-list di al massimo batch_size chiavi).
+    Se la cache fatture è attiva, per ogni blocco vengono lette prima solo le trasmissioni
+    (senza XML): le fatture già in cache con la stessa trasmissione non vengono scaricate né analizzate.
+    Ritorna un LottoFatture con gli XML già inviati all'analisi (vedi LottoFatture per executor e semaforo);
+    gli id_reg_pd senza trasmissione non compaiono nei risultati.
+    Gli errori della sorgente (ODBC, timeout del pool) non vengono trattati come fatture non trasmesse:
+    si propagano al chiamante, così l'azienda (o il shard) fallisce senza avanzare il checkpoint oltre i blocchi salvati.
+    """
+    ids = sorted({i for i in id_reg_pd_list if i and i > 0})
+    azienda = parse_dsn(dsn_str)[0]
+    lotto = LottoFatture(azienda, executor, semaforo)
+    if not ids:
+        return lotto
+
+    # Carica le query una sola volta; {placeholders} viene sostituito con la lista di '?'
+    query_template = open(QUERY_FATTURE_BATCH_FILE, encoding='utf-8').read()
+    query_trasmissioni_template = open(QUERY_TRASMISSIONI_BATCH_FILE, encoding='utf-8').read()
+
+    with get_pool(dsn_str).connection() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(ids), batch_size):
+            blocco = ids[start:start + batch_size]
+            da_scaricare = blocco
+            if cache_fatture is not None:
+                # La query restituisce: id_reg_pd, fine_trasmissione, nome_file
+                trasmissioni = {}
+                query = query_trasmissioni_template.format(placeholders=', '.join('?' * len(blocco)))
+                for row in cursor.execute(query, *blocco).fetchall():
+                    trasmissioni.setdefault(row[0], (row[1], row[2]))
+                in_cache = cache_fatture.cerca(azienda, trasmissioni)
+                for id_reg_pd, importo_fattura in in_cache.items():
+                    lotto.aggiungi_trasmissione(id_reg_pd, trasmissioni[id_reg_pd][0], importo_fattura)
+                # Solo le fatture trasmesse e non in cache
+                da_scaricare = [i for i in blocco if i in trasmissioni and i not in in_cache]
+                if in_cache:
+                    logger.debug("%d/%d fatture trovate in cache", len(in_cache), len(trasmissioni))
+            if da_scaricare:
+                query = query_template.format(placeholders=', '.join('?' * len(da_scaricare)))
+                cursor.execute(query, *da_scaricare)
+                # Righe lette una alla volta: gli XML restano in memoria solo fino all'invio del loro blocco di analisi
+                for row in cursor:
+                    # La query restituisce: id_reg_pd, fine_trasmissione, nome_file, file_xml_vendita
+                    lotto.aggiungi_xml(row[0], row[1], row[2], row[3])
+                logger.debug("Recuperate fatture per %d id_reg_pd (%d/%d)", len(da_scaricare), start + len(blocco), len(ids))
+            lotto.interrogati.update(blocco)
+    lotto.invia()
+    return lotto
+
+# Dati fattura già recuperati durante l'esecuzione: {dsn_str: {id_reg_pd: (data_trasmissione, importo_fattura)}}.
+# Le righe di log di una commessa modificata più volte condividono lo stesso id_reg_pd: ogni id_reg_pd
+# viene recuperato al massimo una volta per esecuzione (anche le fatture non trasmesse, memorizzate come (None, None)).
+# Vi entrano solo gli id_reg_pd a cui la query ha risposto (LottoFatture.interrogati), mai quelli di un recupero fallito.
+_fatture_esecuzione = {}
+
+def anno_minimo(azienda):
+    """Anno minimo delle commesse da considerare per l'azienda (da [ANNO_MINIMO])."""
+    return ANNO_MINIMO.get(azienda.lower(), ANNO_MINIMO['default'])
+
+def id_documento_massimo(dsn_str, last_id_documento=0):
+    """
+    Massimo id_documento ancora da elaborare sulla sorgente: serve solo a stimare
+    percentuale di avanzamento ed ETA. Ritorna None se la query non riesce.
     """
-    if not id_reg_pd or id_reg_pd <= 0:
-        return None, None
-    
-    # Carica la query dal file SQL
-    query_fattura = open('Query Recupero Fattura.sql', encoding='utf-8').read()
-    
     try:
-        with pyodbc.connect(odbc_conn_str) as conn:
+        query = open(QUERY_MASSIMO_ID_FILE, encoding='utf-8').read()
+        with get_pool(dsn_str).connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(query_fattura, id_reg_pd)
+            cursor.execute(query, last_id_documento)
             row = cursor.fetchone()
-            if row:
-                # La query restituisce: id_reg_pd, fine_trasmissione, nome_file, file_xml_vendita
-                data_trasmissione = row[1]  # fine_trasmissione (datetime)
-                xml_content = row[3]  # file_xml_vendita (XML string)
-                print(f"[DEBUG] id_reg_pd {id_reg_pd}: data_trasmissione={data_trasmissione}")
-                if xml_content is None:
-                    print(f"[DEBUG] id_reg_pd {id_reg_pd}: xml_content è None!")
-                elif isinstance(xml_content, bytes):
-                    print(f"[DEBUG] id_reg_pd {id_reg_pd}: xml_content è bytes, len={len(xml_content)}")
-                elif isinstance(xml_content, str):
-                    print(f"[DEBUG] id_reg_pd {id_reg_pd}: xml_content è str, len={len(xml_content)}")
-                else:
-                    print(f"[DEBUG] id_reg_pd {id_reg_pd}: xml_content tipo sconosciuto: {type(xml_content)}")
-                # Mostra un estratto dei primi 200 caratteri
-                if xml_content:
-                    anteprima = xml_content[:200] if isinstance(xml_content, (str, bytes)) else str(xml_content)[:200]
-                    print(f"[DEBUG] id_reg_pd {id_reg_pd}: xml_content anteprima: {anteprima}")
-                importo_fattura = extract_importo_from_xml(xml_content)
-                print(f"[DEBUG] id_reg_pd {id_reg_pd}: importo_fattura={importo_fattura}")
-                return data_trasmissione, importo_fattura
-            else:
-                print(f"[DEBUG] id_reg_pd {id_reg_pd}: Nessun risultato dalla query (fattura non trasmessa?)")
+        return row[0] if row else None
     except Exception as e:
-        print(f"[WARNING] Errore nel recupero dati fattura per id_reg_pd {id_reg_pd}: {e}")
-    
-    return None, None
+        logger.warning("Impossibile stimare l'avanzamento per %s: %s", dsn_str.split('^')[0], e)
+        return None
+
+def intervallo_id_documento(dsn_str):
+    """(minimo, massimo) id_documento dei log sulla sorgente, per dividere l'azienda in shard."""
+    query = open(QUERY_MASSIMO_ID_FILE, encoding='utf-8').read()
+    with get_pool(dsn_str).connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, 0)
+        row = cursor.fetchone()
+    return (row[1], row[0]) if row else (None, None)
+
+class Avanzamento:
+    """
+    Avanzamento dell'esecuzione per azienda (stato, record letti/inseriti, intervallo di id_documento),
+    condiviso dai worker e salvato in Storico_Esecuzioni.dettaglio al massimo ogni INTERVALLO_AVANZAMENTO
+    secondi, così la dashboard (/jobs/<id>) può mostrarlo mentre main.py è in esecuzione.
+    """
+
+    def __init__(self, id_esecuzione, intervallo=INTERVALLO_AVANZAMENTO):
+        self.id_esecuzione = id_esecuzione
+        self.intervallo = intervallo
+        self._lock = threading.Lock()
+        self._aziende = {}
+        self._ultimo_salvataggio = 0.0
+
+    def aggiorna(self, azienda, salva=False, **valori):
+        """
+        Aggiorna i valori dell'azienda; li salva nel database se forzato o se è passato l'intervallo.
+        Senza id_esecuzione (shard, vedi elabora_shard) i valori restano solo in memoria.
+        """
+        with self._lock:
+            self._aziende.setdefault(azienda, {}).update(valori)
+            if self.id_esecuzione is None:
+                return
+            if salva or time.monotonic() - self._ultimo_salvataggio >= self.intervallo:
+                self._ultimo_salvataggio = time.monotonic()
+                try:
+                    checkpoint_store.salva_avanzamento(self.id_esecuzione, self.stato())
+                except Exception as e:
+                    # L'avanzamento è solo informativo: un errore non deve fermare l'elaborazione
+                    logger.warning("Salvataggio avanzamento non riuscito: %s", e)
+
+    def stato(self):
+        return {'aggiornato_il': datetime.now().isoformat(timespec='seconds'),
+                'aziende': {azienda: dict(valori) for azienda, valori in self._aziende.items()}}
+
+class RecordLog(NamedTuple):
+    """
+    Riga della query dei log (Query Check Log Commesse.sql). Tupla con nome: nessun dizionario
+    per riga, accesso ai campi per attributo. Diventa un dizionario di parametri per l'inserimento
+    solo se supera tutti i filtri (vedi parametri_storico).
+    """
+    id_documento: int
+    anno: Optional[int]
+    id_cliente: Optional[int]
+    tipo_doc: Optional[str]
+    data_doc: Optional[date]
+    num_doc: Optional[int]
+    tipo_fattura: Optional[str]
+    data_fattura: Optional[date]
+    numero_fattura: Optional[int]
+    tipo_pagamento: Optional[str]
+    id_hst: Optional[int]
+    nome_tabella: Optional[str]
+    utente: Optional[str]
+    tipo_operazione: Optional[str]
+    note: Optional[str]
+    data_modifica: Optional[datetime]
+    id_reg_pd: Optional[int]
+    targa: Optional[str]
+
+def lettore_record(description):
+    """
+    Funzione riga -> RecordLog per il cursore con questa description: gli indici delle colonne
+    vengono calcolati una sola volta per query. Se le colonne sono già nell'ordine di RecordLog
+    la riga viene usata così com'è.
+    """
+    colonne = [col[0].lower() for col in description]
+    mancanti = [campo for campo in RecordLog._fields if campo not in colonne]
+    if mancanti:
+        raise ValueError(f"Colonne mancanti nella query dei log: {', '.join(mancanti)}")
+    indici = [colonne.index(campo) for campo in RecordLog._fields]
+    if indici == list(range(len(RecordLog._fields))) and len(colonne) == len(indici):
+        return RecordLog._make
+    estrai = itemgetter(*indici)
+    return lambda row: RecordLog._make(estrai(row))
+
+def parametri_storico(record, azienda, data_modifica, importo_log, importo_fattura, data_trasmissione):
+    """Parametri di inserimento in Storico_Modifiche_Fatture per un record che ha superato i filtri."""
+    return {
+        'id_documento': record.id_documento,
+        'anno': record.anno,
+        'id_cliente': record.id_cliente,
+        'tipo_doc': record.tipo_doc,
+        'data_doc': record.data_doc,
+        'num_doc': record.num_doc,
+        'tipo_fattura': record.tipo_fattura,
+        'data_fattura': record.data_fattura,
+        'numero_fattura': record.numero_fattura,
+        'tipo_pagamento': record.tipo_pagamento,
+        'id_hst': record.id_hst,
+        'nome_tabella': record.nome_tabella,
+        'utente': record.utente,
+        'tipo_operazione': record.tipo_operazione,
+        'note': record.note,
+        'data_modifica': data_modifica,
+        'azienda': azienda,
+        'importo_modifica': importo_log,
+        'importo_fattura': importo_fattura,
+        'id_reg_pd': record.id_reg_pd,
+        'data_trasmissione_fattura': data_trasmissione,
+        'targa': record.targa,
+    }
 
 # Funzione per estrarre dati dal DNS e connettersi a Infinity
-def estrai_dati_da_dsn(dsn_str):
-    dsn_parts = dsn_str.split('^')
-    azienda = dsn_parts[0] if len(dsn_parts) > 0 else ''
-    dsn_name = dsn_parts[1] if len(dsn_parts) > 1 else ''
-    username_source = dsn_parts[2] if len(dsn_parts) > 2 else ''
-    password_source = dsn_parts[3] if len(dsn_parts) > 3 else ''
-    odbc_conn_str = f"DSN={dsn_name};UID={username_source};PWD={password_source}"
-    print(f"\n[INFO] Connessione a sorgente azienda: {azienda} (DSN: {dsn_name}) ...")
+def estrai_dati_da_dsn(dsn_str, last_id_documento=0, fetch_size=FETCH_SIZE, id_documento_fine=None):
+    """
+    Esegue la query dei log su un DSN e restituisce un generatore di blocchi
+    (liste di RecordLog) letti con fetchmany(fetch_size).
+    Il primo blocco è disponibile mentre la query sta ancora restituendo righe
+    e in memoria resta un solo blocco alla volta.
+    Il checkpoint (id_documento > last_id_documento), la fine dell'intervallo (id_documento <= id_documento_fine,
+    per i shard) e l'anno minimo dell'azienda sono applicati direttamente nella query,
+    così vengono trasferite solo le righe utili.
+    """
+    azienda, _ = parse_dsn(dsn_str)
+    dsn_name = dsn_str.split('^')[1] if '^' in dsn_str else ''
+    logger.info("Connessione a sorgente azienda: %s (DSN: %s) ...", azienda, dsn_name)
     query = open('Query Check Log Commesse.sql', encoding='utf-8').read()
-    
-    results = []
-    with pyodbc.connect(odbc_conn_str) as conn:
+
+    letti = 0
+    with get_pool(dsn_str).connection() as conn:
         cursor = conn.cursor()
-        cursor.execute(query)
-        columns = [col[0] for col in cursor.description]
-        rows = cursor.fetchall()
-        print(f"[INFO] Trovati {len(rows)} record per azienda {azienda}.")
-        for row in rows:
-            results.append((azienda, odbc_conn_str, dict(zip(columns, row))))
-    
-    return results
+        cursor.execute(query, last_id_documento,
+                       ID_DOCUMENTO_ILLIMITATO if id_documento_fine is None else id_documento_fine,
+                       anno_minimo(azienda))
+        leggi = lettore_record(cursor.description)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            letti += len(rows)
+            yield [leggi(row) for row in rows]
+    logger.info("Letti %d record per azienda %s.", letti, azienda)
+
+def salva_blocco(session, righe, id_esecuzione, azienda, last_id_documento, avanza=None, tempi=None):
+    """
+    Inserisce un blocco di record in Storico_Modifiche_Fatture in una sola transazione:
+    i record vengono caricati in una tabella temporanea e copiati con un unico
+    INSERT ... SELECT ... WHERE NOT EXISTS sulla chiave naturale
+    (id_documento, id_reg_pd, azienda, data_modifica), come il vecchio controllo riga per riga.
+    Nella stessa transazione aggiorna Riepilogo_Modifiche_Fatture per i documenti del blocco
+    e avanza il checkpoint dell'azienda a last_id_documento; con avanza (shard) chiama invece
+    avanza(conn, last_id_documento, inseriti).
+    In tempi (dizionario), se indicato, scrive i secondi di deduplica, riepilogo e commit.
+    Ritorna il numero di record effettivamente inseriti.
+    """
+    # A parità di chiave naturale nello stesso blocco vale il primo record, come prima
+    unici = {}
+    for riga in righe:
+        unici.setdefault(tuple(riga[k] for k in CHIAVE_NATURALE), riga)
+
+    inseriti = 0
+    tabella = StoricoModificheFatture.__table__
+    colonne = [c.name for c in STAGING_TABLE.columns]
+    secondi_riepilogo = 0.0
+    inizio = time.perf_counter()
+    with session.begin():
+        conn = session.connection()
+        if unici:
+            id_documenti = {riga['id_documento'] for riga in unici.values()}
+            prima = riepilogo_store.ultime(conn, azienda, id_documenti)
+            secondi_riepilogo = time.perf_counter() - inizio
+            STAGING_TABLE.create(conn)
+            try:
+                conn.execute(STAGING_TABLE.insert(), list(unici.values()))
+                gia_presente = exists().where(and_(*(tabella.c[k] == STAGING_TABLE.c[k] for k in CHIAVE_NATURALE)))
+                result = conn.execute(
+                    tabella.insert().from_select(colonne, select(*STAGING_TABLE.columns).where(~gia_presente))
+                )
+                inseriti = result.rowcount
+            except BaseException:
+                # Su una connessione già in errore anche la drop può fallire: si registra e vale l'errore originale
+                try:
+                    STAGING_TABLE.drop(conn)
+                except Exception as e:
+                    logger.warning("Rimozione di %s non riuscita: %s", STAGING_TABLE.name, e)
+                raise
+            STAGING_TABLE.drop(conn)
+            inizio_riepilogo = time.perf_counter()
+            if inseriti:
+                riepilogo_store.applica(conn, prima, riepilogo_store.ultime(conn, azienda, id_documenti))
+            secondi_riepilogo += time.perf_counter() - inizio_riepilogo
+        if avanza is not None:
+            avanza(conn, last_id_documento, inseriti)
+        elif last_id_documento:
+            checkpoint_store.avanza(conn, id_esecuzione, azienda, last_id_documento)
+        inizio_commit = time.perf_counter()
+    if tempi is not None:
+        tempi['commit'] = time.perf_counter() - inizio_commit
+        tempi['riepilogo'] = secondi_riepilogo
+        tempi['deduplica'] = inizio_commit - inizio - secondi_riepilogo
+    return inseriti
+
+def log_throughput(azienda, inizio, letti, inseriti, scartati):
+    """Riga di riepilogo per azienda: record letti al secondo, inseriti e scartati per motivo."""
+    secondi = time.monotonic() - inizio
+    logger.info("Azienda %s: %d record letti (%.0f/s), %d inseriti, %d scartati %s",
+                azienda, letti, letti / secondi if secondi > 0 else 0.0, inseriti,
+                sum(scartati.values()), dict(sorted(scartati.items())))
+
+_FINE = object()  # ultimo elemento di una coda della pipeline
+
+class PipelineInterrotta(Exception):
+    """Un'altra fase della pipeline è fallita: la fase corrente si ferma."""
+
+class CodaFase:
+    """
+    Coda limitata (dimensione elementi) tra due fasi della pipeline. metti() e prendi() attendono
+    finché c'è posto o c'è un elemento, ma si interrompono (PipelineInterrotta) se viene impostato arresto.
+    """
+
+    def __init__(self, dimensione, arresto):
+        self._coda = queue.Queue(dimensione)
+        self._arresto = arresto
+
+    def metti(self, elemento):
+        while True:
+            try:
+                self._coda.put(elemento, timeout=0.2)
+                return
+            except queue.Full:
+                if self._arresto.is_set():
+                    raise PipelineInterrotta()
+
+    def prendi(self):
+        while True:
+            try:
+                return self._coda.get(timeout=0.2)
+            except queue.Empty:
+                if self._arresto.is_set():
+                    raise PipelineInterrotta()
+
+    def occupazione(self):
+        return f"{self._coda.qsize()}/{self._coda.maxsize}"
+
+class StatisticheFasi:
+    """
+    Tempi per fase della pipeline di un'azienda: elementi elaborati, secondi di lavoro,
+    secondi di attesa in ingresso (fase precedente più lenta) e in uscita (fase successiva più lenta, backpressure).
+    istogrammi contiene le latenze di ogni unità di lavoro (blocco, lotto di fatture) per fase
+    e per passo del salvataggio (PASSI, vedi salva_blocco).
+    """
+
+    FASI = ('estrazione', 'arricchimento', 'parsing', 'filtro', 'salvataggio')
+    PASSI = ('deduplica', 'riepilogo', 'commit')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fasi = {fase: {'elementi': 0, 'lavoro': 0.0, 'attesa_ingresso': 0.0, 'attesa_uscita': 0.0}
+                     for fase in self.FASI}
+        self.istogrammi = {nome: Istogramma() for nome in self.FASI + self.PASSI}
+
+    def aggiungi(self, fase, elementi=0, lavoro=0.0, attesa_ingresso=0.0, attesa_uscita=0.0):
+        with self._lock:
+            valori = self.fasi[fase]
+            valori['elementi'] += elementi
+            valori['lavoro'] += lavoro
+            valori['attesa_ingresso'] += attesa_ingresso
+            valori['attesa_uscita'] += attesa_uscita
+            if lavoro:
+                self.istogrammi[fase].aggiungi(lavoro)
+
+    def misura(self, passo, secondi):
+        with self._lock:
+            self.istogrammi[passo].aggiungi(secondi)
+
+    def unisci(self, altre):
+        with self._lock, altre._lock:
+            for fase, valori in altre.fasi.items():
+                for chiave, valore in valori.items():
+                    self.fasi[fase][chiave] += valore
+            for nome, istogramma in altre.istogrammi.items():
+                self.istogrammi[nome].unisci(istogramma)
+
+    def come_dizionario(self, classi=False):
+        """Per fase e passo: totali (solo fasi) e latenze (vedi Istogramma.come_dizionario)."""
+        with self._lock:
+            risultato = {}
+            for nome, istogramma in self.istogrammi.items():
+                valori = istogramma.come_dizionario(classi)
+                if nome in self.fasi:
+                    valori.update({chiave: round(valore, 3) for chiave, valore in self.fasi[nome].items()})
+                risultato[nome] = valori
+            return risultato
+
+    def descrizione(self):
+        return ', '.join(
+            f"{fase} {v['lavoro']:.1f}s/{v['elementi']} (attesa ingresso {v['attesa_ingresso']:.1f}s, "
+            f"uscita {v['attesa_uscita']:.1f}s)" for fase, v in self.fasi.items()
+        )
+
+class MetricheIngestione:
+    """
+    Totali dell'esecuzione (o del processo worker con i shard) per Metriche_Esecuzioni e --profile:
+    statistiche per fase e istogrammi di tutte le pipeline, record letti, inseriti e scartati.
+    """
+
+    def __init__(self):
+        self.inizio = time.monotonic()
+        self.statistiche = StatisticheFasi()
+        self.letti = 0
+        self.inseriti = 0
+        self.scartati = Counter()
+        self._lock = threading.Lock()
+
+    def aggiungi(self, pipeline):
+        self.statistiche.unisci(pipeline.statistiche)
+        with self._lock:
+            self.letti += pipeline.letti
+            self.inseriti += pipeline.inseriti
+            self.scartati.update(pipeline.scartati)
+
+    def salva(self, id_esecuzione, cartella_profilo=None):
+        """
+        Scrive la riga di Metriche_Esecuzioni; con cartella_profilo scrive anche il profilo cProfile
+        (profilo_<id>.prof/.txt) e gli istogrammi delle fasi (fasi_<id>.json). Un errore non ferma main.
+        """
+        secondi = time.monotonic() - self.inizio
+        try:
+            metriche_store.salva(id_esecuzione, secondi, self.letti, self.inseriti, sum(self.scartati.values()),
+                                 self.statistiche.come_dizionario())
+        except Exception as e:
+            logger.warning("Salvataggio metriche non riuscito: %s", e)
+        if cartella_profilo is None:
+            return
+        os.makedirs(cartella_profilo, exist_ok=True)
+        suffisso = f'{id_esecuzione}_{os.getpid()}'
+        percorso = os.path.join(cartella_profilo, f'fasi_{suffisso}.json')
+        with open(percorso, 'w', encoding='utf-8') as f:
+            json.dump({'id_esecuzione': id_esecuzione, 'secondi': round(secondi, 3), 'letti': self.letti,
+                       'inseriti': self.inseriti, 'scartati': dict(self.scartati),
+                       'fasi': self.statistiche.come_dizionario(classi=True)}, f, indent=2)
+        logger.info("Istogrammi delle fasi: %s", percorso)
+        for nome, valori in self.statistiche.come_dizionario().items():
+            logger.info("  %-13s %6d misure, p50 %s ms, p95 %s ms, max %s ms", nome, valori['numero'],
+                        valori['p50_ms'], valori['p95_ms'], valori['massimo_ms'])
+        if profilatore.salva(os.path.join(cartella_profilo, f'profilo_{suffisso}')) is not None:
+            logger.info("Profilo cProfile: %s.prof (riepilogo in .txt)", os.path.join(cartella_profilo, f'profilo_{suffisso}'))
+
+class PipelineAzienda:
+    """
+    Elaborazione dei log di un singolo DSN (azienda) come pipeline di fasi collegate da code limitate:
+
+        estrazione     (thread)      blocchi di log letti con fetchmany (estrai_dati_da_dsn)
+        arricchimento  (thread)      trasmissioni e XML delle fatture non ancora recuperati (scarica_fatture)
+        parsing        (executor)    importi dagli XML, a blocchi, in un pool di processi
+        filtro         (chiamante)   filtri sui record e composizione dei blocchi da salvare
+        salvataggio    (thread)      salva_blocco: inserimento, riepilogo e checkpoint, nell'ordine di lettura
+
+    Ogni coda contiene al massimo DIMENSIONE_CODE elementi: una fase più lenta ferma quelle che la
+    alimentano (backpressure), quindi le fasi lavorano in parallelo, la velocità complessiva è
+    quella della fase più lenta e la memoria resta limitata. Se una fase fallisce le altre si fermano
+    ed esegui() rilancia l'errore. Tempi di lavoro e attese di ogni fase sono in statistiche.
+    """
+
+    def __init__(self, dsn_str, checkpoint, id_esecuzione, solo_ultima_modifica=False, avanzamento=None,
+                 executor_xml=None, semaforo_xml=None, id_documento_fine=None, avanza=None, metriche=None):
+        self.dsn_str = dsn_str
+        self.azienda = dsn_str.split('^')[0]
+        # Ultimo id_documento processato per questa azienda
+        self.last_id_documento = checkpoint.get(self.azienda, 0)
+        self.id_esecuzione = id_esecuzione
+        self.solo_ultima_modifica = solo_ultima_modifica
+        self.avanzamento = avanzamento or Avanzamento(id_esecuzione)
+        self.executor_xml = executor_xml
+        self.semaforo_xml = semaforo_xml
+        # Shard: fine dell'intervallo di id_documento e aggiornamento del watermark (vedi salva_blocco)
+        self.id_documento_fine = id_documento_fine
+        self.avanza = avanza
+        self.metriche = metriche  # MetricheIngestione dell'esecuzione, aggiornata al termine
+        self.statistiche = StatisticheFasi()
+        self.scartati = Counter()  # righe scartate per motivo
+        self.letti = 0
+        self.inseriti = 0
+        self._arresto = threading.Event()
+        self._errore = None
+        self._blocchi = CodaFase(DIMENSIONE_CODE, self._arresto)  # estrazione -> arricchimento
+        self._fatture = CodaFase(DIMENSIONE_CODE, self._arresto)  # arricchimento -> filtro
+        self._da_salvare = CodaFase(DIMENSIONE_CODE, self._arresto)  # filtro -> salvataggio
+
+    def _ferma(self, errore):
+        if self._errore is None:
+            self._errore = errore
+        self._arresto.set()
+
+    def _avvia(self, fase, funzione):
+        def esegui():
+            try:
+                profilatore.esegui(funzione)
+            except PipelineInterrotta:
+                pass
+            except BaseException as e:
+                self._ferma(e)
+        thread = threading.Thread(target=esegui, name=f'{fase}-{self.azienda}', daemon=True)
+        thread.start()
+        return thread
+
+    def _metti(self, coda, fase, elemento):
+        inizio = time.perf_counter()
+        coda.metti(elemento)
+        self.statistiche.aggiungi(fase, attesa_uscita=time.perf_counter() - inizio)
+
+    def _prendi(self, coda, fase):
+        inizio = time.perf_counter()
+        elemento = coda.prendi()
+        self.statistiche.aggiungi(fase, attesa_ingresso=time.perf_counter() - inizio)
+        return elemento
+
+    def esegui(self):
+        """Esegue la pipeline e ritorna il numero di record inseriti."""
+        logger.info("Inizio elaborazione per DSN: %s", self.dsn_str)
+        if self.last_id_documento > 0:
+            logger.info("Ripresa da id_documento > %s", self.last_id_documento)
+        self.avanzamento.aggiorna(self.azienda, salva=True, stato='in_corso',
+                                  inizio=datetime.now().isoformat(timespec='seconds'), letti=0, inseriti=0,
+                                  id_iniziale=self.last_id_documento, ultimo_id_documento=self.last_id_documento,
+                                  id_massimo=self.id_documento_fine or id_documento_massimo(self.dsn_str, self.last_id_documento))
+        self._inizio = time.monotonic()
+        thread = [self._avvia('estrazione', self._estrazione),
+                  self._avvia('arricchimento', self._arricchimento),
+                  self._avvia('salvataggio', self._salvataggio)]
+        try:
+            self._filtro()
+        except PipelineInterrotta:
+            pass
+        except BaseException as e:
+            self._ferma(e)
+        finally:
+            for t in thread:
+                t.join()
+        if self.metriche is not None:
+            self.metriche.aggiungi(self)
+        if self._errore is not None:
+            raise self._errore
+
+        # Azienda completata
+        self.avanzamento.aggiorna(self.azienda, salva=True, stato='completata', letti=self.letti,
+                                  inseriti=self.inseriti, scartati=dict(self.scartati),
+                                  fine=datetime.now().isoformat(timespec='seconds'))
+        log_throughput(self.azienda, self._inizio, self.letti, self.inseriti, self.scartati)
+        logger.info("Fasi azienda %s: %s", self.azienda, self.statistiche.descrizione())
+        logger.info("Azienda %s completata (%d record inseriti)", self.azienda, self.inseriti)
+        return self.inseriti
+
+    def _estrazione(self):
+        # Elabora i log a blocchi mentre la query li restituisce (memoria costante)
+        with closing(estrai_dati_da_dsn(self.dsn_str, self.last_id_documento,
+                                        id_documento_fine=self.id_documento_fine)) as blocchi:
+            while True:
+                inizio = time.perf_counter()
+                blocco = next(blocchi, _FINE)
+                self.statistiche.aggiungi('estrazione', elementi=0 if blocco is _FINE else len(blocco),
+                                          lavoro=time.perf_counter() - inizio)
+                self._metti(self._blocchi, 'estrazione', blocco)
+                if blocco is _FINE:
+                    return
+
+    def _arricchimento(self):
+        # id_reg_pd già richiesti in questa esecuzione, anche da blocchi non ancora arrivati al filtro
+        # copy(): con i shard più pipeline della stessa azienda aggiornano il dizionario insieme
+        richiesti = set(_fatture_esecuzione.get(self.dsn_str, {}).copy())
+        while True:
+            blocco = self._prendi(self._blocchi, 'arricchimento')
+            if blocco is _FINE:
+                self._metti(self._fatture, 'arricchimento', _FINE)
+                return
+            inizio = time.perf_counter()
+            # Recupera in blocco i dati fattura per gli id_reg_pd distinti del blocco non ancora recuperati
+            nuovi = {r.id_reg_pd for r in blocco if r.id_reg_pd and r.id_reg_pd > 0} - richiesti
+            richiesti |= nuovi
+            lotto = scarica_fatture(self.dsn_str, nuovi, executor=self.executor_xml, semaforo=self.semaforo_xml)
+            self.statistiche.aggiungi('arricchimento', elementi=len(nuovi), attesa_uscita=lotto.attesa_invio,
+                                      lavoro=time.perf_counter() - inizio - lotto.attesa_invio)
+            self._metti(self._fatture, 'arricchimento', (blocco, lotto))
+
+    def _salvataggio(self):
+        # Sessione SQLAlchemy propria: più aziende possono essere elaborate in parallelo
+        session = Session()
+        try:
+            while True:
+                elemento = self._prendi(self._da_salvare, 'salvataggio')
+                if elemento is _FINE:
+                    return
+                righe, id_documento_completato = elemento
+                inizio = time.perf_counter()
+                # Scrive i record accodati (record già presenti in DB esclusi) e avanza il checkpoint
+                tempi = {}
+                inseriti = salva_blocco(session, righe, self.id_esecuzione, self.azienda, id_documento_completato,
+                                        self.avanza, tempi)
+                self.inseriti += inseriti
+                self.statistiche.aggiungi('salvataggio', elementi=len(righe), lavoro=time.perf_counter() - inizio)
+                for passo, secondi in tempi.items():
+                    self.statistiche.misura(passo, secondi)
+                if righe:
+                    logger.debug("Inseriti %d/%d record (%d già presenti in DB)", inseriti, len(righe), len(righe) - inseriti)
+        finally:
+            session.close()
+
+    def _filtro(self):
+        azienda_name = azienda = self.azienda
+        solo_ultima_modifica = self.solo_ultima_modifica
+        scartati = self.scartati
+        memo = _fatture_esecuzione.setdefault(self.dsn_str, {})
+        debug = logger.isEnabledFor(logging.DEBUG)
+        prossimo_riepilogo = self._inizio + INTERVALLO_THROUGHPUT
+
+        # Record in attesa di essere scritti in blocco
+        buffer = []
+        in_attesa = []  # solo_ultima_modifica: ultima modifica valida del documento corrente
 
+        letti = 0
+        ultimo_letto = None  # id_documento dell'ultima riga letta dalla query
+        id_documento_corrente = None  # id_documento delle righe candidate in elaborazione
+        id_documento_completato = None  # ultimo id_documento con tutte le righe elaborate
+        while True:
+            elemento = self._prendi(self._fatture, 'filtro')
+            if elemento is _FINE:
+                break
+            blocco, lotto = elemento
+            inizio = time.perf_counter()
+            trovate = lotto.risultati()
+            for id_reg_pd in lotto.interrogati:
+                memo[id_reg_pd] = trovate.get(id_reg_pd, (None, None))
+            self.statistiche.aggiungi('parsing', elementi=lotto.analizzati, lavoro=lotto.secondi_analisi)
 
+            # Prima passata: filtri che non richiedono i dati fattura
+            candidati = []
+            for record in blocco:
+                letti += 1
+                ultimo_letto = record.id_documento
+                if debug:
+                    logger.debug("[%d] id_documento=%s id_reg_pd=%s", letti, record.id_documento, record.id_reg_pd)
+
+                # Checkpoint e anno minimo sono già applicati dalla query
+                id_reg_pd = record.id_reg_pd
+                # Verifica che la commessa sia stata fatturata (id_reg_pd > 0)
+                if not id_reg_pd or id_reg_pd <= 0:
+                    scartati['id_reg_pd_mancante'] += 1
+                    if debug:
+                        logger.debug("  -> SKIP: id_reg_pd mancante o <= 0")
+                    continue
+                candidati.append(record)
+
+            # Importi delle note dei candidati, in un solo passaggio
+            importi_log = extract_importi([record.note for record in candidati])
+            for record, importo_log in zip(candidati, importi_log):
+                # Le righe arrivano ordinate per id_documento: al cambio, il documento precedente è completo
+                if record.id_documento != id_documento_corrente:
+                    id_documento_completato = id_documento_corrente
+                    id_documento_corrente = record.id_documento
+                    buffer.extend(in_attesa)
+                    in_attesa.clear()
+                id_reg_pd = record.id_reg_pd
+                # Dati fattura (data trasmissione e importo fattura) dal recupero batch
+                data_trasmissione, importo_fattura = memo.get(id_reg_pd, (None, None))
+                if not data_trasmissione:
+                    scartati['fattura_non_trasmessa'] += 1
+                    if debug:
+                        logger.debug("  -> SKIP: data_trasmissione non trovata per id_reg_pd=%s", id_reg_pd)
+                    continue
+                data_modifica = parse_data(record.data_modifica)
+                data_trasmissione = parse_data(data_trasmissione)
+                # Controlla validità delle date
+                if not data_modifica:
+                    scartati['data_modifica_non_valida'] += 1
+                    if debug:
+                        logger.debug("  -> SKIP: data_modifica non valida: %s", record.data_modifica)
+                    continue
+                if not data_trasmissione:
+                    scartati['data_trasmissione_non_valida'] += 1
+                    if debug:
+                        logger.debug("  -> SKIP: data_trasmissione non valida: %s", data_trasmissione)
+                    continue
+                if data_modifica >= data_trasmissione:
+                    scartati['modifica_dopo_trasmissione'] += 1
+                    if debug:
+                        logger.debug("  -> SKIP: data_modifica >= data_trasmissione (%s >= %s)", data_modifica, data_trasmissione)
+                    continue
+                # Importo log estratto dalle note
+                if importo_log is None:
+                    scartati['importo_log_mancante'] += 1
+                    if debug:
+                        logger.debug("  -> SKIP: importo_log non trovato nelle note")
+                    continue
+                # Accoda il record per il salvataggio in blocco
+                if debug:
+                    logger.debug("Accodo log per id_documento %s, id_reg_pd %s, azienda %s | importo_log: %s",
+                                 record.id_documento, id_reg_pd, azienda, importo_log)
+                if solo_ultima_modifica:
+                    # Le righe del documento sono ordinate per data_operazione: la successiva sostituisce questa
+                    in_attesa.clear()
+                (in_attesa if solo_ultima_modifica else buffer).append(
+                    parametri_storico(record, azienda, data_modifica, importo_log, importo_fattura, data_trasmissione))
+                if len(buffer) >= INSERT_BATCH_SIZE:
+                    self._metti(self._da_salvare, 'filtro', (buffer, id_documento_completato))
+                    buffer = []
+
+            self.letti = letti
+            self.statistiche.aggiungi('filtro', elementi=len(blocco), attesa_ingresso=lotto.attesa_risultati,
+                                      lavoro=time.perf_counter() - inizio - lotto.attesa_risultati)
+            self.avanzamento.aggiorna(azienda_name, letti=letti, inseriti=self.inseriti, ultimo_id_documento=ultimo_letto,
+                                      scartati=dict(scartati))
+            if time.monotonic() >= prossimo_riepilogo:
+                prossimo_riepilogo = time.monotonic() + INTERVALLO_THROUGHPUT
+                log_throughput(azienda_name, self._inizio, letti, self.inseriti, scartati)
+                logger.info("Code azienda %s: blocchi %s, fatture %s, da salvare %s", azienda_name,
+                            self._blocchi.occupazione(), self._fatture.occupazione(), self._da_salvare.occupazione())
+
+        # Salva gli ultimi record accodati: tutte le righe lette sono elaborate
+        buffer.extend(in_attesa)
+        self._metti(self._da_salvare, 'filtro', (buffer, ultimo_letto))
+        self._metti(self._da_salvare, 'filtro', _FINE)
+
+def crea_executor_xml(processi=PROCESSI_XML):
+    """
+    Executor per l'analisi degli XML delle fatture: pool di processi avviati con 'spawn'
+    (come su Windows; niente fork di un processo con thread e connessioni aperte),
+    oppure un solo thread se processi = 0.
+    """
+    if processi > 0:
+        return ProcessPoolExecutor(processi, mp_context=multiprocessing.get_context('spawn'))
+    return ThreadPoolExecutor(1, thread_name_prefix='analisi-xml')
+
+def elabora_azienda(dsn_str, checkpoint, id_esecuzione, solo_ultima_modifica=False, avanzamento=None,
+                    executor_xml=None, semaforo_xml=None, metriche=None):
+    """
+    Estrae, arricchisce e salva i log di un singolo DSN (azienda) con una PipelineAzienda.
+    Usa una propria sessione SQLAlchemy, così più aziende possono essere elaborate
+    in parallelo. Ritorna il numero di record inseriti.
+    Il checkpoint avanza solo su id_documento elaborati completamente (tutte le loro righe
+    di log lette), quindi la ripresa dopo un'interruzione non salta né ripete righe.
+    Con solo_ultima_modifica salva per ogni id_documento solo l'ultima modifica valida
+    precedente alla trasmissione (l'unica mostrata dalla dashboard).
+    L'avanzamento (Avanzamento condiviso da main, altrimenti uno per la sola azienda) viene aggiornato a ogni blocco letto.
+    Gli XML vengono analizzati con executor_xml (vedi crea_executor_xml), altrimenti nel thread che li scarica.
+    Tempi per fase e record vengono sommati in metriche (MetricheIngestione), se indicato.
+    """
+    return PipelineAzienda(dsn_str, checkpoint, id_esecuzione, solo_ultima_modifica, avanzamento,
+                           executor_xml, semaforo_xml, metriche=metriche).esegui()
+
+def elabora_shard(shard, dsn_str, solo_ultima_modifica=False, executor_xml=None, semaforo_xml=None, metriche=None):
+    """
+    Elabora un shard reclamato da Lease_Ingestione (log dell'azienda con shard.ultimo_id_documento < id_documento
+    <= shard.id_a) con una PipelineAzienda. Il watermark del shard avanza nella transazione di ogni blocco salvato
+    e un Heartbeat rinnova il lease; se il lease viene perso la pipeline si ferma con LeaseScaduto.
+    Ritorna il numero di record letti.
+    """
+    pipeline = PipelineAzienda(
+        dsn_str, {shard.azienda: shard.ultimo_id_documento}, shard.id_esecuzione, solo_ultima_modifica,
+        Avanzamento(None), executor_xml, semaforo_xml, id_documento_fine=shard.id_a,
+        avanza=lambda conn, ultimo_id_documento, inseriti: lease_store.avanza(conn, shard, ultimo_id_documento, inseriti),
+        metriche=metriche
+    )
+    perso = lambda: pipeline._ferma(LeaseScaduto(f"Lease del shard {shard.id} ({shard.azienda}) perso"))
+    aggiorna = lambda: checkpoint_store.salva_avanzamento(shard.id_esecuzione, lease_store.stato(shard.id_esecuzione))
+    with Heartbeat(lease_store, shard, perso, aggiorna):
+        pipeline.esegui()
+    return pipeline.letti
+
+def lavora_shard(id_esecuzione, numero, dsn_per_azienda, solo_ultima_modifica=False, executor_xml=None,
+                 semaforo_xml=None, metriche=None):
+    """
+    Worker: reclama ed elabora i shard dell'esecuzione per le aziende configurate (dsn_per_azienda)
+    finché ce ne sono. Se i shard rimasti sono assegnati ad altri worker attende ATTESA_SHARD secondi
+    e riprova, così riprende quelli il cui lease scade (worker fermato). Ritorna i shard elaborati.
+    """
+    worker = nome_worker(numero)
+    elaborati = 0
+    while True:
+        shard = lease_store.reclama(id_esecuzione, worker, dsn_per_azienda)
+        if shard is None:
+            aziende = lease_store.stato(id_esecuzione)['aziende']
+            if all(valori['stato'] != 'in_corso' for azienda, valori in aziende.items() if azienda in dsn_per_azienda):
+                return elaborati
+            time.sleep(ATTESA_SHARD)
+            continue
+        logger.info("Worker %s: shard %d, azienda %s, id_documento %d-%d (da %d)", worker, shard.id, shard.azienda,
+                    shard.id_da + 1, shard.id_a, shard.ultimo_id_documento + 1)
+        try:
+            letti = elabora_shard(shard, dsn_per_azienda[shard.azienda], solo_ultima_modifica, executor_xml, semaforo_xml,
+                                  metriche)
+        except LeaseScaduto as e:
+            # Il shard è ora di un altro worker, che riparte dal watermark salvato
+            logger.warning("%s: shard abbandonato", e)
+        except Exception as e:
+            logger.error("Shard %d (%s) fallito: %s", shard.id, shard.azienda, e)
+            lease_store.fallisce(shard, e)
+        else:
+            if not lease_store.completa(shard, letti):
+                logger.warning("Shard %d (%s) elaborato dopo la scadenza del lease", shard.id, shard.azienda)
+        elaborati += 1
+        checkpoint_store.salva_avanzamento(id_esecuzione, lease_store.stato(id_esecuzione))
+
+def chiudi_esecuzione_shard(id_esecuzione):
+    """
+    Chiude l'esecuzione a shard se nessun shard è ancora da elaborare: completata, oppure errore
+    se qualche shard ha esaurito i tentativi. Ritorna lo stato dell'esecuzione ('in_corso' se resta aperta).
+    """
+    aziende = lease_store.stato(id_esecuzione)['aziende']
+    stati = {valori['stato'] for valori in aziende.values()}
+    if 'in_corso' in stati:
+        return 'in_corso'
+    stato = 'errore' if 'errore' in stati else 'completata'
+    record_inseriti = {azienda: valori['inseriti'] for azienda, valori in aziende.items()}
+    dettaglio = {'record_inseriti': record_inseriti, 'aziende': aziende,
+                 'errori': {azienda: valori['errore'] for azienda, valori in aziende.items() if 'errore' in valori}}
+    checkpoint_store.chiudi_esecuzione(id_esecuzione, stato, sum(record_inseriti.values()), dettaglio)
+    return stato
+
+def esegui_shard(args, dsn_list):
+    """
+    Ingestione distribuita (vedi shard.LeaseStore): con --coordinatore registra l'esecuzione e la divide
+    in shard per azienda e intervallo di id_documento (AMPIEZZA_SHARD id_documento ciascuno); con --worker
+    elabora i shard dell'esecuzione (--id-esecuzione, altrimenti l'ultima aperta) con --workers thread.
+    I worker possono essere avviati in qualsiasi numero, su questo o altri host con lo stesso database
+    di destinazione; l'ultimo che termina chiude l'esecuzione. Ogni processo worker registra le proprie
+    metriche in Metriche_Esecuzioni (e con --profile il proprio profilo).
+    """
+    id_esecuzione = args.id_esecuzione
+    if args.worker:
+        # I thread worker possono elaborare insieme shard della stessa azienda, con lo stesso pool
+        dimensiona_pool(max(1, args.workers))
+    if args.coordinatore:
+        id_esecuzione = checkpoint_store.avvia_esecuzione(args.id_esecuzione)
+        intervalli = []
+        for dsn_str in dsn_list:
+            azienda = dsn_str.split('^')[0]
+            id_minimo, id_massimo = intervallo_id_documento(dsn_str)
+            intervalli += dividi_intervallo(azienda, id_minimo, id_massimo, AMPIEZZA_SHARD)
+        creati = lease_store.crea_shard(id_esecuzione, intervalli)
+        logger.info("Esecuzione %s: %d shard creati per %d aziende", id_esecuzione, creati, len(dsn_list))
+        checkpoint_store.salva_avanzamento(id_esecuzione, lease_store.stato(id_esecuzione))
+    elif id_esecuzione is None:
+        id_esecuzione = lease_store.esecuzione_aperta()
+        if id_esecuzione is None:
+            logger.info("Nessuna esecuzione a shard da elaborare")
+            return
+
+    if args.worker:
+        dsn_per_azienda = {dsn_str.split('^')[0]: dsn_str for dsn_str in dsn_list}
+        executor_xml = crea_executor_xml()
+        semaforo_xml = threading.BoundedSemaphore(ANALISI_IN_CORSO)
+        metriche = MetricheIngestione()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+                futures = [executor.submit(profilatore.esegui, lavora_shard, id_esecuzione, numero, dsn_per_azienda,
+                                           args.solo_ultima_modifica, executor_xml, semaforo_xml, metriche)
+                           for numero in range(max(1, args.workers))]
+                elaborati = sum(future.result() for future in futures)
+            logger.info("Esecuzione %s: %d shard elaborati da questo processo", id_esecuzione, elaborati)
+        finally:
+            executor_xml.shutdown(cancel_futures=True)
+            close_pools()
+            _fatture_esecuzione.clear()
+            metriche.salva(id_esecuzione, args.profile)
+
+    stato = chiudi_esecuzione_shard(id_esecuzione)
+    logger.info("Esecuzione %s: %s", id_esecuzione, stato)
+    if stato == 'errore':
+        raise RuntimeError(f"Esecuzione {id_esecuzione}: shard falliti dopo {lease_store.tentativi} tentativi")
 
 def main():
 
@@ -173,169 +1257,150 @@ def main():
 
     Funzionalità:
     - Estrae i log delle modifiche da Infinity tramite query SQL.
-    - Per ogni log, recupera la data di trasmissione e l'importo fattura dal file XML associato.
+    - Recupera in blocco (query a IN-list da batch_size chiavi) la data di trasmissione e l'importo fattura dal file XML associato.
     - Salva nel database tutti i dati rilevanti, compresi importi log, importo fattura, targa, ecc.
-    - Stampa dettagliate informazioni di debug per ogni step. 
-    - Usa un checkpoint JSON per riprendere in caso di interruzione.
+    - Scrive il log con il modulo logging (livello da --log-level o [LOG] livello, default INFO): con DEBUG
+      il dettaglio di ogni record, altrimenti per azienda una riga periodica con velocità e record scartati
+      per motivo (ogni [LOG] intervallo_throughput secondi).
+    - All'avvio applica le migrazioni dello schema mancanti (migrations.py: tabelle e indici).
+    - Usa un checkpoint su database (Checkpoint_Ingestione) per riprendere in caso di interruzione
+      e registra ogni esecuzione in Storico_Esecuzioni.
+    - Con --workers N elabora fino a N aziende in parallelo (default: [SOURCE_INFINITY] workers, altrimenti 1).
+    - Ogni azienda è elaborata da una pipeline (PipelineAzienda: estrazione, arricchimento, parsing XML in un pool
+      di processi, filtro e salvataggio in parallelo, collegati da code limitate; sezione [PIPELINE]).
+    - Ogni id_reg_pd viene recuperato una sola volta per esecuzione; con --solo-ultima-modifica salva solo
+      l'ultima modifica valida di ogni id_documento.
+    - Salva l'avanzamento per azienda in Storico_Esecuzioni (letto da /jobs/<id> della dashboard, che avvia
+      main.py con --id-esecuzione).
+    - Mantiene Riepilogo_Modifiche_Fatture (totali per azienda, mese e utente letti dalla dashboard);
+      con --ricostruisci-riepilogo lo ricalcola da zero.
+    - Con --coordinatore e --worker l'ingestione è divisa in shard (azienda e intervallo di id_documento)
+      elaborati da più processi, anche su host diversi (Lease_Ingestione, vedi esegui_shard e shard.py).
+    - Al termine registra le metriche dell'esecuzione in Metriche_Esecuzioni (durata, record, tempi e percentili
+      delle latenze per fase, lette da /metrics della dashboard); con --profile [CARTELLA] scrive anche
+      il profilo cProfile e gli istogrammi delle latenze per fase (default: cartella profili).
 
     Dipendenze: pyodbc, sqlalchemy, configparser
     Configurazione: vedi config.ini per parametri di connessione.
     """
-    # Carica checkpoint se esiste
-    checkpoint = {}
-    if os.path.exists(CHECKPOINT_FILE):
-        with open(CHECKPOINT_FILE, 'r') as f:
-            checkpoint = json.load(f)
-        print(f"[INFO] Checkpoint caricato: {checkpoint}")
-    
-    # Avvio script e creazione sessione DB
-    print("[INFO] Avvio script di estrazione e salvataggio dati\n")
-    session = Session()  # Crea una nuova sessione SQLAlchemy per il database
+    parser = argparse.ArgumentParser(description='Controllo modifiche importi commesse')
+    parser.add_argument('--workers', type=int, default=config.getint('SOURCE_INFINITY', 'workers', fallback=1),
+                        help='numero di aziende elaborate in parallelo')
+    parser.add_argument('--solo-ultima-modifica', action='store_true',
+                        default=config.getboolean('SOURCE_INFINITY', 'solo_ultima_modifica', fallback=False),
+                        help="salva per ogni id_documento solo l'ultima modifica precedente alla trasmissione")
+    parser.add_argument('--ricostruisci-riepilogo', action='store_true',
+                        help='ricalcola Riepilogo_Modifiche_Fatture da Storico_Modifiche_Fatture prima di elaborare')
+    parser.add_argument('--id-esecuzione', type=int, default=None,
+                        help="id dell'esecuzione già accodata in Storico_Esecuzioni (avvio dalla dashboard)")
+    parser.add_argument('--coordinatore', action='store_true',
+                        help="divide l'esecuzione in shard (azienda e intervallo di id_documento) in Lease_Ingestione")
+    parser.add_argument('--worker', action='store_true',
+                        help="elabora i shard dell'esecuzione (--id-esecuzione, altrimenti l'ultima aperta) "
+                             "con --workers thread; combinabile con --coordinatore")
+    parser.add_argument('--profile', nargs='?', const='profili', default=None, metavar='CARTELLA',
+                        help="scrive nella cartella (default: profili) il profilo cProfile e gli istogrammi "
+                             "delle latenze per fase dell'esecuzione")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], type=str.upper,
+                        help='livello di log (default: [LOG] livello, altrimenti INFO)')
+    args = parser.parse_args()
+    configura_logging(config, args.log_level)
+    if args.profile is not None:
+        profilatore.avvia()
+    global cache_fatture
+    cache_fatture = CacheFatture.da_config(config)
+
+    # Porta lo schema all'ultima versione (tabelle e indici, vedi migrations.py)
+    try:
+        applica_migrazioni(engine)
+    except DoppioniChiaveNaturale as e:
+        logger.error("%s", e)
+        parser.exit(1)
+
     source_conf = config['SOURCE_INFINITY']  # Legge la sezione di configurazione per le sorgenti Infinity
     dsn_list = [dsn.strip() for dsn in source_conf['dsn'].split(',') if dsn.strip()]  # Lista dei DSN configurati
-    totale = 0  # Contatore dei record salvati
-
-    # Ciclo su ogni DSN (azienda/sorgente)
-    for dsn_str in dsn_list:
-        azienda_name = dsn_str.split('^')[0]
-        
-        # Recupera l'ultimo id_documento processato per questa azienda
-        last_id_documento = checkpoint.get(azienda_name, 0)
-        
-        print(f"[INFO] Inizio elaborazione per DSN: {dsn_str}")
-        if last_id_documento > 0:
-            print(f"[INFO] Ripresa da id_documento > {last_id_documento}")
-
-        records = estrai_dati_da_dsn(dsn_str)  # Estrae tutti i log per questo DSN (azienda)
-        print(f"[DEBUG] Numero record estratti da DSN {dsn_str}: {len(records)}")
-        for idx, (azienda, odbc_conn_str, record) in enumerate(records):
-            # Stampa info base su ogni record
-            print(f"[DEBUG] [{idx+1}/{len(records)}] id_documento={record.get('id_documento')} id_reg_pd={record.get('id_reg_pd')}")
-            
-            # Salta record già processati (checkpoint)
-            id_documento_current = record.get('id_documento')
-            if id_documento_current <= last_id_documento:
-                continue
-            
-            # Filtro anno in Python: CV dal 2024, altri dal 2025
-            anno = record.get('anno')
-            if azienda == 'CV':
-                if anno is not None and int(anno) < 2024:
-                    continue
-            else:
-                if anno is not None and int(anno) < 2025:
-                    continue
-            
-            id_reg_pd = record.get('id_reg_pd')
-            # Verifica che la commessa sia stata fatturata (id_reg_pd > 0)
-            if not id_reg_pd or id_reg_pd <= 0:
-                print(f"[DEBUG]   -> SKIP: id_reg_pd mancante o <= 0")
-                continue
-            # Recupera dati fattura (data trasmissione e importo fattura)
-            data_trasmissione, importo_fattura = get_fattura_data(odbc_conn_str, id_reg_pd)
-            if not data_trasmissione:
-                print(f"[DEBUG]   -> SKIP: data_trasmissione non trovata per id_reg_pd={id_reg_pd}")
-                continue
-            data_modifica = record.get('data_modifica')
-            # Funzione di utilità per convertire vari formati data in datetime
-            def parse_data(val):
-                if not val:
-                    return None
-                if isinstance(val, datetime):
-                    return val
-                s = str(val)
+    if args.coordinatore or args.worker:
+        if args.coordinatore and (args.ricostruisci_riepilogo or riepilogo_store.da_ricostruire()):
+            logger.info("Riepilogo ricostruito: %d gruppi", riepilogo_store.ricostruisci())
+        try:
+            esegui_shard(args, dsn_list)
+        finally:
+            if cache_fatture is not None:
+                cache_fatture.chiudi()
+                cache_fatture = None
+        return
+
+    # Carica il checkpoint lasciato da un'esecuzione interrotta (se esiste) e registra l'esecuzione
+    checkpoint = checkpoint_store.carica()
+    if checkpoint:
+        logger.info("Checkpoint caricato: %s", checkpoint)
+    id_esecuzione = checkpoint_store.avvia_esecuzione(args.id_esecuzione)
+    avanzamento = Avanzamento(id_esecuzione)
+
+    # Il riepilogo viene aggiornato a ogni blocco; va ricalcolato solo se richiesto o se manca
+    if args.ricostruisci_riepilogo or riepilogo_store.da_ricostruire():
+        logger.info("Riepilogo ricostruito: %d gruppi", riepilogo_store.ricostruisci())
+
+    # Avvio script
+    logger.info("Avvio script di estrazione e salvataggio dati (esecuzione %s)", id_esecuzione)
+    workers = max(1, min(args.workers, len(dsn_list) or 1))
+    totali_per_azienda = {}  # Record salvati per azienda
+    errori = {}  # Eccezioni per azienda
+
+    # Analisi degli XML condivisa dalle aziende, con al massimo ANALISI_IN_CORSO blocchi in attesa o in analisi
+    executor_xml = crea_executor_xml()
+    semaforo_xml = threading.BoundedSemaphore(ANALISI_IN_CORSO)
+    metriche = MetricheIngestione()
+
+    # Ogni DSN (azienda/sorgente) è un database indipendente: con workers > 1 vengono elaborati in parallelo
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(profilatore.esegui, elabora_azienda, dsn_str, checkpoint, id_esecuzione,
+                                       args.solo_ultima_modifica, avanzamento, executor_xml, semaforo_xml,
+                                       metriche): dsn_str.split('^')[0]
+                       for dsn_str in dsn_list}
+            for future in as_completed(futures):
+                azienda_name = futures[future]
                 try:
-                    return datetime.fromisoformat(s)
-                except Exception:
-                    pass
-                if s.isdigit() and len(s) == 8:
-                    try:
-                        return datetime.strptime(s, '%Y%m%d')
-                    except Exception:
-                        pass
-                return None
-            data_modifica = parse_data(data_modifica)
-            data_trasmissione = parse_data(data_trasmissione)
-            # Controlla validità delle date
-            if not data_modifica:
-                print(f"[DEBUG]   -> SKIP: data_modifica non valida: {record.get('data_modifica')}")
-                continue
-            if not data_trasmissione:
-                print(f"[DEBUG]   -> SKIP: data_trasmissione non valida: {data_trasmissione}")
-                continue
-            if data_modifica >= data_trasmissione:
-                print(f"[DEBUG]   -> SKIP: data_modifica >= data_trasmissione ({data_modifica} >= {data_trasmissione})")
-                continue
-            # Filtro anno in Python: CV dal 2024, altri dal 2025
-            anno = record.get('anno')
-            if azienda == 'CV':
-                if anno is not None and int(anno) < 2024:
-                    continue
-            else:
-                if anno is not None and int(anno) < 2025:
-                    continue
-            # Estrai importo log dalle note
-            importo_log = extract_importo(record.get('note'))
-            if importo_log is None:
-                print(f"[DEBUG]   -> SKIP: importo_log non trovato nelle note")
-                continue
-            # Salva il record nel database
-            print(f"[INFO] Salvo log per id_documento {record.get('id_documento')}, id_reg_pd {id_reg_pd}, azienda {azienda} | importo_log: {importo_log}")
-            nuovo_record = StoricoModificheFatture(
-                id_documento=record.get('id_documento'),
-                anno=record.get('anno'),
-                id_cliente=record.get('id_cliente'),
-                tipo_doc=record.get('tipo_doc'),
-                data_doc=record.get('data_doc'),
-                num_doc=record.get('num_doc'),
-                tipo_fattura=record.get('tipo_fattura'),
-                data_fattura=record.get('data_fattura'),
-                numero_fattura=record.get('numero_fattura'),
-                tipo_pagamento=record.get('tipo_pagamento'),
-                id_hst=record.get('id_hst'),
-                nome_tabella=record.get('nome_tabella'),
-                utente=record.get('utente'),
-                tipo_operazione=record.get('tipo_operazione'),
-                note=record.get('note'),
-                data_modifica=data_modifica,
-                azienda=azienda,
-                importo_modifica=importo_log,
-                importo_fattura=importo_fattura,
-                id_reg_pd=id_reg_pd,
-                data_trasmissione_fattura=data_trasmissione,
-                targa=record.get('targa')
-            )
-            # Salta se il record è già presente (stesso id_documento, id_reg_pd, azienda, data_modifica)
-            exists = session.query(StoricoModificheFatture).filter_by(
-                id_documento=record.get('id_documento'),
-                id_reg_pd=id_reg_pd,
-                azienda=azienda,
-                data_modifica=data_modifica
-            ).first()
-            if exists:
-                print(f"[DEBUG]   -> SKIP: record già presente in DB (id_documento={record.get('id_documento')}, id_reg_pd={id_reg_pd}, azienda={azienda}, data_modifica={data_modifica})")
-                continue
-            session.add(nuovo_record)  # Aggiunge il record alla sessione
-            session.commit()  # Commit immediato per ogni record
-            totale += 1  # Incrementa il contatore dei record salvati
-            
-            # Aggiorna checkpoint dopo ogni record salvato
-            checkpoint[azienda_name] = id_documento_current
-            with open(CHECKPOINT_FILE, 'w') as f:
-                json.dump(checkpoint, f, indent=2)
-        
-        # Azienda completata
-        print(f"[INFO] Azienda {azienda_name} completata")
+                    totali_per_azienda[azienda_name] = future.result()
+                except Exception as e:
+                    logger.error("Elaborazione azienda %s fallita: %s", azienda_name, e)
+                    errori[azienda_name] = e
+                    avanzamento.aggiorna(azienda_name, salva=True, stato='errore')
+    except BaseException:
+        # Es. Ctrl+C: l'esecuzione resta nello storico come interrotta, il checkpoint è già coerente
+        checkpoint_store.chiudi_esecuzione(id_esecuzione, 'interrotta', sum(totali_per_azienda.values()),
+                                           {'record_inseriti': totali_per_azienda})
+        raise
+    finally:
+        executor_xml.shutdown(cancel_futures=True)
+        close_pools()  # Chiude le connessioni verso le sorgenti Infinity
+        _fatture_esecuzione.clear()
+        if cache_fatture is not None:
+            cache_fatture.chiudi()  # Applica l'eviction e chiude la cache fatture
+            cache_fatture = None
+        metriche.salva(id_esecuzione, args.profile)
 
-    session.close()  # Chiude la sessione del database
-    
-    # Rimuove il checkpoint alla fine (successo completo)
-    if os.path.exists(CHECKPOINT_FILE):
-        os.remove(CHECKPOINT_FILE)
-        print(f"[INFO] Checkpoint rimosso: elaborazione completata")
-    
-    print(f"\n[INFO] Tutti i record ({totale}) sono stati inseriti con successo!")
-    print("[INFO] Fine script\n")
+    # Riepilogo per azienda
+    logger.info("Riepilogo record inseriti per azienda:")
+    for azienda_name in sorted(totali_per_azienda):
+        logger.info("  %s: %d", azienda_name, totali_per_azienda[azienda_name])
+    totale = sum(totali_per_azienda.values())
+
+    dettaglio = {'record_inseriti': totali_per_azienda, 'errori': {az: str(e) for az, e in errori.items()},
+                 'aziende': avanzamento.stato()['aziende']}
+    if errori:
+        # Il checkpoint resta nel database: la prossima esecuzione riprende dalle aziende interrotte
+        checkpoint_store.chiudi_esecuzione(id_esecuzione, 'errore', totale, dettaglio)
+        logger.error("Elaborazione terminata con errori per: %s (%d record inseriti)", ', '.join(sorted(errori)), totale)
+        raise next(iter(errori.values()))
+
+    # Chiude l'esecuzione e rimuove il checkpoint (successo completo)
+    checkpoint_store.chiudi_esecuzione(id_esecuzione, 'completata', totale, dettaglio)
+    logger.info("Checkpoint rimosso: elaborazione completata")
+
+    logger.info("Tutti i record (%d) sono stati inseriti con successo!", totale)
+    logger.info("Fine script")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,256 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import socket
+import sys
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime
+
+from sqlalchemy import event, insert, select
+
+from models import MetricheEsecuzione
+
+logger = logging.getLogger(__name__)
+
+# Da Python 3.12 cProfile usa sys.monitoring: un solo profilo attivo per processo, che vede tutti i thread
+PROFILO_PER_PROCESSO = sys.version_info >= (3, 12)
+
+# Limiti superiori (millisecondi) delle classi degli istogrammi di latenza; l'ultima classe è oltre 60 s
+LIMITI_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class Istogramma:
+    """
+    Istogramma di latenze a classi fisse (LIMITI_MS) con numero, totale e massimo.
+    I percentili sono stimati con il limite superiore della classe (il massimo per l'ultima).
+    Non è thread-safe: lo protegge chi lo contiene.
+    """
+
+    def __init__(self):
+        self.conteggi = [0] * (len(LIMITI_MS) + 1)
+        self.numero = 0
+        self.totale = 0.0
+        self.massimo = 0.0
+
+    def aggiungi(self, secondi):
+        self.conteggi[bisect_left(LIMITI_MS, secondi * 1000)] += 1
+        self.numero += 1
+        self.totale += secondi
+        self.massimo = max(self.massimo, secondi)
+
+    def unisci(self, altro):
+        self.conteggi = [a + b for a, b in zip(self.conteggi, altro.conteggi)]
+        self.numero += altro.numero
+        self.totale += altro.totale
+        self.massimo = max(self.massimo, altro.massimo)
+
+    def percentile(self, p):
+        """Percentile p (0-100) in millisecondi, None se vuoto."""
+        if not self.numero:
+            return None
+        soglia = self.numero * p / 100
+        cumulato = 0
+        for limite, conteggio in zip(LIMITI_MS, self.conteggi):
+            cumulato += conteggio
+            if cumulato >= soglia:
+                return round(float(min(limite, self.massimo * 1000)), 1)
+        return round(self.massimo * 1000, 1)
+
+    def come_dizionario(self, classi=True):
+        risultato = {
+            'numero': self.numero,
+            'totale_s': round(self.totale, 3),
+            'media_ms': round(self.totale * 1000 / self.numero, 1) if self.numero else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'massimo_ms': round(self.massimo * 1000, 1),
+        }
+        if classi:
+            etichette = [f'<={limite}ms' for limite in LIMITI_MS] + [f'>{LIMITI_MS[-1]}ms']
+            risultato['classi'] = {e: n for e, n in zip(etichette, self.conteggi) if n}
+        return risultato
+
+
+class Profilatore:
+    """
+    cProfile per più thread, attivato con avvia(). Fino a Python 3.11 cProfile misura solo il thread
+    in cui è attivo: ogni funzione avviata con esegui() in un thread ha il proprio profilo, uniti da
+    salva(). Da Python 3.12 può essere attivo un solo profilo per processo, che misura già tutti i
+    thread: avvia() lo attiva ed esegui() chiama solo la funzione. Se il profilo non può essere
+    attivato (es. un altro profiler in uso) l'esecuzione continua senza profilo.
+    L'analisi degli XML nei processi del pool non compare nel profilo: il suo tempo è negli
+    istogrammi della fase parsing.
+    """
+
+    def __init__(self):
+        self.attivo = False
+        self._lock = threading.Lock()
+        self._profili = []
+        self._processo = None  # profilo unico del processo (Python 3.12+)
+
+    def avvia(self):
+        self.attivo = True
+        if PROFILO_PER_PROCESSO:
+            self._processo = self._abilita()
+            self.attivo = self._processo is not None
+
+    def _abilita(self):
+        profilo = cProfile.Profile()
+        try:
+            profilo.enable()
+        except ValueError as e:
+            logger.warning("Profilo cProfile non attivato: %s", e)
+            return None
+        with self._lock:
+            self._profili.append(profilo)
+        return profilo
+
+    def esegui(self, funzione, *args, **kwargs):
+        if not self.attivo or PROFILO_PER_PROCESSO:
+            return funzione(*args, **kwargs)
+        profilo = self._abilita()
+        try:
+            return funzione(*args, **kwargs)
+        finally:
+            if profilo is not None:
+                profilo.disable()
+
+    def salva(self, percorso, righe=40):
+        """
+        Scrive percorso.prof (pstats, es. per snakeviz) e percorso.txt con le prime righe funzioni per
+        tempo cumulativo. Ritorna il testo del riepilogo, None se non c'è nessun profilo.
+        """
+        if self._processo is not None:
+            self._processo.disable()
+            self._processo = None
+        with self._lock:
+            profili = [profilo for profilo in self._profili if profilo.getstats()]
+        if not profili:
+            return None
+        statistiche = pstats.Stats(profili[0])
+        for profilo in profili[1:]:
+            statistiche.add(profilo)
+        statistiche.dump_stats(f'{percorso}.prof')
+        testo = io.StringIO()
+        pstats.Stats(f'{percorso}.prof', stream=testo).sort_stats('cumulative').print_stats(righe)
+        with open(f'{percorso}.txt', 'w', encoding='utf-8') as f:
+            f.write(testo.getvalue())
+        return testo.getvalue()
+
+
+class MetricheStore:
+    """
+    Metriche_Esecuzioni: una riga per ogni esecuzione di main.py (una per processo worker con i shard)
+    con durata, record letti/inseriti/scartati e, per fase della pipeline, secondi di lavoro e
+    di attesa e percentili delle latenze. Lette da /metrics della dashboard.
+    """
+
+    def __init__(self, session_factory):
+        self.Session = session_factory
+
+    def salva(self, id_esecuzione, secondi, letti, inseriti, scartati, fasi):
+        with self.Session() as session, session.begin():
+            session.execute(insert(MetricheEsecuzione).values(
+                id_esecuzione=id_esecuzione, processo=f'{socket.gethostname()}:{os.getpid()}'[:100],
+                registrata_il=datetime.now(), secondi=round(secondi, 3), record_letti=letti,
+                record_inseriti=inseriti, record_scartati=scartati,
+                record_al_secondo=round(letti / secondi, 1) if secondi > 0 else None,
+                fasi=json.dumps(fasi),
+            ))
+
+    def ultime(self, limite=10):
+        """Metriche delle ultime esecuzioni, dalla più recente."""
+        modello = MetricheEsecuzione
+        with self.Session() as session:
+            righe = session.execute(
+                select(modello.id_esecuzione, modello.processo, modello.registrata_il, modello.secondi,
+                       modello.record_letti, modello.record_inseriti, modello.record_scartati,
+                       modello.record_al_secondo, modello.fasi)
+                .order_by(modello.id.desc()).limit(limite)
+            ).all()
+        return [dict(riga._mapping, registrata_il=riga.registrata_il.isoformat(timespec='seconds'),
+                     fasi=json.loads(riga.fasi) if riga.fasi else {}) for riga in righe]
+
+
+class LatenzeRoute:
+    """
+    Latenze delle richieste della dashboard per route (metodo e regola di Flask): istogramma del
+    tempo totale e secondi spesi nell'esecuzione delle query SQL (eventi del cursore dell'engine)
+    e nel rendering dei template Jinja (segnali di Flask). Per le risposte in streaming
+    (es. /export) il tempo è quello fino all'invio delle intestazioni.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._route = {}
+
+    def registra(self, app, engine):
+        """Collega la misura all'app Flask e all'engine SQLAlchemy."""
+        from flask import before_render_template, g, has_request_context, request, template_rendered
+
+        @app.before_request
+        def _inizio():
+            g.metriche = {'inizio': time.perf_counter(), 'sql': 0.0, 'query': 0, 'template': 0.0}
+
+        @app.after_request
+        def _fine(risposta):
+            misura = g.pop('metriche', None)
+            if misura is not None:
+                regola = request.url_rule.rule if request.url_rule is not None else '(nessuna route)'
+                self.aggiungi(f'{request.method} {regola}', time.perf_counter() - misura['inizio'],
+                              misura['sql'], misura['query'], misura['template'], risposta.status_code)
+            return risposta
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def _query_inizio(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('metriche_inizio', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def _query_fine(conn, cursor, statement, parameters, context, executemany):
+            inizio = conn.info['metriche_inizio'].pop()
+            if has_request_context() and 'metriche' in g:
+                g.metriche['sql'] += time.perf_counter() - inizio
+                g.metriche['query'] += 1
+
+        @event.listens_for(engine, 'handle_error')
+        def _query_errore(contesto):
+            # Query fallita: after_cursor_execute non viene chiamato
+            if contesto.connection is not None and contesto.connection.info.get('metriche_inizio'):
+                contesto.connection.info['metriche_inizio'].pop()
+
+        def _template_inizio(sender, template, context, **extra):
+            if 'metriche' in g:
+                g.metriche['template_inizio'] = time.perf_counter()
+
+        def _template_fine(sender, template, context, **extra):
+            if 'metriche' in g and 'template_inizio' in g.metriche:
+                g.metriche['template'] += time.perf_counter() - g.metriche.pop('template_inizio')
+
+        before_render_template.connect(_template_inizio, app, weak=False)
+        template_rendered.connect(_template_fine, app, weak=False)
+
+    def aggiungi(self, route, secondi, sql=0.0, query=0, template=0.0, stato=200):
+        with self._lock:
+            valori = self._route.get(route)
+            if valori is None:
+                valori = self._route[route] = {'istogramma': Istogramma(), 'errori': 0, 'sql_s': 0.0, 'query': 0,
+                                               'template_s': 0.0}
+            valori['istogramma'].aggiungi(secondi)
+            valori['errori'] += stato >= 500
+            valori['sql_s'] += sql
+            valori['query'] += query
+            valori['template_s'] += template
+
+    def stato(self):
+        with self._lock:
+            return {
+                route: dict(valori['istogramma'].come_dizionario(), errori=valori['errori'], query=valori['query'],
+                            sql_s=round(valori['sql_s'], 3), template_s=round(valori['template_s'], 3))
+                for route, valori in sorted(self._route.items())
+            }
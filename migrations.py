@@ -0,0 +1,160 @@
+"""
+Migrazioni versionate dello schema del database di destinazione.
+
+Ogni migrazione ha un numero di versione crescente e viene applicata una sola volta, nella propria
+transazione, registrandola in Schema_Versione. Tabelle e indici sono definiti una sola volta in
+models.py: le migrazioni li creano da lì e Create_Table.sql riporta lo stesso DDL
+(python migrations.py --sql lo genera per SQL Server).
+
+Le migrazioni vengono applicate da main.py all'avvio o esplicitamente con python migrations.py,
+mai dalla dashboard (app.py ne verifica solo la presenza). La migrazione 2 non si applica se
+Storico_Modifiche_Fatture contiene doppioni della chiave naturale (DoppioniChiaveNaturale): vanno
+verificati e rimossi esplicitamente con python migrations.py --rimuovi-doppioni.
+
+Il partizionamento per anno non è incluso: richiede partition function/scheme e la ricostruzione
+dell'indice cluster, da pianificare con il DBA se i volumi lo renderanno necessario.
+
+Uso:
+    python migrations.py          applica le migrazioni mancanti
+    python migrations.py --rimuovi-doppioni
+                                  applica le migrazioni mancanti rimuovendo i doppioni dello storico
+    python migrations.py --sql    stampa il DDL degli indici per SQL Server
+"""
+import argparse
+import configparser
+import logging
+from datetime import datetime
+
+from sqlalchemy import func, insert, inspect, select
+from sqlalchemy.dialects import mssql
+from sqlalchemy.schema import CreateIndex
+
+from database import get_engine
+from log_config import configura_logging
+from models import Base, MetricheEsecuzione, SchemaVersione, StoricoEsecuzioni, StoricoModificheFatture
+
+logger = logging.getLogger(__name__)
+
+
+class DoppioniChiaveNaturale(Exception):
+    def __init__(self, tabella, doppioni):
+        super().__init__(
+            f"{tabella} contiene {doppioni} doppioni della chiave naturale (azienda, id_documento, data_modifica, "
+            f"id_reg_pd): l'indice univoco non può essere creato. Verificarli e rimuoverli con "
+            f"python migrations.py --rimuovi-doppioni (resta la riga con l'id più basso)"
+        )
+        self.doppioni = doppioni
+
+
+def _crea_tabelle(conn, **opzioni):
+    # Crea le tabelle (con i loro indici) che non esistono ancora
+    Base.metadata.create_all(conn, checkfirst=True)
+
+
+def _indici_storico(conn, rimuovi_doppioni=False, **opzioni):
+    tabella = StoricoModificheFatture.__table__
+    esistenti = {indice['name'] for indice in inspect(conn).get_indexes(tabella.name)}
+    mancanti = [indice for indice in sorted(tabella.indexes, key=lambda i: i.name) if indice.name not in esistenti]
+    if any(indice.unique for indice in mancanti):
+        # L'indice univoco non si crea se ci sono doppioni della chiave naturale: si rimuovono solo su richiesta
+        # esplicita (resta la riga con l'id più basso), altrimenti la migrazione si ferma
+        chiave = [tabella.c.azienda, tabella.c.id_documento, tabella.c.data_modifica, tabella.c.id_reg_pd]
+        primi = select(func.min(tabella.c.id)).group_by(*chiave)
+        doppioni = conn.execute(
+            select(func.count()).select_from(tabella).where(tabella.c.id.not_in(primi))
+        ).scalar()
+        if doppioni and not rimuovi_doppioni:
+            raise DoppioniChiaveNaturale(tabella.name, doppioni)
+        if doppioni:
+            conn.execute(tabella.delete().where(tabella.c.id.not_in(primi)))
+            logger.warning("Rimossi %d doppioni della chiave naturale da %s prima dell'indice univoco",
+                           doppioni, tabella.name)
+    for indice in mancanti:
+        logger.info("Creazione indice %s", indice.name)
+        indice.create(conn)
+
+
+def _colonna_max(colonna):
+    # VARCHAR(n) -> VARCHAR(MAX); SQLite non applica la lunghezza delle VARCHAR e non va modificato
+    def migrazione(conn, **opzioni):
+        if conn.dialect.name == 'mssql':
+            conn.exec_driver_sql(f'ALTER TABLE {colonna.table.name} ALTER COLUMN {colonna.name} VARCHAR(MAX)')
+    return migrazione
+
+
+# (versione, descrizione, funzione): aggiungere in fondo, non modificare quelle già rilasciate
+MIGRAZIONI = [
+    (1, 'Tabelle di storico, checkpoint, esecuzioni e riepilogo', _crea_tabelle),
+    (2, 'Indice univoco sulla chiave naturale e indici coprenti di Storico_Modifiche_Fatture', _indici_storico),
+    (3, 'Tabella Lease_Ingestione per l\'ingestione a shard', _crea_tabelle),
+    (4, 'Tabella Metriche_Esecuzioni', _crea_tabelle),
+    # Avanzamento ed errori di molte aziende non stanno in 4000 caratteri
+    (5, 'Storico_Esecuzioni.dettaglio VARCHAR(MAX)', _colonna_max(StoricoEsecuzioni.__table__.c.dettaglio)),
+    # JSON completo: troncato a 4000 caratteri non sarebbe più leggibile da /metrics
+    (6, 'Metriche_Esecuzioni.fasi VARCHAR(MAX)', _colonna_max(MetricheEsecuzione.__table__.c.fasi)),
+]
+
+
+def versioni_applicate(engine):
+    with engine.connect() as conn:
+        return set(conn.execute(select(SchemaVersione.versione)).scalars())
+
+
+def migrazioni_mancanti(engine):
+    """Versioni di MIGRAZIONI non ancora applicate (tutte se Schema_Versione non esiste)."""
+    if not inspect(engine).has_table(SchemaVersione.__tablename__):
+        return [versione for versione, _, _ in MIGRAZIONI]
+    applicate = versioni_applicate(engine)
+    return [versione for versione, _, _ in MIGRAZIONI if versione not in applicate]
+
+
+def applica_migrazioni(engine, rimuovi_doppioni=False):
+    """
+    Applica in ordine le migrazioni non ancora registrate in Schema_Versione. Ritorna quante ne ha applicate.
+    Con rimuovi_doppioni la migrazione 2 rimuove i doppioni della chiave naturale invece di sollevare
+    DoppioniChiaveNaturale.
+    """
+    SchemaVersione.__table__.create(engine, checkfirst=True)
+    applicate = versioni_applicate(engine)
+    eseguite = 0
+    for versione, descrizione, migrazione in MIGRAZIONI:
+        if versione in applicate:
+            continue
+        logger.info("Migrazione %d: %s", versione, descrizione)
+        with engine.begin() as conn:
+            migrazione(conn, rimuovi_doppioni=rimuovi_doppioni)
+            conn.execute(insert(SchemaVersione).values(
+                versione=versione, descrizione=descrizione, applicata_il=datetime.now()
+            ))
+        eseguite += 1
+    return eseguite
+
+
+def ddl_indici():
+    """DDL SQL Server degli indici dichiarati in models.py (lo stesso riportato in Create_Table.sql)."""
+    dialetto = mssql.dialect()
+    return [str(CreateIndex(indice).compile(dialect=dialetto)).strip()
+            for tabella in Base.metadata.sorted_tables
+            for indice in sorted(tabella.indexes, key=lambda i: i.name)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrazioni dello schema del database di destinazione')
+    parser.add_argument('--sql', action='store_true', help='stampa il DDL degli indici per SQL Server')
+    parser.add_argument('--rimuovi-doppioni', action='store_true',
+                        help="rimuove i doppioni della chiave naturale da Storico_Modifiche_Fatture "
+                             "prima di creare l'indice univoco (resta la riga con l'id più basso)")
+    args = parser.parse_args()
+    if args.sql:
+        for istruzione in ddl_indici():
+            print(f"{istruzione};\nGO")
+    else:
+        config = configparser.ConfigParser()
+        config.read('config.ini')
+        configura_logging(config)
+        try:
+            applicate = applica_migrazioni(get_engine(config), rimuovi_doppioni=args.rimuovi_doppioni)
+        except DoppioniChiaveNaturale as e:
+            logger.error("%s", e)
+            parser.exit(1)
+        logger.info("Migrazioni applicate: %d", applicate)
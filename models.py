@@ -1,4 +1,4 @@
-from sqlalchemy import DECIMAL, Column, Integer, String, Date, DateTime
+from sqlalchemy import DECIMAL, Column, Float, Index, Integer, String, Date, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -28,4 +28,102 @@ class StoricoModificheFatture(Base):
     importo_fattura = Column(DECIMAL(18, 2)) # XML: importo totale documento - spesa materiale consumo
     id_reg_pd = Column(Integer) # ID registro PD
     data_trasmissione_fattura = Column(DateTime) # Query recupero fattura
-    targa = Column(String(20)) # Targa veicolo
\ No newline at end of file
+    targa = Column(String(20)) # Targa veicolo
+
+    # Indici creati dalla migrazione 2 (migrations.py). Su SQL Server l'id (chiave cluster) è incluso in ogni indice
+    # e mssql_include li rende coprenti: le query della dashboard non leggono la tabella.
+    __table_args__ = (
+        # Chiave naturale della deduplica di main.py; serve anche l'ultima modifica per (azienda, id_documento)
+        Index('UX_Storico_Chiave_Naturale', 'azienda', 'id_documento', 'data_modifica', 'id_reg_pd', unique=True,
+              mssql_include=['utente', 'importo_fattura', 'importo_modifica']),
+        # Pagine di /api/records (data_modifica, id decrescenti), senza e con filtro azienda
+        Index('IX_Storico_Data_Modifica', 'data_modifica', 'id',
+              mssql_include=['azienda', 'id_documento', 'id_reg_pd', 'data_trasmissione_fattura', 'targa',
+                             'importo_fattura', 'importo_modifica', 'utente']),
+        Index('IX_Storico_Azienda_Data_Modifica', 'azienda', 'data_modifica', 'id',
+              mssql_include=['id_documento', 'id_reg_pd', 'data_trasmissione_fattura', 'targa',
+                             'importo_fattura', 'importo_modifica', 'utente']),
+    )
+
+class CheckpointIngestione(Base):
+    __tablename__ = 'Checkpoint_Ingestione'
+
+    azienda = Column(String(10), primary_key=True)
+    id_esecuzione = Column(Integer) # Esecuzione che ha scritto il checkpoint
+    last_id_documento = Column(Integer, nullable=False) # Ultimo id_documento elaborato completamente
+    aggiornato_il = Column(DateTime)
+
+
+class StoricoEsecuzioni(Base):
+    __tablename__ = 'Storico_Esecuzioni'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    avvio = Column(DateTime, nullable=False)
+    fine = Column(DateTime)
+    stato = Column(String(20), nullable=False) # in_coda, in_corso, completata, errore, interrotta
+    record_inseriti = Column(Integer)
+    dettaglio = Column(String()) # VARCHAR(MAX), JSON: avanzamento, record inseriti ed errori per azienda
+
+
+class RiepilogoModifiche(Base):
+    __tablename__ = 'Riepilogo_Modifiche_Fatture'
+
+    # Ultima modifica di ogni documento raggruppata per azienda, mese e utente (vedi riepilogo.py)
+    azienda = Column(String(10), primary_key=True)
+    mese = Column(String(7), primary_key=True) # AAAA-MM di data_modifica
+    utente = Column(String(50), primary_key=True)
+    numero_record = Column(Integer, nullable=False)
+    differenza_totale = Column(DECIMAL(18, 2), nullable=False) # Somma delle differenze oltre la soglia
+
+
+class LeaseIngestione(Base):
+    __tablename__ = 'Lease_Ingestione'
+
+    # Shard dell'ingestione distribuita (vedi shard.py): log dell'azienda con id_da < id_documento <= id_a
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    id_esecuzione = Column(Integer, nullable=False) # Esecuzione del coordinatore in Storico_Esecuzioni
+    azienda = Column(String(10), nullable=False)
+    id_da = Column(Integer, nullable=False)
+    id_a = Column(Integer, nullable=False)
+    stato = Column(String(20), nullable=False) # libero, in_corso, completato, errore
+    worker = Column(String(100)) # Worker che ha il lease (host:pid:thread)
+    scadenza = Column(DateTime) # Senza heartbeat entro questa data il shard torna disponibile
+    ultimo_id_documento = Column(Integer, nullable=False) # Watermark del shard, avanzato con gli inserimenti
+    record_letti = Column(Integer, nullable=False, default=0)
+    record_inseriti = Column(Integer, nullable=False, default=0)
+    tentativi = Column(Integer, nullable=False, default=0)
+    errore = Column(String(1000))
+    aggiornato_il = Column(DateTime)
+
+    __table_args__ = (
+        # Shard da reclamare di un'esecuzione
+        Index('IX_Lease_Esecuzione_Stato', 'id_esecuzione', 'stato'),
+    )
+
+
+class MetricheEsecuzione(Base):
+    __tablename__ = 'Metriche_Esecuzioni'
+
+    # Metriche di fine esecuzione di main.py (vedi metriche.py), una riga per processo
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    id_esecuzione = Column(Integer, nullable=False)
+    processo = Column(String(100)) # host:pid
+    registrata_il = Column(DateTime, nullable=False)
+    secondi = Column(Float)
+    record_letti = Column(Integer)
+    record_inseriti = Column(Integer)
+    record_scartati = Column(Integer)
+    record_al_secondo = Column(Float)
+    fasi = Column(String()) # VARCHAR(MAX), JSON: per fase secondi di lavoro e attesa, percentili delle latenze
+
+    __table_args__ = (
+        Index('IX_Metriche_Esecuzione', 'id_esecuzione'),
+    )
+
+
+class SchemaVersione(Base):
+    __tablename__ = 'Schema_Versione'
+
+    versione = Column(Integer, primary_key=True, autoincrement=False) # Migrazioni applicate (vedi migrations.py)
+    descrizione = Column(String(200), nullable=False)
+    applicata_il = Column(DateTime, nullable=False)
@@ -0,0 +1,185 @@
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import RiepilogoModifiche, StoricoModificheFatture
+
+# Sotto questa soglia la differenza importo fattura - importo modifica è considerata arrotondamento
+SOGLIA_DIFFERENZA = Decimal('0.05')
+CENTESIMO = Decimal('0.01')
+
+
+def contributo(importo_fattura, importo_modifica):
+    """Differenza importo fattura - importo modifica, al centesimo, se supera la soglia, altrimenti 0."""
+    if importo_fattura is None or importo_modifica is None:
+        return Decimal('0')
+    differenza = (Decimal(importo_fattura) - Decimal(importo_modifica)).quantize(CENTESIMO)
+    return differenza if differenza > SOGLIA_DIFFERENZA else Decimal('0')
+
+
+def _gruppo(azienda, data_modifica, utente):
+    # Chiave della riga di riepilogo: (azienda, mese AAAA-MM della modifica, utente)
+    return azienda or '', data_modifica.strftime('%Y-%m') if data_modifica else '', utente or ''
+
+
+class RiepilogoStore:
+    """
+    Riepilogo_Modifiche_Fatture: numero di documenti e somma delle differenze per azienda,
+    mese (di data_modifica) e utente, calcolati sull'ultima modifica di ogni documento
+    (stessa azienda e id_documento: data_modifica più recente, a parità l'id più basso),
+    come la tabella della dashboard.
+
+    main.py lo aggiorna in modo incrementale con applica() nella stessa transazione
+    dell'inserimento in blocco; dashboard ed export leggono solo questa tabella.
+    ricostruisci() lo ricalcola da zero da Storico_Modifiche_Fatture.
+    """
+
+    def __init__(self, session_factory):
+        self.Session = session_factory
+
+    @staticmethod
+    def ultime(conn, azienda, id_documenti):
+        """
+        Ritorna {id_documento: (id, gruppo, contributo)} dell'ultima modifica salvata
+        per ciascuno degli id_documento indicati dell'azienda.
+        """
+        tabella = StoricoModificheFatture.__table__
+        id_documenti = list(id_documenti)
+        ultime = {}
+        # Al massimo 1000 parametri per query (SQL Server ne accetta 2100)
+        for start in range(0, len(id_documenti), 1000):
+            rows = conn.execute(
+                select(tabella.c.id_documento, tabella.c.id, tabella.c.data_modifica, tabella.c.utente,
+                       tabella.c.importo_fattura, tabella.c.importo_modifica)
+                .where(tabella.c.azienda == azienda, tabella.c.id_documento.in_(id_documenti[start:start + 1000]))
+            )
+            for id_documento, id_riga, data_modifica, utente, importo_fattura, importo_modifica in rows:
+                ordine = (data_modifica or datetime.min, -id_riga)
+                attuale = ultime.get(id_documento)
+                if attuale is None or ordine > attuale[0]:
+                    ultime[id_documento] = (ordine, id_riga, _gruppo(azienda, data_modifica, utente),
+                                            contributo(importo_fattura, importo_modifica))
+        return {id_documento: valori[1:] for id_documento, valori in ultime.items()}
+
+    @staticmethod
+    def applica(conn, prima, dopo):
+        """
+        Aggiorna il riepilogo con la connessione (e la transazione) del chiamante.
+        prima/dopo: risultati di ultime() letti prima e dopo l'inserimento del blocco; per ogni
+        documento la cui ultima modifica è cambiata toglie la vecchia riga dal suo gruppo e aggiunge la nuova.
+
+        Con i shard più transazioni aggiornano insieme gli stessi gruppi di un'azienda: su SQL Server
+        l'UPDATE tiene il lock sulla chiave anche se la riga non esiste (UPDLOCK, SERIALIZABLE), così
+        l'altra transazione attende l'INSERT invece di ripeterlo; i gruppi sono aggiornati in ordine
+        per evitare deadlock. Se l'INSERT trova comunque la riga già inserita (altri database) viene
+        ripetuto l'UPDATE.
+
+        La somma viene arrotondata al centesimo anche nell'UPDATE: dove DECIMAL è memorizzato in virgola
+        mobile (SQLite) le somme successive accumulerebbero errori e il riepilogo divergerebbe da ricostruisci().
+        """
+        variazioni = {}
+        for id_documento, (id_riga, gruppo, importo) in dopo.items():
+            precedente = prima.get(id_documento)
+            if precedente is not None and precedente[0] == id_riga:
+                continue
+            if precedente is not None:
+                numero, somma = variazioni.get(precedente[1], (0, Decimal('0')))
+                variazioni[precedente[1]] = (numero - 1, somma - precedente[2])
+            numero, somma = variazioni.get(gruppo, (0, Decimal('0')))
+            variazioni[gruppo] = (numero + 1, somma + importo)
+
+        tabella = RiepilogoModifiche.__table__
+        for (azienda, mese, utente), (numero, somma) in sorted(variazioni.items()):
+            if numero == 0 and somma == 0:
+                continue
+            chiave = (tabella.c.azienda == azienda, tabella.c.mese == mese, tabella.c.utente == utente)
+            aggiorna = (
+                update(tabella).where(*chiave).values(
+                    numero_record=tabella.c.numero_record + numero,
+                    differenza_totale=func.round(tabella.c.differenza_totale + somma, 2),
+                ).with_hint('WITH (UPDLOCK, SERIALIZABLE)', dialect_name='mssql')
+            )
+            result = conn.execute(aggiorna)
+            if result.rowcount == 0:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(insert(tabella).values(
+                            azienda=azienda, mese=mese, utente=utente, numero_record=numero, differenza_totale=somma
+                        ))
+                except IntegrityError:
+                    # Riga inserita nel frattempo da un'altra transazione
+                    conn.execute(aggiorna)
+            elif numero < 0:
+                conn.execute(delete(tabella).where(*chiave, tabella.c.numero_record <= 0))
+
+    def da_ricostruire(self):
+        """True se il riepilogo è vuoto ma Storico_Modifiche_Fatture no (es. prima esecuzione dopo l'aggiornamento)."""
+        with self.Session() as session:
+            if session.execute(select(RiepilogoModifiche.azienda).limit(1)).first() is not None:
+                return False
+            return session.execute(select(StoricoModificheFatture.id).limit(1)).first() is not None
+
+    def ricostruisci(self):
+        """Ricalcola tutto il riepilogo da Storico_Modifiche_Fatture. Ritorna il numero di gruppi."""
+        modello = StoricoModificheFatture
+        rn = func.row_number().over(
+            partition_by=(modello.azienda, modello.id_documento),
+            order_by=(modello.data_modifica.desc(), modello.id)
+        ).label('rn')
+        ultime = select(modello.azienda, modello.data_modifica, modello.utente,
+                        modello.importo_fattura, modello.importo_modifica, rn).subquery()
+
+        gruppi = {}
+        with self.Session() as session, session.begin():
+            conn = session.connection()
+            rows = conn.execution_options(yield_per=5000).execute(
+                select(ultime.c.azienda, ultime.c.data_modifica, ultime.c.utente,
+                       ultime.c.importo_fattura, ultime.c.importo_modifica).where(ultime.c.rn == 1)
+            )
+            for azienda, data_modifica, utente, importo_fattura, importo_modifica in rows:
+                gruppo = _gruppo(azienda, data_modifica, utente)
+                numero, somma = gruppi.get(gruppo, (0, Decimal('0')))
+                gruppi[gruppo] = (numero + 1, somma + contributo(importo_fattura, importo_modifica))
+
+            conn.execute(delete(RiepilogoModifiche))
+            if gruppi:
+                conn.execute(insert(RiepilogoModifiche), [
+                    dict(azienda=azienda, mese=mese, utente=utente, numero_record=numero, differenza_totale=somma)
+                    for (azienda, mese, utente), (numero, somma) in gruppi.items()
+                ])
+        return len(gruppi)
+
+    @staticmethod
+    def svuota(session):
+        """Svuota il riepilogo nella transazione della sessione del chiamante (es. svuotamento dello storico)."""
+        session.execute(delete(RiepilogoModifiche))
+
+    def aziende(self):
+        with self.Session() as session:
+            return [row[0] for row in session.execute(
+                select(RiepilogoModifiche.azienda).where(RiepilogoModifiche.azienda != '')
+                .distinct().order_by(RiepilogoModifiche.azienda)
+            )]
+
+    def totali(self, azienda=None):
+        """(numero documenti, somma differenze) complessivi o della sola azienda."""
+        query = select(func.coalesce(func.sum(RiepilogoModifiche.numero_record), 0),
+                       func.coalesce(func.sum(RiepilogoModifiche.differenza_totale), 0))
+        if azienda:
+            query = query.where(RiepilogoModifiche.azienda == azienda)
+        with self.Session() as session:
+            return tuple(session.execute(query).one())
+
+    def totali_per_azienda(self):
+        """Lista di (azienda, numero documenti, somma differenze) ordinata per azienda."""
+        query = (
+            select(RiepilogoModifiche.azienda, func.sum(RiepilogoModifiche.numero_record),
+                   func.sum(RiepilogoModifiche.differenza_totale))
+            .where(RiepilogoModifiche.azienda != '')
+            .group_by(RiepilogoModifiche.azienda)
+            .order_by(RiepilogoModifiche.azienda)
+        )
+        with self.Session() as session:
+            return [tuple(row) for row in session.execute(query)]
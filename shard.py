@@ -0,0 +1,280 @@
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from sqlalchemy import and_, func, insert, or_, select, update
+
+from models import LeaseIngestione, StoricoEsecuzioni
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseScaduto(Exception):
+    """Il lease del shard è scaduto ed è stato reclamato da un altro worker: il shard va abbandonato."""
+
+
+class Shard(NamedTuple):
+    id: int
+    id_esecuzione: int
+    azienda: str
+    id_da: int
+    id_a: int
+    ultimo_id_documento: int
+    worker: str
+
+
+def nome_worker(numero=0):
+    """Identificativo del worker nel lease: host, processo e numero del thread."""
+    return f'{socket.gethostname()}:{os.getpid()}:{numero}'[:100]
+
+
+def dividi_intervallo(azienda, id_minimo, id_massimo, ampiezza):
+    """
+    Shard (azienda, id_da, id_a) che coprono id_documento da id_minimo a id_massimo,
+    ciascuno di al massimo ampiezza id_documento (id_da escluso, id_a incluso).
+    """
+    if id_massimo is None:
+        return []
+    intervalli = []
+    id_da = (id_minimo or 1) - 1
+    while id_da < id_massimo:
+        id_a = min(id_da + ampiezza, id_massimo)
+        intervalli.append((azienda, id_da, id_a))
+        id_da = id_a
+    return intervalli
+
+
+class LeaseStore:
+    """
+    Lease_Ingestione: shard dell'ingestione distribuita (azienda e intervallo di id_documento)
+    reclamati dai worker di main.py su uno o più host.
+
+    Il coordinatore registra i shard di un'esecuzione con crea_shard(). Ogni worker reclama un
+    shard libero, scaduto o fallito meno di tentativi volte (reclama), ne rinnova la scadenza
+    con un heartbeat (rinnova, vedi Heartbeat) e avanza il watermark ultimo_id_documento nella
+    stessa transazione degli inserimenti (avanza), come il checkpoint per azienda. Un shard
+    il cui worker si ferma torna disponibile alla scadenza del lease e riparte dal watermark;
+    i shard completati non vengono rielaborati. Ogni aggiornamento è condizionato al worker
+    che ha il lease: chi l'ha perso non può più scrivere (LeaseScaduto).
+    Le operazioni sono singole UPDATE condizionate: funzionano con SQL Server e con SQLite.
+    Scadenze e aggiornamenti usano l'ora del database, letta una volta per operazione (_adesso),
+    così gli orologi non allineati degli host dei worker non anticipano né ritardano la scadenza dei lease.
+    """
+
+    def __init__(self, session_factory, durata=120.0, tentativi=3):
+        self.Session = session_factory
+        self.durata = durata
+        self.tentativi = tentativi
+
+    @classmethod
+    def da_config(cls, config, session_factory):
+        """Crea lo store dalla sezione [SHARD] (durata_lease in secondi, tentativi per shard)."""
+        return cls(session_factory,
+                   durata=config.getfloat('SHARD', 'durata_lease', fallback=120.0),
+                   tentativi=config.getint('SHARD', 'tentativi', fallback=3))
+
+    @staticmethod
+    def _adesso(conn):
+        # Ora del database: la stessa per tutti i worker, qualunque sia l'host
+        return conn.execute(select(func.current_timestamp())).scalar()
+
+    def _scadenza(self, adesso):
+        return adesso + timedelta(seconds=self.durata)
+
+    def _disponibile(self, adesso):
+        # Shard libero, con lease scaduto, oppure fallito con tentativi ancora disponibili
+        tabella = LeaseIngestione
+        return or_(
+            tabella.stato == 'libero',
+            and_(tabella.stato == 'in_corso', tabella.scadenza < adesso),
+            and_(tabella.stato == 'errore', tabella.tentativi < self.tentativi),
+        )
+
+    def crea_shard(self, id_esecuzione, intervalli):
+        """Registra i shard (azienda, id_da, id_a) dell'esecuzione, se non ci sono già. Ritorna quanti ne ha creati."""
+        with self.Session() as session, session.begin():
+            adesso = self._adesso(session)
+            esistenti = session.execute(
+                select(func.count()).select_from(LeaseIngestione).where(LeaseIngestione.id_esecuzione == id_esecuzione)
+            ).scalar()
+            if esistenti or not intervalli:
+                return 0
+            session.execute(insert(LeaseIngestione), [
+                dict(id_esecuzione=id_esecuzione, azienda=azienda, id_da=id_da, id_a=id_a, stato='libero',
+                     ultimo_id_documento=id_da, record_letti=0, record_inseriti=0, tentativi=0,
+                     aggiornato_il=adesso)
+                for azienda, id_da, id_a in intervalli
+            ])
+            return len(intervalli)
+
+    def esecuzione_aperta(self):
+        """Id dell'ultima esecuzione in corso con shard ancora da completare, None se non ce ne sono."""
+        with self.Session() as session:
+            return session.execute(
+                select(func.max(LeaseIngestione.id_esecuzione))
+                .join(StoricoEsecuzioni, StoricoEsecuzioni.id == LeaseIngestione.id_esecuzione)
+                .where(StoricoEsecuzioni.stato == 'in_corso', LeaseIngestione.stato != 'completato')
+            ).scalar()
+
+    def reclama(self, id_esecuzione, worker, aziende=None):
+        """
+        Assegna al worker un shard disponibile dell'esecuzione (tra le aziende indicate, se presenti)
+        e ritorna lo Shard, oppure None se non ce ne sono. Più worker possono chiamarlo insieme:
+        l'UPDATE condizionata assegna ogni shard a uno solo.
+        """
+        tabella = LeaseIngestione
+        with self.Session() as session, session.begin():
+            adesso = self._adesso(session)
+            query = (select(tabella.id).where(tabella.id_esecuzione == id_esecuzione, self._disponibile(adesso))
+                     .order_by(tabella.id).limit(20))
+            if aziende is not None:
+                query = query.where(tabella.azienda.in_(list(aziende)))
+            candidati = session.execute(query).scalars().all()
+        for id_shard in candidati:
+            with self.Session() as session, session.begin():
+                result = session.execute(
+                    update(tabella)
+                    .where(tabella.id == id_shard, self._disponibile(adesso))
+                    .values(stato='in_corso', worker=worker, scadenza=self._scadenza(adesso), errore=None,
+                            tentativi=tabella.tentativi + 1, aggiornato_il=adesso)
+                )
+                if result.rowcount == 1:
+                    riga = session.execute(
+                        select(tabella.id, tabella.id_esecuzione, tabella.azienda, tabella.id_da, tabella.id_a,
+                               tabella.ultimo_id_documento, tabella.worker).where(tabella.id == id_shard)
+                    ).one()
+                    return Shard(*riga)
+        return None
+
+    def _del_worker(self, shard):
+        return and_(LeaseIngestione.id == shard.id, LeaseIngestione.worker == shard.worker,
+                    LeaseIngestione.stato == 'in_corso')
+
+    def rinnova(self, shard):
+        """Heartbeat: sposta in avanti la scadenza del lease. Ritorna False se il lease è stato perso."""
+        with self.Session() as session, session.begin():
+            adesso = self._adesso(session)
+            result = session.execute(
+                update(LeaseIngestione).where(self._del_worker(shard))
+                .values(scadenza=self._scadenza(adesso), aggiornato_il=adesso)
+            )
+            return result.rowcount == 1
+
+    def avanza(self, conn, shard, ultimo_id_documento, inseriti=0):
+        """
+        Aggiorna watermark e record inseriti del shard usando la connessione (e quindi la transazione)
+        del chiamante. Se il lease è stato perso solleva LeaseScaduto, così la transazione degli
+        inserimenti viene annullata.
+        """
+        adesso = self._adesso(conn)
+        valori = dict(record_inseriti=LeaseIngestione.record_inseriti + inseriti, scadenza=self._scadenza(adesso),
+                      aggiornato_il=adesso)
+        if ultimo_id_documento:
+            valori['ultimo_id_documento'] = ultimo_id_documento
+        result = conn.execute(update(LeaseIngestione.__table__).where(self._del_worker(shard)).values(**valori))
+        if result.rowcount != 1:
+            raise LeaseScaduto(f"Lease del shard {shard.id} ({shard.azienda}) perso")
+
+    def completa(self, shard, letti):
+        """Segna il shard come completato. Ritorna False se nel frattempo il lease era stato perso."""
+        with self.Session() as session, session.begin():
+            result = session.execute(
+                update(LeaseIngestione).where(self._del_worker(shard))
+                .values(stato='completato', scadenza=None, ultimo_id_documento=shard.id_a,
+                        record_letti=LeaseIngestione.record_letti + letti, aggiornato_il=self._adesso(session))
+            )
+            return result.rowcount == 1
+
+    def fallisce(self, shard, errore, letti=0):
+        """Segna il shard in errore: viene reclamato di nuovo finché non esaurisce i tentativi."""
+        with self.Session() as session, session.begin():
+            session.execute(
+                update(LeaseIngestione).where(self._del_worker(shard))
+                .values(stato='errore', scadenza=None, errore=str(errore)[:1000],
+                        record_letti=LeaseIngestione.record_letti + letti, aggiornato_il=self._adesso(session))
+            )
+
+    def stato(self, id_esecuzione):
+        """
+        Riepilogo dei shard dell'esecuzione per azienda, nel formato dell'avanzamento di main.py
+        (letto da /jobs/<id>): stato, intervallo di id_documento, record e numero di shard per stato.
+        ultimo_id_documento è la somma dell'avanzamento dei shard riportata sull'intervallo, per la percentuale.
+        """
+        tabella = LeaseIngestione
+        with self.Session() as session:
+            adesso = self._adesso(session)
+            righe = session.execute(
+                select(tabella.azienda, tabella.stato, tabella.id_da, tabella.id_a, tabella.ultimo_id_documento,
+                       tabella.record_letti, tabella.record_inseriti, tabella.tentativi, tabella.scadenza, tabella.errore)
+                .where(tabella.id_esecuzione == id_esecuzione)
+            ).all()
+        aziende = {}
+        for riga in righe:
+            valori = aziende.setdefault(riga.azienda, {
+                'id_iniziale': riga.id_da, 'id_massimo': riga.id_a, 'avanzati': 0, 'letti': 0, 'inseriti': 0,
+                'shard': {},
+            })
+            stato = riga.stato
+            if stato == 'in_corso' and riga.scadenza is not None and riga.scadenza < adesso:
+                stato = 'scaduto'
+            if stato == 'errore' and riga.tentativi >= self.tentativi:
+                stato = 'fallito'
+                valori.setdefault('errore', (riga.errore or '')[:200])
+            valori['shard'][stato] = valori['shard'].get(stato, 0) + 1
+            valori['id_iniziale'] = min(valori['id_iniziale'], riga.id_da)
+            valori['id_massimo'] = max(valori['id_massimo'], riga.id_a)
+            valori['avanzati'] += riga.ultimo_id_documento - riga.id_da
+            valori['letti'] += riga.record_letti
+            valori['inseriti'] += riga.record_inseriti
+        for valori in aziende.values():
+            shard = valori['shard']
+            valori['ultimo_id_documento'] = valori['id_iniziale'] + valori.pop('avanzati')
+            if set(shard) == {'completato'}:
+                valori['stato'] = 'completata'
+            elif set(shard) <= {'completato', 'fallito'}:
+                valori['stato'] = 'errore'
+            else:
+                valori['stato'] = 'in_corso'
+        # aggiornato_il con l'ora dell'host, come l'avanzamento di main.py (confrontato da JobRunner.attiva)
+        return {'aggiornato_il': datetime.now().isoformat(timespec='seconds'), 'aziende': aziende}
+
+
+class Heartbeat:
+    """
+    Thread che rinnova il lease del shard ogni terzo della durata finché il blocco with è in corso.
+    Se il lease viene perso chiama perso() (es. per fermare la pipeline); aggiorna() viene chiamata
+    a ogni rinnovo (es. per salvare l'avanzamento dell'esecuzione).
+    """
+
+    def __init__(self, lease_store, shard, perso=None, aggiorna=None):
+        self.lease_store = lease_store
+        self.shard = shard
+        self.perso = perso
+        self.aggiorna = aggiorna
+        self._fine = threading.Event()
+        self._thread = threading.Thread(target=self._esegui, name=f'heartbeat-{shard.id}', daemon=True)
+
+    def _esegui(self):
+        while not self._fine.wait(self.lease_store.durata / 3):
+            try:
+                if not self.lease_store.rinnova(self.shard):
+                    logger.warning("Lease del shard %d (%s) perso", self.shard.id, self.shard.azienda)
+                    if self.perso is not None:
+                        self.perso()
+                    return
+                if self.aggiorna is not None:
+                    self.aggiorna()
+            except Exception as e:
+                # Un heartbeat mancato non ferma il shard: il lease scade solo dopo la durata intera
+                logger.warning("Heartbeat del shard %d non riuscito: %s", self.shard.id, e)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._fine.set()
+        self._thread.join()